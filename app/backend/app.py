@@ -4,12 +4,14 @@ import json
 import logging
 import mimetypes
 import os
+import time
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Union, cast
+from typing import Any, AsyncGenerator, Dict, Optional, Union, cast
 
+import aiohttp
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core.exceptions import AzureError, ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.keyvault.secrets.aio import SecretClient
 from azure.monitor.opentelemetry import configure_azure_monitor
@@ -42,8 +44,11 @@ from quart_cors import cors
 from approaches.approach import Approach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
+from approaches.contextcompressor import ContextCompressor
+from approaches.conversationsummarizer import ConversationSummarizer
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
+from approaches.rewritepolicy import QueryRewritePolicy
 from config import (
     CONFIG_ASK_APPROACH,
     CONFIG_ASK_VISION_APPROACH,
@@ -51,16 +56,29 @@ from config import (
     CONFIG_BLOB_CONTAINER_CLIENT,
     CONFIG_CHAT_APPROACH,
     CONFIG_CHAT_VISION_APPROACH,
+    CONFIG_CONVERSATION_STORE,
+    CONFIG_EMBEDDING_CACHE,
     CONFIG_GPT4V_DEPLOYED,
     CONFIG_INGESTER,
     CONFIG_OPENAI_CLIENT,
+    CONFIG_SEARCH_CACHE,
     CONFIG_SEARCH_CLIENT,
     CONFIG_SEMANTIC_RANKER_DEPLOYED,
+    CONFIG_STREAM_COALESCE_MS,
     CONFIG_USER_BLOB_CONTAINER_CLIENT,
     CONFIG_USER_UPLOAD_ENABLED,
     CONFIG_VECTOR_SEARCH_ENABLED,
+    CONFIG_VISION_SESSION,
 )
 from core.authentication import AuthenticationHelper
+from core.cache import CacheGeneration, SqliteCacheBackend, TTLCache
+from core.conversationstore import ConversationStore
+from core.streaming import (
+    StreamDelta,
+    coalesce_deltas,
+    time_to_first_byte,
+    time_to_first_token,
+)
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
 from prepdocs import (
@@ -71,6 +89,7 @@ from prepdocs import (
 )
 from prepdocslib.filestrategy import UploadUserFileStrategy
 from prepdocslib.listfilestrategy import File
+from prepdocslib.localsearch import LocalSearchClient
 
 bp = Blueprint("routes", __name__, static_folder="static")
 # Fix Windows registry issue with mimetypes
@@ -175,10 +194,25 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+async def format_as_ndjson(
+    r: AsyncGenerator[dict, None], coalesce_ms: float = 0, start_time: Optional[float] = None
+) -> AsyncGenerator[str, None]:
     try:
+        if coalesce_ms > 0:
+            r = coalesce_deltas(r, coalesce_ms / 1000)
+        first_event = first_delta = True
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+            if start_time is not None and first_event:
+                first_event = False
+                time_to_first_byte.record((time.perf_counter() - start_time) * 1000)
+            if isinstance(event, StreamDelta):
+                if start_time is not None and first_delta:
+                    first_delta = False
+                    time_to_first_token.record((time.perf_counter() - start_time) * 1000)
+                # Most of the stream is deltas, which only need their content encoded
+                yield event.to_ndjson()
+            else:
+                yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps(error_dict(error))
@@ -187,6 +221,7 @@ async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str,
 @bp.route("/chat", methods=["POST"])
 @authenticated
 async def chat(auth_claims: Dict[str, Any]):
+    start_time = time.perf_counter()
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
     request_json = await request.get_json()
@@ -209,7 +244,11 @@ async def chat(auth_claims: Dict[str, Any]):
         if isinstance(result, dict):
             return jsonify(result)
         else:
-            response = await make_response(format_as_ndjson(result))
+            response = await make_response(
+                format_as_ndjson(
+                    result, coalesce_ms=current_app.config[CONFIG_STREAM_COALESCE_MS], start_time=start_time
+                )
+            )
             response.timeout = None  # type: ignore
             response.mimetype = "application/json-lines"
             return response
@@ -339,9 +378,26 @@ async def setup_clients():
     AZURE_SEARCH_QUERY_LANGUAGE = os.getenv("AZURE_SEARCH_QUERY_LANGUAGE", "en-us")
     AZURE_SEARCH_QUERY_SPELLER = os.getenv("AZURE_SEARCH_QUERY_SPELLER", "lexicon")
     AZURE_SEARCH_SEMANTIC_RANKER = os.getenv("AZURE_SEARCH_SEMANTIC_RANKER", "free").lower()
+    # Search a local index stored in this folder instead of Azure AI Search, see prepdocslib/localsearch.py
+    LOCAL_SEARCH_PATH = os.getenv("LOCAL_SEARCH_PATH")
+    if LOCAL_SEARCH_PATH:
+        AZURE_SEARCH_SEMANTIC_RANKER = "disabled"
 
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
     USE_USER_UPLOAD = os.getenv("USE_USER_UPLOAD", "").lower() == "true"
+    EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 1000))
+    EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 86400))
+    EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+    # Off by default, as only the app, prepdocs and manageacl runs that share SEARCH_CACHE_PATH invalidate it
+    SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 0))
+    SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 300))
+    SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH")
+    USE_QUERY_REWRITE_POLICY = os.getenv("USE_QUERY_REWRITE_POLICY", "").lower() == "true"
+    USE_CONTEXT_COMPRESSION = os.getenv("USE_CONTEXT_COMPRESSION", "").lower() == "true"
+    USE_CONVERSATION_STORE = os.getenv("USE_CONVERSATION_STORE", "").lower() == "true"
+    USE_CONVERSATION_SUMMARY = os.getenv("USE_CONVERSATION_SUMMARY", "").lower() == "true"
+    VISION_MAX_CONNECTIONS = int(os.getenv("VISION_MAX_CONNECTIONS", 20))
+    VISION_KEEPALIVE_TIMEOUT = int(os.getenv("VISION_KEEPALIVE_TIMEOUT", 60))
 
     # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
@@ -363,25 +419,47 @@ async def setup_clients():
     search_credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
         AzureKeyCredential(search_key) if search_key else azure_credential
     )
-    search_client = SearchClient(
-        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-        index_name=AZURE_SEARCH_INDEX,
-        credential=search_credential,
-    )
+    search_client: SearchClient
+    if LOCAL_SEARCH_PATH:
+        current_app.logger.info("LOCAL_SEARCH_PATH is set, searching the local index in %s", LOCAL_SEARCH_PATH)
+        search_client = cast(SearchClient, LocalSearchClient(LOCAL_SEARCH_PATH, AZURE_SEARCH_INDEX))
+    else:
+        search_client = SearchClient(
+            endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+            index_name=AZURE_SEARCH_INDEX,
+            credential=search_credential,
+        )
 
     blob_container_client = ContainerClient(
         f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", AZURE_STORAGE_CONTAINER, credential=azure_credential
     )
 
-    # Set up authentication helper
+    # The index definition tells whether the access control fields exist, and which vector fields can be returned
     search_index = None
-    if AZURE_USE_AUTHENTICATION:
+    if LOCAL_SEARCH_PATH:
+        search_index = cast(LocalSearchClient, search_client).get_index()
+    else:
         search_index_client = SearchIndexClient(
             endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
             credential=search_credential,
         )
-        search_index = await search_index_client.get_index(AZURE_SEARCH_INDEX)
-        await search_index_client.close()
+        try:
+            search_index = await search_index_client.get_index(AZURE_SEARCH_INDEX)
+        except AzureError:
+            # Only authentication can't do without the definition
+            if AZURE_USE_AUTHENTICATION:
+                raise
+            logging.warning("Could not read the definition of search index %s", AZURE_SEARCH_INDEX)
+        finally:
+            await search_index_client.close()
+    # Vectors of indexes that don't store them, such as with the storage-optimized profile, can't be selected
+    retrievable_fields = (
+        [field.name for field in search_index.fields if not field.hidden and field.stored is not False]
+        if search_index
+        else None
+    )
+
+    # Set up authentication helper
     auth_helper = AuthenticationHelper(
         search_index=search_index,
         use_authentication=AZURE_USE_AUTHENTICATION,
@@ -392,6 +470,19 @@ async def setup_clients():
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
     )
 
+    # Cache search results until they expire or until documents are ingested, which increments the search generation
+    search_cache: Optional[TTLCache] = None
+    if SEARCH_CACHE_SIZE > 0:
+        search_cache_backend = SqliteCacheBackend(SEARCH_CACHE_PATH) if SEARCH_CACHE_PATH else None
+        search_cache = TTLCache(
+            "search",
+            max_size=SEARCH_CACHE_SIZE,
+            ttl=SEARCH_CACHE_TTL,
+            shared_backend=search_cache_backend,
+            generation=CacheGeneration("search", shared_backend=search_cache_backend),
+        )
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+
     if USE_USER_UPLOAD:
         current_app.logger.info("USE_USER_UPLOAD is true, setting up user upload feature")
         if not AZURE_USERSTORAGE_ACCOUNT or not AZURE_USERSTORAGE_CONTAINER:
@@ -418,6 +509,7 @@ async def setup_clients():
             index_name=AZURE_SEARCH_INDEX,
             azure_credential=azure_credential,
             search_key=clean_key_if_exists(search_key),
+            local_search_path=LOCAL_SEARCH_PATH,
         )
         text_embeddings_service = setup_embeddings_service(
             azure_credential=azure_credential,
@@ -430,8 +522,17 @@ async def setup_clients():
             openai_org=OPENAI_ORGANIZATION,
             disable_vectors=os.getenv("USE_VECTORS", "").lower() == "false",
         )
+        search_generation = search_cache.generation if search_cache else None
+
+        def invalidate_search_cache():
+            if search_generation:
+                search_generation.increment()
+
         ingester = UploadUserFileStrategy(
-            search_info=search_info, embeddings=text_embeddings_service, file_processors=file_processors
+            search_info=search_info,
+            embeddings=text_embeddings_service,
+            file_processors=file_processors,
+            on_index_changed=invalidate_search_cache,
         )
         current_app.config[CONFIG_INGESTER] = ingester
 
@@ -464,6 +565,17 @@ async def setup_clients():
             organization=OPENAI_ORGANIZATION,
         )
 
+    # Cache query embeddings, shared between the worker processes of the host when a cache file is configured
+    embedding_cache: Optional[TTLCache] = None
+    if EMBEDDING_CACHE_SIZE > 0:
+        embedding_cache = TTLCache(
+            "embeddings",
+            max_size=EMBEDDING_CACHE_SIZE,
+            ttl=EMBEDDING_CACHE_TTL,
+            shared_backend=SqliteCacheBackend(EMBEDDING_CACHE_PATH) if EMBEDDING_CACHE_PATH else None,
+        )
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+
     current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
@@ -472,8 +584,17 @@ async def setup_clients():
     current_app.config[CONFIG_GPT4V_DEPLOYED] = bool(USE_GPT4V)
     current_app.config[CONFIG_SEMANTIC_RANKER_DEPLOYED] = AZURE_SEARCH_SEMANTIC_RANKER != "disabled"
     current_app.config[CONFIG_VECTOR_SEARCH_ENABLED] = os.getenv("USE_VECTORS", "").lower() != "false"
+    # Optionally merge the deltas of streamed answers generated within a few milliseconds into a single frame
+    current_app.config[CONFIG_STREAM_COALESCE_MS] = float(os.getenv("STREAM_COALESCE_MS", 0))
     current_app.config[CONFIG_USER_UPLOAD_ENABLED] = bool(USE_USER_UPLOAD)
 
+    # Optionally keep only the sentences of the sources that are relevant to the question in the answer prompt
+    context_compressor: Optional[ContextCompressor] = None
+    if USE_CONTEXT_COMPRESSION:
+        context_compressor = ContextCompressor(
+            max_source_chars=int(os.getenv("CONTEXT_COMPRESSION_MAX_SOURCE_CHARS", 800)),
+        )
+
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
     current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
@@ -489,8 +610,45 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        retrievable_fields=retrievable_fields,
+        context_compressor=context_compressor,
     )
 
+    # Optionally search for first turn questions as they are, without generating a search query first
+    query_rewrite_policy: Optional[QueryRewritePolicy] = None
+    if USE_QUERY_REWRITE_POLICY:
+        query_rewrite_policy = QueryRewritePolicy(
+            max_user_messages=int(os.getenv("QUERY_REWRITE_MAX_USER_MESSAGES", 1)),
+            max_question_words=int(os.getenv("QUERY_REWRITE_MAX_QUESTION_WORDS", 30)),
+        )
+
+    # Optionally keep the conversations on the server, so that follow-up turns only process the new messages
+    conversation_store: Optional[ConversationStore] = None
+    if USE_CONVERSATION_STORE:
+        CONVERSATION_STORE_PATH = os.getenv("CONVERSATION_STORE_PATH")
+        conversation_store = ConversationStore(
+            max_size=int(os.getenv("CONVERSATION_STORE_SIZE", 1000)),
+            ttl=int(os.getenv("CONVERSATION_STORE_TTL", 86400)),
+            shared_backend=SqliteCacheBackend(CONVERSATION_STORE_PATH) if CONVERSATION_STORE_PATH else None,
+        )
+    current_app.config[CONFIG_CONVERSATION_STORE] = conversation_store
+
+    # Optionally replace the older turns of long conversations with a summary, kept in the conversation store
+    conversation_summarizer: Optional[ConversationSummarizer] = None
+    if USE_CONVERSATION_SUMMARY:
+        if not conversation_store:
+            raise ValueError("USE_CONVERSATION_STORE must be true when USE_CONVERSATION_SUMMARY is true")
+        conversation_summarizer = ConversationSummarizer(
+            openai_client=openai_client,
+            chatgpt_model=OPENAI_CHATGPT_MODEL,
+            chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+            conversation_store=conversation_store,
+            trigger_tokens=int(os.getenv("CONVERSATION_SUMMARY_TRIGGER_TOKENS", 1000)),
+            keep_recent_messages=int(os.getenv("CONVERSATION_SUMMARY_KEEP_MESSAGES", 4)),
+        )
+
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
         search_client=search_client,
         openai_client=openai_client,
@@ -504,13 +662,26 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        retrievable_fields=retrievable_fields,
+        query_rewrite_policy=query_rewrite_policy,
+        context_compressor=context_compressor,
+        conversation_store=conversation_store,
+        conversation_summarizer=conversation_summarizer,
     )
 
     if USE_GPT4V:
         current_app.logger.info("USE_GPT4V is true, setting up GPT4V approach")
         if not AZURE_OPENAI_GPT4V_MODEL:
             raise ValueError("AZURE_OPENAI_GPT4V_MODEL must be set when USE_GPT4V is true")
+        # The token provider caches its token until shortly before it expires
         token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
+        # Keep the connections to the Vision endpoint alive between requests, instead of a new TLS handshake each time
+        vision_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=VISION_MAX_CONNECTIONS, keepalive_timeout=VISION_KEEPALIVE_TIMEOUT)
+        )
+        current_app.config[CONFIG_VISION_SESSION] = vision_session
 
         current_app.config[CONFIG_ASK_VISION_APPROACH] = RetrieveThenReadVisionApproach(
             search_client=search_client,
@@ -528,6 +699,10 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            retrievable_fields=retrievable_fields,
+            vision_session=vision_session,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -546,6 +721,12 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            retrievable_fields=retrievable_fields,
+            vision_session=vision_session,
+            conversation_store=conversation_store,
+            conversation_summarizer=conversation_summarizer,
         )
 
 
@@ -555,6 +736,16 @@ async def close_clients():
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
         await current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT].close()
+    if current_app.config.get(CONFIG_VISION_SESSION):
+        await current_app.config[CONFIG_VISION_SESSION].close()
+    caches = [current_app.config.get(CONFIG_EMBEDDING_CACHE), current_app.config.get(CONFIG_SEARCH_CACHE)]
+    if conversation_store := current_app.config.get(CONFIG_CONVERSATION_STORE):
+        caches.append(conversation_store.cache)
+    for cache in caches:
+        if cache:
+            current_app.logger.info("Cache %s stats: %s", cache.name, cache.stats())
+            if cache.shared_backend:
+                cache.shared_backend.close()
 
 
 def create_app():
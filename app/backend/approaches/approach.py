@@ -1,5 +1,12 @@
+import asyncio
+import hashlib
+import json
+import logging
 import os
+import time
+import unicodedata
 from abc import ABC
+from array import array
 from dataclasses import dataclass
 from typing import (
     Any,
@@ -25,6 +32,7 @@ from azure.search.documents.models import (
 from openai import AsyncOpenAI
 
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
 from text import nonewlines
 
 
@@ -70,6 +78,52 @@ class Document:
             "reranker_score": self.reranker_score,
         }
 
+    def serialize_for_cache(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "content": self.content,
+            "category": self.category,
+            "sourcepage": self.sourcepage,
+            "sourcefile": self.sourcefile,
+            "oids": self.oids,
+            "groups": self.groups,
+            "captions": [
+                {
+                    "additional_properties": caption.additional_properties,
+                    "text": caption.text,
+                    "highlights": caption.highlights,
+                }
+                for caption in self.captions or []
+            ],
+            "score": self.score,
+            "reranker_score": self.reranker_score,
+        }
+
+    @classmethod
+    def from_cache(cls, cached: dict[str, Any]) -> "Document":
+        return cls(
+            id=cached["id"],
+            content=cached["content"],
+            embedding=None,
+            image_embedding=None,
+            category=cached["category"],
+            sourcepage=cached["sourcepage"],
+            sourcefile=cached["sourcefile"],
+            oids=cached["oids"],
+            groups=cached["groups"],
+            captions=[Document.caption_from_cache(caption) for caption in cached["captions"]],
+            score=cached["score"],
+            reranker_score=cached["reranker_score"],
+        )
+
+    @classmethod
+    def caption_from_cache(cls, cached: dict[str, Any]) -> QueryCaptionResult:
+        caption = QueryCaptionResult(additional_properties=cached["additional_properties"])
+        # text and highlights are read-only for the service, but not on the model
+        caption.text = cached["text"]
+        caption.highlights = cached["highlights"]
+        return caption
+
     @classmethod
     def trim_embedding(cls, embedding: Optional[List[float]]) -> Optional[str]:
         """Returns a trimmed list of floats from the vector embedding."""
@@ -91,6 +145,17 @@ class ThoughtStep:
 
 
 class Approach(ABC):
+    # Fields returned by search, the vector fields are only fetched when the include_vectors override is set
+    SEARCH_FIELDS = ["id", "content", "category", "sourcepage", "sourcefile"]
+    ACL_FIELDS = ["oids", "groups"]
+    VECTOR_FIELDS = ["embedding"]
+    embedding_cache: Optional[TTLCache] = None
+    search_cache: Optional[TTLCache] = None
+    # Fields that the index returns in search results, when known. Vector fields that aren't stored can't be selected
+    retrievable_fields: Optional[List[str]] = None
+    # Session shared by all the requests to the Vision endpoint, when the app provides one
+    vision_session: Optional[aiohttp.ClientSession] = None
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -104,6 +169,9 @@ class Approach(ABC):
         openai_host: str,
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
+        embedding_cache: Optional[TTLCache] = None,
+        search_cache: Optional[TTLCache] = None,
+        retrievable_fields: Optional[List[str]] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -116,6 +184,13 @@ class Approach(ABC):
         self.openai_host = openai_host
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.retrievable_fields = retrievable_fields
+
+    @staticmethod
+    def elapsed_ms(start: float) -> float:
+        return round((time.perf_counter() - start) * 1000, 1)
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         exclude_category = overrides.get("exclude_category")
@@ -127,6 +202,54 @@ class Approach(ABC):
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
+    def build_select(self, include_vectors: bool) -> List[str]:
+        select = list(self.SEARCH_FIELDS)
+        if self.auth_helper and self.auth_helper.has_auth_fields:
+            select += self.ACL_FIELDS
+        if include_vectors:
+            select += [
+                field
+                for field in self.VECTOR_FIELDS
+                if self.retrievable_fields is None or field in self.retrievable_fields
+            ]
+        return select
+
+    def search_cache_key(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: List[VectorQuery],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        select: List[str],
+    ) -> str:
+        # The filter includes the security filter, so users never share results for documents they can't access
+        vector_keys = [
+            (
+                [
+                    vector.fields,
+                    vector.k_nearest_neighbors,
+                    hashlib.sha256(array("d", vector.vector).tobytes()).hexdigest(),
+                ]
+                if isinstance(vector, VectorizedQuery)
+                else vector.as_dict()
+            )
+            for vector in vectors
+        ]
+        key_parts = [
+            top,
+            query_text,
+            filter,
+            vector_keys,
+            use_semantic_ranker,
+            use_semantic_captions,
+            self.query_language,
+            self.query_speller,
+            select,
+        ]
+        return hashlib.sha256(json.dumps(key_parts).encode()).hexdigest()
+
     async def search(
         self,
         top: int,
@@ -137,6 +260,91 @@ class Approach(ABC):
         use_semantic_captions: bool,
         minimum_search_score: Optional[float],
         minimum_reranker_score: Optional[float],
+        include_vectors: bool = False,
+        use_cache: bool = True,
+    ) -> List[Document]:
+        # Vectors are the bulk of each search result, only return them when asked to
+        select = self.build_select(include_vectors)
+        # Results with vectors are too large to be worth caching
+        search_cache = self.search_cache if not include_vectors else None
+        cache_key = ""
+        cached = None
+        if search_cache is not None:
+            cache_key = self.search_cache_key(
+                top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions, select
+            )
+            if use_cache:
+                cached = search_cache.get(cache_key)
+
+        if cached is not None:
+            documents = [Document.from_cache(document) for document in json.loads(cached)]
+        else:
+            documents = await self.query_documents(
+                top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions, select
+            )
+            if search_cache is not None:
+                search_cache.set(
+                    cache_key, json.dumps([document.serialize_for_cache() for document in documents]).encode()
+                )
+
+        return [
+            doc
+            for doc in documents
+            if (
+                (doc.score or 0) >= (minimum_search_score or 0)
+                and (doc.reranker_score or 0) >= (minimum_reranker_score or 0)
+            )
+        ]
+
+    @staticmethod
+    def fuse_results(result_lists: List[List[Document]], top: int, k: int = 60) -> List[Document]:
+        """Merges ranked result lists with reciprocal rank fusion, keeping each document once."""
+        scores: dict[str, float] = {}
+        documents: dict[str, Document] = {}
+        for results in result_lists:
+            for rank, document in enumerate(results, start=1):
+                key = document.id or f"{document.sourcepage}:{document.content}"
+                scores[key] = scores.get(key, 0.0) + 1 / (k + rank)
+                documents.setdefault(key, document)
+        # Ties keep the order in which the documents were first seen, so the first list wins
+        ranked = sorted(scores, key=lambda key: scores[key], reverse=True)
+        return [documents[key] for key in ranked[:top]]
+
+    @staticmethod
+    async def gather_within_budget(
+        coroutines: List[Awaitable[List[Document]]], budget_ms: float
+    ) -> List[Optional[List[Document]]]:
+        """
+        Runs the searches concurrently and returns the results of those that finished within the budget, None for the
+        others. When none of them finished in time, waits for the first one so that there is always something to answer.
+        """
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=budget_ms / 1000)
+            while pending and not any(not task.exception() for task in done):
+                more_done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                done |= more_done
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        failed = [task.exception() for task in done if task.exception()]
+        if len(failed) == len(tasks):
+            raise failed[0]  # type: ignore[misc]
+        for exception in failed:
+            logging.warning("Search failed and was left out of the results: %s", exception)
+        return [task.result() if task in done and not task.exception() else None for task in tasks]
+
+    async def query_documents(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: List[VectorQuery],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        select: List[str],
     ) -> List[Document]:
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
         if use_semantic_ranker and query_text:
@@ -150,10 +358,11 @@ class Approach(ABC):
                 top=top,
                 query_caption="extractive|highlight-false" if use_semantic_captions else None,
                 vector_queries=vectors,
+                select=select,
             )
         else:
             results = await self.search_client.search(
-                search_text=query_text or "", filter=filter, top=top, vector_queries=vectors
+                search_text=query_text or "", filter=filter, top=top, vector_queries=vectors, select=select
             )
 
         documents = []
@@ -175,17 +384,7 @@ class Approach(ABC):
                         reranker_score=document.get("@search.reranker_score"),
                     )
                 )
-
-            qualified_documents = [
-                doc
-                for doc in documents
-                if (
-                    (doc.score or 0) >= (minimum_search_score or 0)
-                    and (doc.reranker_score or 0) >= (minimum_reranker_score or 0)
-                )
-            ]
-
-        return qualified_documents
+        return documents
 
     def get_sources_content(
         self, results: List[Document], use_semantic_captions: bool, use_image_citation: bool
@@ -208,14 +407,38 @@ class Approach(ABC):
             return sourcepage
         else:
             path, ext = os.path.splitext(sourcepage)
-            if ext.lower() == ".png":
+            if ext.lower() in (".png", ".jpg", ".webp"):
                 page_idx = path.rfind("-")
                 page_number = int(path[page_idx + 1 :])
                 return f"{path[:page_idx]}.pdf#page={page_number}"
 
             return sourcepage
 
-    async def compute_text_embedding(self, q: str):
+    @staticmethod
+    def normalize_query(q: str) -> str:
+        return " ".join(unicodedata.normalize("NFC", q).split())
+
+    def embedding_cache_key(self, *parts: Any) -> str:
+        return ":".join(str(part) for part in parts[:-1]) + ":" + hashlib.sha256(parts[-1].encode()).hexdigest()
+
+    def get_cached_embedding(self, cache_key: str, use_cache: bool) -> Optional[List[float]]:
+        if not use_cache or self.embedding_cache is None:
+            return None
+        cached = self.embedding_cache.get(cache_key)
+        return array("d", cached).tolist() if cached is not None else None
+
+    def set_cached_embedding(self, cache_key: str, embedding: List[float]):
+        if self.embedding_cache is not None:
+            self.embedding_cache.set(cache_key, array("d", embedding).tobytes())
+
+    async def compute_text_embedding(self, q: str, use_cache: bool = True):
+        q = self.normalize_query(q)
+        cache_key = self.embedding_cache_key(
+            "text", self.embedding_model, self.embedding_deployment, self.embedding_dimensions, q
+        )
+        if cached_vector := self.get_cached_embedding(cache_key, use_cache):
+            return VectorizedQuery(vector=cached_vector, k_nearest_neighbors=50, fields="embedding")
+
         SUPPORTED_DIMENSIONS_MODEL = {
             "text-embedding-ada-002": False,
             "text-embedding-3-small": True,
@@ -235,22 +458,47 @@ class Approach(ABC):
             **dimensions_args,
         )
         query_vector = embedding.data[0].embedding
+        self.set_cached_embedding(cache_key, query_vector)
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields="embedding")
 
-    async def compute_image_embedding(self, q: str):
+    async def compute_vectors(self, q: str, vector_fields: List[str], use_cache: bool = True) -> List[VectorQuery]:
+        # The text and image embeddings come from different services, so compute them concurrently
+        vectors = await asyncio.gather(
+            *(
+                (
+                    self.compute_text_embedding(q, use_cache=use_cache)
+                    if field == "embedding"
+                    else self.compute_image_embedding(q, use_cache=use_cache)
+                )
+                for field in vector_fields
+            )
+        )
+        return list(vectors)
+
+    async def compute_image_embedding(self, q: str, use_cache: bool = True):
+        q = self.normalize_query(q)
+        params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
+        cache_key = self.embedding_cache_key("image", self.vision_endpoint, params["modelVersion"], q)
+        if cached_vector := self.get_cached_embedding(cache_key, use_cache):
+            return VectorizedQuery(vector=cached_vector, k_nearest_neighbors=50, fields="imageEmbedding")
+
         endpoint = urljoin(self.vision_endpoint, "computervision/retrieval:vectorizeText")
         headers = {"Content-Type": "application/json"}
-        params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
-        data = {"text": q}
+        body = {"text": q}
 
         headers["Authorization"] = "Bearer " + await self.vision_token_provider()
 
-        async with aiohttp.ClientSession() as session:
+        session = self.vision_session or aiohttp.ClientSession()
+        try:
             async with session.post(
-                url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
+                url=endpoint, params=params, headers=headers, json=body, raise_for_status=True
             ) as response:
-                json = await response.json()
-                image_query_vector = json["vector"]
+                data = await response.json()
+                image_query_vector = data["vector"]
+        finally:
+            if session is not self.vision_session:
+                await session.close()
+        self.set_cached_embedding(cache_key, image_query_vector)
         return VectorizedQuery(vector=image_query_vector, k_nearest_neighbors=50, fields="imageEmbedding")
 
     async def run(
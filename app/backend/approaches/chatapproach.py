@@ -1,8 +1,10 @@
+import asyncio
 import json
 import logging
 import re
+import unicodedata
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Optional, Union
+from typing import Any, AsyncGenerator, Callable, Optional, Union
 
 from openai.types.chat import (
     ChatCompletion,
@@ -10,8 +12,11 @@ from openai.types.chat import (
     ChatCompletionMessageParam,
 )
 
-from approaches.approach import Approach
-from core.messagebuilder import MessageBuilder
+from approaches.approach import Approach, ThoughtStep
+from approaches.conversationsummarizer import ConversationSummarizer
+from core.conversationstore import Conversation, ConversationStore
+from core.messagebuilder import MessageBuilder, PromptPrefixCache
+from core.streaming import FollowupQuestionParser, StreamDelta
 
 
 class ChatApproach(Approach, ABC):
@@ -30,7 +35,7 @@ class ChatApproach(Approach, ABC):
         {"role": USER, "content": "Quais foram as provas apresentadas no caso trabalhista?"},
         {"role": ASSISTANT, "content": "Identifique as provas apresentadas no caso trabalhista"},
         {"role": USER, "content": "Qual foi o resultado da apelação no caso de locação de aluguel?"},
-        {"role": ASSISTANT, "content": "Informe o resultado da apelação no caso de locação de aluguel"}
+        {"role": ASSISTANT, "content": "Informe o resultado da apelação no caso de locação de aluguel"},
         {"role": USER, "content": "Qual é o procedimento para entrar com uma ação de despejo por falta de pagamento?"},
         {"role": ASSISTANT, "content": "Explique o procedimento para entrar com uma ação de despejo por falta de pagamento"},
         {"role": USER, "content": "Quais são os requisitos para caracterizar uma rescisão indireta do contrato de trabalho?"},
@@ -47,6 +52,20 @@ class ChatApproach(Approach, ABC):
         {"role": ASSISTANT, "content": "Identifique as formas de garantia de um contrato de locação"}
     ]
     NO_RESPONSE = "0"
+    # Speculative search results for the user question are reused when this share of the words of the generated
+    # search query already appear in the question, as the generated query then adds no context from the history
+    SPECULATIVE_QUERY_OVERLAP = 0.8
+    # Time allowed for the searches of the query variants, the variants still searching after it are left out
+    RETRIEVAL_BUDGET_MS = 2000
+    # Share of the prompt tokens, after the system prompt and the question, that the sources can use before the history
+    SOURCES_TOKEN_SHARE = 0.75
+
+    # Set by the subclasses, see precompute_prompt_prefixes
+    prompt_prefixes: PromptPrefixCache
+    # Keeps the conversations between turns when set, keyed by the session_state returned to the client
+    conversation_store: Optional[ConversationStore] = None
+    # Summarizes the older turns of long conversations kept in the conversation store when set
+    conversation_summarizer: Optional[ConversationSummarizer] = None
 
     follow_up_questions_prompt_content = """<<Gere 3 perguntas de acompanhamento muito breves que o usuário provavelmente faria em seguida.
     Inclua as perguntas de acompanhamento entre duplos sinais de ângulo. Exemplo:
@@ -72,9 +91,26 @@ class ChatApproach(Approach, ABC):
         pass
 
     @abstractmethod
-    async def run_until_final_call(self, history, overrides, auth_claims, should_stream) -> tuple:
+    async def run_until_final_call(
+        self,
+        history,
+        overrides,
+        auth_claims,
+        should_stream,
+        conversation: Optional[Conversation] = None,
+        thought_listener: Optional[Callable[[ThoughtStep], None]] = None,
+    ) -> tuple:
         pass
 
+    @staticmethod
+    def add_thought(
+        thoughts: list[ThoughtStep], thought: ThoughtStep, thought_listener: Optional[Callable[[ThoughtStep], None]]
+    ):
+        """Adds the thought of a stage that has completed, and passes it to the listener, which streams it."""
+        thoughts.append(thought)
+        if thought_listener:
+            thought_listener(thought)
+
     def get_system_prompt(self, override_prompt: Optional[str], follow_up_questions_prompt: str) -> str:
         if override_prompt is None:
             return self.system_message_chat_conversation.format(
@@ -87,6 +123,16 @@ class ChatApproach(Approach, ABC):
         else:
             return override_prompt.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
+    def precompute_prompt_prefixes(self, model_id: str):
+        """
+        Builds the prefixes of the query prompt and of the answer prompts without a prompt override, so that requests
+        only assemble the history and the question. Prefixes for overridden prompts are built on their first use
+        """
+        self.prompt_prefixes = PromptPrefixCache()
+        self.prompt_prefixes.get(self.query_prompt_template, model_id, self.query_prompt_few_shots)
+        for follow_up_questions_prompt in ("", self.follow_up_questions_prompt_content):
+            self.prompt_prefixes.get(self.get_system_prompt(None, follow_up_questions_prompt), model_id)
+
     def get_search_query(self, chat_completion: ChatCompletion, user_query: str):
         response_message = chat_completion.choices[0].message
 
@@ -105,6 +151,38 @@ class ChatApproach(Approach, ABC):
                 return query_text
         return user_query
 
+    def get_search_queries(self, chat_completion: ChatCompletion, user_query: str, query_variants: int) -> list[str]:
+        """Returns up to query_variants distinct search queries, falling back to the user query."""
+        response_message = chat_completion.choices[0].message
+
+        search_queries: list[str] = []
+        if response_message.tool_calls:
+            for tool in response_message.tool_calls:
+                if tool.type != "function" or tool.function.name != "search_sources":
+                    continue
+                arg = json.loads(tool.function.arguments)
+                search_queries += arg.get("search_queries") or [arg.get("search_query", self.NO_RESPONSE)]
+        elif query_text := response_message.content:
+            search_queries = query_text.splitlines()
+
+        distinct_queries: dict[str, str] = {}
+        for search_query in search_queries:
+            search_query = search_query.strip()
+            if search_query and search_query != self.NO_RESPONSE:
+                distinct_queries.setdefault(search_query.casefold(), search_query)
+        return list(distinct_queries.values())[:query_variants] or [user_query]
+
+    @staticmethod
+    def query_terms(query: str) -> set[str]:
+        return set(re.findall(r"\w+", unicodedata.normalize("NFC", query).casefold()))
+
+    def query_overlap(self, search_query: str, user_query: str) -> float:
+        """Returns the share of the words of the search query that also appear in the user query."""
+        search_terms = self.query_terms(search_query)
+        if not search_terms:
+            return 1.0
+        return len(search_terms & self.query_terms(user_query)) / len(search_terms)
+
     def extract_followup_questions(self, content: str):
         return content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
 
@@ -117,19 +195,18 @@ class ChatApproach(Approach, ABC):
         max_tokens: int,
         few_shots=[],
     ) -> list[ChatCompletionMessageParam]:
-        message_builder = MessageBuilder(system_prompt, model_id)
-
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
+        # The system prompt and examples are normalized and counted once, when their prefix is first built
+        prefix = self.prompt_prefixes.get(system_prompt, model_id, few_shots)
+        message_builder = MessageBuilder(prefix, model_id)
 
-        append_index = len(few_shots) + 1
+        append_index = len(prefix.messages)
 
         message_builder.insert_message(self.USER, user_content, index=append_index)
 
-        total_token_count = 0
-        for existing_message in message_builder.messages:
-            total_token_count += message_builder.count_tokens_for_message(existing_message)
+        total_token_count = prefix.token_count + message_builder.count_tokens_for_message(
+            message_builder.messages[append_index]
+        )
 
         newest_to_oldest = list(reversed(history[:-1]))
         for message in newest_to_oldest:
@@ -147,9 +224,10 @@ class ChatApproach(Approach, ABC):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        conversation: Optional[Conversation] = None,
     ) -> dict[str, Any]:
         extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=False
+            history, overrides, auth_claims, should_stream=False, conversation=conversation
         )
         chat_completion_response: ChatCompletion = await chat_coroutine
         chat_resp = chat_completion_response.model_dump()  # Convert to dict to make it JSON serializable
@@ -159,6 +237,8 @@ class ChatApproach(Approach, ABC):
             chat_resp["choices"][0]["message"]["content"] = content
             chat_resp["choices"][0]["context"]["followup_questions"] = followup_questions
         chat_resp["choices"][0]["session_state"] = session_state
+        if conversation:
+            self.save_conversation(session_state, conversation, chat_resp["choices"][0]["message"]["content"] or "")
         return chat_resp
 
     async def run_with_streaming(
@@ -167,16 +247,63 @@ class ChatApproach(Approach, ABC):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        conversation: Optional[Conversation] = None,
     ) -> AsyncGenerator[dict, None]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=True
+        # The thought of each stage is sent as soon as the stage completes, while the next stages run, and the
+        # complete context follows with the data points once the answer is about to be generated
+        thoughts: asyncio.Queue[Optional[ThoughtStep]] = asyncio.Queue()
+        final_call = asyncio.create_task(
+            self.run_until_final_call(
+                history,
+                overrides,
+                auth_claims,
+                should_stream=True,
+                conversation=conversation,
+                thought_listener=thoughts.put_nowait,
+            )
         )
-        yield {
+        final_call.add_done_callback(lambda _: thoughts.put_nowait(None))
+        try:
+            while (thought := await thoughts.get()) is not None:
+                yield self.context_event({"thoughts": [thought]}, session_state=session_state)
+            extra_info, chat_coroutine = await final_call
+        finally:
+            # The client may have gone away before the answer was generated
+            final_call.cancel()
+        yield self.context_event(extra_info, session_state=session_state)
+
+        # Follow-up questions are left out of the answer and sent as soon as each of them is complete
+        followup_parser = FollowupQuestionParser() if overrides.get("suggest_followup_questions") else None
+        followup_questions: list[str] = []
+        answer_content: list[str] = []
+        async for event_chunk in await chat_coroutine:
+            # "2023-07-01-preview" API version has a bug where first response has empty choices
+            if event_chunk.choices:
+                # Only the content of the delta is streamed, so the chunk isn't converted to a dict
+                content = event_chunk.choices[0].delta.content
+                content = content or ""  # content is None in the first and last deltas
+                new_questions: list[str] = []
+                if followup_parser:
+                    content, new_questions = followup_parser.feed(content)
+                if content:
+                    answer_content.append(content)
+                    yield StreamDelta(content)
+                if new_questions:
+                    followup_questions.extend(new_questions)
+                    yield self.followup_questions_event(followup_questions)
+        if followup_parser and (content := followup_parser.close()):
+            answer_content.append(content)
+            yield StreamDelta(content)
+        if conversation:
+            self.save_conversation(session_state, conversation, "".join(answer_content))
+
+    def context_event(self, context: dict[str, Any], **choice_fields: Any) -> dict[str, Any]:
+        return {
             "choices": [
                 {
                     "delta": {"role": self.ASSISTANT},
-                    "context": extra_info,
-                    "session_state": session_state,
+                    "context": context,
+                    **choice_fields,
                     "finish_reason": None,
                     "index": 0,
                 }
@@ -184,39 +311,9 @@ class ChatApproach(Approach, ABC):
             "object": "chat.completion.chunk",
         }
 
-        followup_questions_started = False
-        followup_content = ""
-        async for event_chunk in await chat_coroutine:
-            # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
-                # if event contains << and not >>, it is start of follow-up question, truncate
-                content = event["choices"][0]["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        event["choices"][0]["delta"]["content"] = earlier_content
-                        yield event
-                    followup_content += content[content.index("<<") :]
-                elif followup_questions_started:
-                    followup_content += content
-                else:
-                    yield event
-        if followup_content:
-            _, followup_questions = self.extract_followup_questions(followup_content)
-            yield {
-                "choices": [
-                    {
-                        "delta": {"role": self.ASSISTANT},
-                        "context": {"followup_questions": followup_questions},
-                        "finish_reason": None,
-                        "index": 0,
-                    }
-                ],
-                "object": "chat.completion.chunk",
-            }
+    def followup_questions_event(self, followup_questions: list[str]) -> dict[str, Any]:
+        """An event with all the follow-up questions completed so far, which replace the ones sent before."""
+        return self.context_event({"followup_questions": list(followup_questions)})
 
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
@@ -224,7 +321,24 @@ class ChatApproach(Approach, ABC):
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
 
+        conversation: Optional[Conversation] = None
+        if self.conversation_store:
+            # Only the messages added since the previous turn of the conversation are normalized and counted
+            session_state, conversation = self.conversation_store.resume(
+                session_state, messages, auth_claims.get("oid")
+            )
+            # The older messages may be replaced by their summary
+            messages = conversation.get_history()
+
         if stream is False:
-            return await self.run_without_streaming(messages, overrides, auth_claims, session_state)
+            return await self.run_without_streaming(messages, overrides, auth_claims, session_state, conversation)
         else:
-            return self.run_with_streaming(messages, overrides, auth_claims, session_state)
+            return self.run_with_streaming(messages, overrides, auth_claims, session_state, conversation)
+
+    def save_conversation(self, session_state: str, conversation: Conversation, answer: str):
+        if self.conversation_store:
+            conversation.add_answer(answer)
+            self.conversation_store.save(session_state, conversation)
+            if self.conversation_summarizer:
+                # The summary is refreshed after the answer has been sent, and used from the next turn on
+                self.conversation_summarizer.schedule_refresh(session_state, conversation)
@@ -1,4 +1,16 @@
-from typing import Any, Coroutine, List, Literal, Optional, Union, overload
+import asyncio
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    List,
+    Literal,
+    Optional,
+    Union,
+    overload,
+)
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
@@ -6,13 +18,19 @@ from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
     ChatCompletion,
     ChatCompletionChunk,
+    ChatCompletionMessageParam,
     ChatCompletionToolParam,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
+from approaches.contextcompressor import ContextCompressor
+from approaches.conversationsummarizer import ConversationSummarizer
+from approaches.rewritepolicy import QueryRewriteDecision, QueryRewritePolicy
 from core.authentication import AuthenticationHelper
-from core.modelhelper import get_token_limit
+from core.cache import TTLCache
+from core.conversationstore import Conversation, ConversationStore
+from core.modelhelper import get_token_limit, num_tokens_from_text, pack_sources
 
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -37,6 +55,13 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[TTLCache] = None,
+        search_cache: Optional[TTLCache] = None,
+        retrievable_fields: Optional[List[str]] = None,
+        query_rewrite_policy: Optional[QueryRewritePolicy] = None,
+        context_compressor: Optional[ContextCompressor] = None,
+        conversation_store: Optional[ConversationStore] = None,
+        conversation_summarizer: Optional[ConversationSummarizer] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -50,7 +75,15 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.retrievable_fields = retrievable_fields
+        self.query_rewrite_policy = query_rewrite_policy
+        self.context_compressor = context_compressor
+        self.conversation_store = conversation_store
+        self.conversation_summarizer = conversation_summarizer
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.precompute_prompt_prefixes(chatgpt_model)
 
 
     @property
@@ -63,6 +96,98 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         {injected_prompt}
         """
 
+    def get_query_messages(
+        self, history: list[dict[str, str]], user_query_request: str
+    ) -> list[ChatCompletionMessageParam]:
+        return self.get_messages_from_history(
+            system_prompt=self.query_prompt_template,
+            model_id=self.chatgpt_model,
+            history=history,
+            user_content=user_query_request,
+            max_tokens=self.chatgpt_token_limit - len(user_query_request),
+            few_shots=self.query_prompt_few_shots,
+        )
+
+    async def generate_search_query(
+        self, history: list[dict[str, str]], user_query: str
+    ) -> tuple[list[ChatCompletionMessageParam], str]:
+        user_query_request = "Generate search query for: " + user_query
+
+        tools: List[ChatCompletionToolParam] = [
+            {
+                "type": "function",
+                "function": {
+                    "name": "search_sources",
+                    "description": "Retrieve sources from the Azure AI Search index",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "search_query": {
+                                "type": "string",
+                                "description": "Query string to retrieve documents from azure search eg: 'Contract'",
+                            }
+                        },
+                        "required": ["search_query"],
+                    },
+                },
+            }
+        ]
+
+        query_messages = self.get_query_messages(history, user_query_request)
+
+        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+            messages=query_messages,  # type: ignore
+            # Azure OpenAI takes the deployment name as the model name
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+            temperature=0.0,  # Minimize creativity for search query generation
+            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
+            n=1,
+            tools=tools,
+            tool_choice="auto",
+        )
+        return query_messages, self.get_search_query(chat_completion, user_query)
+
+    async def generate_search_queries(
+        self, history: list[dict[str, str]], user_query: str, query_variants: int
+    ) -> tuple[list[ChatCompletionMessageParam], list[str]]:
+        user_query_request = f"Generate up to {query_variants} different search queries for: " + user_query
+
+        tools: List[ChatCompletionToolParam] = [
+            {
+                "type": "function",
+                "function": {
+                    "name": "search_sources",
+                    "description": "Retrieve sources from the Azure AI Search index, searching for each query",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "search_queries": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": f"Up to {query_variants} query strings, each one using different "
+                                "terms or covering a different aspect of the question eg: ['Contract', 'Agreement']",
+                            }
+                        },
+                        "required": ["search_queries"],
+                    },
+                },
+            }
+        ]
+
+        query_messages = self.get_query_messages(history, user_query_request)
+
+        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+            messages=query_messages,  # type: ignore
+            # Azure OpenAI takes the deployment name as the model name
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+            temperature=0.0,  # Minimize creativity for search query generation
+            max_tokens=100 * query_variants,  # Each variant needs about as many tokens as a single query
+            n=1,
+            tools=tools,
+            tool_choice="auto",
+        )
+        return query_messages, self.get_search_queries(chat_completion, user_query, query_variants)
+
     @overload
     async def run_until_final_call(
         self,
@@ -70,6 +195,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[False],
+        conversation: Optional[Conversation] = None,
+        thought_listener: Optional[Callable[[ThoughtStep], None]] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]: ...
 
     @overload
@@ -79,6 +206,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[True],
+        conversation: Optional[Conversation] = None,
+        thought_listener: Optional[Callable[[ThoughtStep], None]] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]: ...
 
     async def run_until_final_call(
@@ -87,6 +216,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        conversation: Optional[Conversation] = None,
+        thought_listener: Optional[Callable[[ThoughtStep], None]] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -94,80 +225,163 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.01)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 1.5)
+        query_variants = overrides.get("query_variants", 1)
 
         filter = self.build_filter(overrides, auth_claims)
         use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
 
         original_user_query = history[-1]["content"]
-        user_query_request = "Generate search query for: " + original_user_query
+        # The thought of each stage is added as soon as the stage completes, so that it can be streamed right away
+        thoughts: list[ThoughtStep] = []
 
-        tools: List[ChatCompletionToolParam] = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "search_sources",
-                    "description": "Retrieve sources from the Azure AI Search index",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "search_query": {
-                                "type": "string",
-                                "description": "Query string to retrieve documents from azure search eg: 'Contract'",
-                            }
-                        },
-                        "required": ["search_query"],
-                    },
-                },
-            }
-        ]
+        async def retrieve(search_query: str) -> list[Document]:
+            # If retrieval mode includes vectors, compute an embedding for the query
+            vectors: list[VectorQuery] = []
+            if has_vector:
+                vectors.append(
+                    await self.compute_text_embedding(search_query, use_cache=not overrides.get("bypass_cache"))
+                )
 
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        query_messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
+            # Only keep the text query if the retrieval mode uses text, otherwise drop it
+            return await self.search(
+                top,
+                search_query if has_text else None,
+                filter,
+                vectors,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                include_vectors=overrides.get("include_vectors", False),
+                use_cache=not overrides.get("bypass_cache"),
+            )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=query_messages,  # type: ignore
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            tools=tools,
-            tool_choice="auto",
-        )
+        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question,
+        # unless the rewrite policy decides that the question can be searched as is, or the same question was already
+        # asked after the same messages in this conversation, such as when the answer is regenerated
+        previous_turn = conversation.get_turn(len(conversation.messages) - 1) if conversation else None
+        reuse_search_query = previous_turn is not None and previous_turn.query_variants == query_variants == 1
+        rewrite_decision: Optional[QueryRewriteDecision] = None
+        if self.query_rewrite_policy and not overrides.get("always_rewrite_query") and not reuse_search_query:
+            rewrite_decision = self.query_rewrite_policy.decide(history)
+            self.add_thought(
+                thoughts,
+                ThoughtStep(
+                    "Query rewrite policy",
+                    rewrite_decision.reason,
+                    {"rewrite": rewrite_decision.rewrite, **rewrite_decision.props},
+                ),
+                thought_listener,
+            )
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+        query_messages: list[ChatCompletionMessageParam] = []
+        search_queries: list[str] = []
+        results: Optional[list[Document]] = None
+        search_props: dict[str, Any] = {}
+        if previous_turn and reuse_search_query:
+            query_text = previous_turn.search_queries[0]
+            search_props = {"reused_search_query": True}
+        elif rewrite_decision and not rewrite_decision.rewrite:
+            query_text = original_user_query
+        else:
+            # Optionally search for the user question while the search query is generated
+            speculative_search: Optional[asyncio.Task[list[Document]]] = None
+            if overrides.get("speculative_retrieval"):
+                speculative_search = asyncio.create_task(retrieve(original_user_query))
 
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+            try:
+                if query_variants > 1:
+                    query_messages, search_queries = await self.generate_search_queries(
+                        history, original_user_query, query_variants
+                    )
+                    query_text = search_queries[0]
+                else:
+                    query_messages, query_text = await self.generate_search_query(history, original_user_query)
+            except BaseException:
+                if speculative_search:
+                    speculative_search.cancel()
+                raise
+            self.add_thought(
+                thoughts,
+                ThoughtStep(
+                    "Prompt to generate search query",
+                    [str(message) for message in query_messages],
+                    (
+                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
+                        if self.chatgpt_deployment
+                        else {"model": self.chatgpt_model}
+                    ),
+                ),
+                thought_listener,
+            )
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if has_vector:
-            vectors.append(await self.compute_text_embedding(query_text))
-
-        # Only keep the text query if the retrieval mode uses text, otherwise drop it
-        if not has_text:
-            query_text = None
-
-        results = await self.search(
-            top,
-            query_text,
-            filter,
-            vectors,
-            use_semantic_ranker,
-            use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
+            if search_queries:
+                # STEP 2: Search for each query variant concurrently, and fuse the results that arrive within budget.
+                # The speculative search for the user question is fused as one more variant
+                retrieval_budget_ms = overrides.get("retrieval_budget_ms", self.RETRIEVAL_BUDGET_MS)
+                searches: list[Awaitable[list[Document]]] = [retrieve(search_query) for search_query in search_queries]
+                if speculative_search:
+                    searches.append(speculative_search)
+                start = time.perf_counter()
+                result_lists = await self.gather_within_budget(searches, retrieval_budget_ms)
+                completed = [result_list for result_list in result_lists if result_list is not None]
+                results = self.fuse_results(completed, top)
+                search_props = {
+                    "query_variants": len(searches),
+                    "searches_completed": len(completed),
+                    "retrieval_budget_ms": retrieval_budget_ms,
+                    "search_ms": self.elapsed_ms(start),
+                }
+            elif speculative_search:
+                query_overlap = self.query_overlap(query_text, original_user_query)
+                speculative_reused = query_overlap >= self.SPECULATIVE_QUERY_OVERLAP
+                search_props = {"speculative_retrieval": speculative_reused, "query_overlap": round(query_overlap, 2)}
+                if speculative_reused:
+                    query_text = original_user_query
+                    results = await speculative_search
+                else:
+                    speculative_search.cancel()
+
+        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        if results is None:
+            results = await retrieve(query_text)
+        self.add_thought(
+            thoughts,
+            ThoughtStep(
+                "Search using generated search query",
+                (search_queries or query_text) if has_text else None,
+                {
+                    "use_semantic_captions": use_semantic_captions,
+                    "use_semantic_ranker": use_semantic_ranker,
+                    "top": top,
+                    "filter": filter,
+                    "has_vector": has_vector,
+                    **search_props,
+                },
+            ),
+            thought_listener,
+        )
+        self.add_thought(
+            thoughts,
+            ThoughtStep("Search results", [result.serialize_for_results() for result in results]),
+            thought_listener,
         )
 
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
-        content = "\n".join(sources_content)
+        # Optionally keep only the sentences of each source that are relevant to the question. Semantic captions are
+        # already short extracts
+        source_results = results
+        compression_props: dict[str, Any] = {}
+        if self.context_compressor and overrides.get("compress_sources", True) and not use_semantic_captions:
+            source_results, compression_props = self.context_compressor.compress_results(
+                " ".join([original_user_query, *(search_queries or [query_text])]), results, self.chatgpt_model
+            )
+            self.add_thought(
+                thoughts,
+                ThoughtStep("Compress sources", "Kept the sentences relevant to the question", compression_props),
+                thought_listener,
+            )
+
+        sources_content = self.get_sources_content(source_results, use_semantic_captions, use_image_citation=False)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
@@ -179,6 +393,14 @@ class ChatReadRetrieveReadApproach(ChatApproach):
 
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
+        # The sources get a share of the tokens left after the system prompt and the question, and the history fills
+        # the rest, so that long sources can't make the request exceed the context length
+        sources_token_limit = int(
+            (messages_token_limit - num_tokens_from_text(system_message + original_user_query, self.chatgpt_model))
+            * self.SOURCES_TOKEN_SHARE
+        )
+        sources_content, packing_props = pack_sources(sources_content, self.chatgpt_model, sources_token_limit)
+        content = "\n".join(sources_content)
        
         
         messages = self.get_messages_from_history(
@@ -191,45 +413,27 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         )
 
         data_points = {"text": sources_content}
+        if conversation:
+            conversation.record_turn(
+                search_queries or [query_text],
+                query_variants,
+                [result.id for result in results if result.id],
+                self.chatgpt_model,
+            )
 
-        extra_info = {
-            "data_points": data_points,
-            "thoughts": [
-                ThoughtStep(
-                    "Prompt to generate search query",
-                    [str(message) for message in query_messages],
-                    (
-                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
-                        if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
-                    ),
-                ),
-                ThoughtStep(
-                    "Search using generated search query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "top": top,
-                        "filter": filter,
-                        "has_vector": has_vector,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
+        # The last thought is sent with the data points, right before the answer is generated
+        thoughts.append(
+            ThoughtStep(
+                "Prompt to generate answer",
+                [str(message) for message in messages],
+                (
+                    {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment, **packing_props}
+                    if self.chatgpt_deployment
+                    else {"model": self.chatgpt_model, **packing_props}
                 ),
-                ThoughtStep(
-                    "Prompt to generate answer",
-                    [str(message) for message in messages],
-                    (
-                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
-                        if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
-                    ),
-                ),
-            ],
-        }
+            )
+        )
+        extra_info = {"data_points": data_points, "thoughts": thoughts}
 
         chat_coroutine = self.openai_client.chat.completions.create(
             # Azure OpenAI takes the deployment name as the model name
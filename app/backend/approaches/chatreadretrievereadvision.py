@@ -1,6 +1,9 @@
+import time
 from typing import Any, Awaitable, Callable, Coroutine, Optional, Union
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
@@ -12,8 +15,11 @@ from openai.types.chat import (
 
 from approaches.approach import ThoughtStep
 from approaches.chatapproach import ChatApproach
+from approaches.conversationsummarizer import ConversationSummarizer
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.cache import TTLCache
+from core.conversationstore import Conversation, ConversationStore
+from core.imageshelper import fetch_images
 from core.modelhelper import get_token_limit
 
 
@@ -24,6 +30,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
     original user question, and search results to OpenAI to generate a response.
     """
 
+    VECTOR_FIELDS = ["embedding", "imageEmbedding"]
+
     def __init__(
         self,
         *,
@@ -41,7 +49,13 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
-        vision_token_provider: Callable[[], Awaitable[str]]
+        vision_token_provider: Callable[[], Awaitable[str]],
+        embedding_cache: Optional[TTLCache] = None,
+        search_cache: Optional[TTLCache] = None,
+        retrievable_fields: Optional[list[str]] = None,
+        vision_session: Optional[aiohttp.ClientSession] = None,
+        conversation_store: Optional[ConversationStore] = None,
+        conversation_summarizer: Optional[ConversationSummarizer] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -58,7 +72,14 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.retrievable_fields = retrievable_fields
+        self.vision_session = vision_session
+        self.conversation_store = conversation_store
+        self.conversation_summarizer = conversation_summarizer
         self.chatgpt_token_limit = get_token_limit(gpt4v_model)
+        self.precompute_prompt_prefixes(gpt4v_model)
 
     @property
     def system_message_chat_conversation(self):
@@ -77,6 +98,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        conversation: Optional[Conversation] = None,
+        thought_listener: Optional[Callable[[ThoughtStep], None]] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -92,6 +115,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         include_gtpV_images = overrides.get("gpt4v_input") in ["textAndImages", "images", None]
 
         original_user_query = history[-1]["content"]
+        # The thought of each stage is added as soon as the stage completes, so that it can be streamed right away
+        thoughts: list[ThoughtStep] = []
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
         user_query_request = "Generate search query for: " + original_user_query
@@ -114,24 +139,34 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         )
 
         query_text = self.get_search_query(chat_completion, original_user_query)
+        self.add_thought(
+            thoughts,
+            ThoughtStep(
+                "Prompt to generate search query",
+                [str(message) for message in query_messages],
+                (
+                    {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
+                    if self.gpt4v_deployment
+                    else {"model": self.gpt4v_model}
+                ),
+            ),
+            thought_listener,
+        )
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
+        start = time.perf_counter()
+        vectors: list[VectorQuery] = []
         if has_vector:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(query_text)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(query_text)
-                )
-                vectors.append(vector)
+            vectors = await self.compute_vectors(query_text, vector_fields, use_cache=not overrides.get("bypass_cache"))
+        vectors_ms = self.elapsed_ms(start)
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
+        start = time.perf_counter()
         results = await self.search(
             top,
             query_text,
@@ -141,6 +176,26 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             use_semantic_captions,
             minimum_search_score,
             minimum_reranker_score,
+            include_vectors=overrides.get("include_vectors", False),
+            use_cache=not overrides.get("bypass_cache"),
+        )
+        search_ms = self.elapsed_ms(start)
+        self.add_thought(
+            thoughts,
+            ThoughtStep(
+                "Search using generated search query",
+                query_text,
+                {
+                    "use_semantic_captions": use_semantic_captions,
+                    "use_semantic_ranker": use_semantic_ranker,
+                    "top": top,
+                    "filter": filter,
+                    "vector_fields": vector_fields,
+                    "vectors_ms": vectors_ms,
+                    "search_ms": search_ms,
+                },
+            ),
+            thought_listener,
         )
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
         content = "\n".join(sources_content)
@@ -161,12 +216,22 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         if include_gtpV_text:
             user_content.append({"text": "\n\nSources:\n" + content, "type": "text"})
+        start = time.perf_counter()
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
+            for url in await fetch_images(self.blob_container_client, results):
                 if url:
                     image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
+        fetch_images_ms = self.elapsed_ms(start)
+        self.add_thought(
+            thoughts,
+            ThoughtStep(
+                "Search results",
+                [result.serialize_for_results() for result in results],
+                {"fetch_images_ms": fetch_images_ms},
+            ),
+            thought_listener,
+        )
 
         messages = self.get_messages_from_history(
             system_prompt=system_message,
@@ -180,45 +245,24 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             "text": sources_content,
             "images": [d["image_url"] for d in image_list],
         }
+        if conversation:
+            conversation.record_turn(
+                [query_text] if query_text else [], 1, [result.id for result in results if result.id], self.gpt4v_model
+            )
 
-        extra_info = {
-            "data_points": data_points,
-            "thoughts": [
-                ThoughtStep(
-                    "Prompt to generate search query",
-                    [str(message) for message in query_messages],
-                    (
-                        {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
-                        if self.gpt4v_deployment
-                        else {"model": self.gpt4v_model}
-                    ),
+        # The last thought is sent with the data points, right before the answer is generated
+        thoughts.append(
+            ThoughtStep(
+                "Prompt to generate answer",
+                [str(message) for message in messages],
+                (
+                    {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
+                    if self.gpt4v_deployment
+                    else {"model": self.gpt4v_model}
                 ),
-                ThoughtStep(
-                    "Search using generated search query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "top": top,
-                        "filter": filter,
-                        "vector_fields": vector_fields,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
-                ThoughtStep(
-                    "Prompt to generate answer",
-                    [str(message) for message in messages],
-                    (
-                        {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
-                        if self.gpt4v_deployment
-                        else {"model": self.gpt4v_model}
-                    ),
-                ),
-            ],
-        }
+            )
+        )
+        extra_info = {"data_points": data_points, "thoughts": thoughts}
 
         chat_coroutine = self.openai_client.chat.completions.create(
             model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
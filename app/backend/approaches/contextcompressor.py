@@ -0,0 +1,136 @@
+import dataclasses
+import math
+import re
+import time
+import unicodedata
+from collections import Counter
+from typing import Any
+
+from approaches.approach import Approach, Document
+from core.modelhelper import token_count_cache
+
+# Sentences end with a punctuation mark followed by an uppercase letter, so that abbreviations such as "art. 5º" or
+# "nº 8.245" don't split a sentence, or with a line break
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?;])\s+(?=[A-ZÀ-Ý\"'(])|\s*\n+\s*")
+
+# Marks the sentences left out between the kept ones. Square brackets would be taken for a citation
+OMISSION = " … "
+
+
+class ContextCompressor:
+    """
+    Keeps the sentences of each source that are most relevant to the question, along with their neighbours, so that
+    the answer prompt only carries the relevant parts of each chunk. Sentences are scored with BM25, using the
+    sentences of all the retrieved sources as the corpus
+    """
+
+    def __init__(self, max_source_chars: int = 800, neighbours: int = 1, k1: float = 1.5, b: float = 0.75):
+        self.max_source_chars = max_source_chars
+        self.neighbours = neighbours
+        self.k1 = k1
+        self.b = b
+
+    @staticmethod
+    def split_sentences(text: str) -> list[str]:
+        return [sentence for sentence in SENTENCE_BOUNDARY.split(text.strip()) if sentence]
+
+    @staticmethod
+    def terms(text: str) -> list[str]:
+        return re.findall(r"\w+", unicodedata.normalize("NFC", text).casefold())
+
+    def score_sentences(self, query: str, sources: list[list[str]]) -> list[list[float]]:
+        query_terms = set(self.terms(query))
+        sentence_terms = [[Counter(self.terms(sentence)) for sentence in sentences] for sentences in sources]
+        corpus = [terms for source in sentence_terms for terms in source]
+        if not corpus or not query_terms:
+            return [[0.0] * len(sentences) for sentences in sources]
+
+        average_length = sum(sum(terms.values()) for terms in corpus) / len(corpus) or 1
+        document_frequency = Counter(term for terms in corpus for term in terms.keys() & query_terms)
+        idf = {
+            term: math.log((len(corpus) - frequency + 0.5) / (frequency + 0.5) + 1)
+            for term, frequency in document_frequency.items()
+        }
+
+        scores = []
+        for source in sentence_terms:
+            source_scores = []
+            for terms in source:
+                length_norm = self.k1 * (1 - self.b + self.b * sum(terms.values()) / average_length)
+                source_scores.append(
+                    sum(
+                        weight * terms[term] * (self.k1 + 1) / (terms[term] + length_norm)
+                        for term, weight in idf.items()
+                        if term in terms
+                    )
+                )
+            scores.append(source_scores)
+        return scores
+
+    def select_sentences(self, sentences: list[str], scores: list[float]) -> list[int]:
+        selected: set[int] = set()
+        used_chars = 0
+
+        def add(index: int) -> bool:
+            nonlocal used_chars
+            if index in selected:
+                return True
+            if used_chars + len(sentences[index]) > self.max_source_chars:
+                return False
+            selected.add(index)
+            used_chars += len(sentences[index])
+            return True
+
+        matching = [index for index in range(len(sentences)) if scores[index] > 0]
+        # Without any matching sentence, the beginning of the chunk is the best summary of it
+        ranked = sorted(matching, key=lambda index: scores[index], reverse=True) or list(range(len(sentences)))
+        for index in ranked:
+            if not add(index):
+                continue
+            for distance in range(1, self.neighbours + 1):
+                for neighbour in (index - distance, index + distance):
+                    if 0 <= neighbour < len(sentences):
+                        add(neighbour)
+        return sorted(selected)
+
+    def compress(self, query: str, texts: list[str]) -> list[str]:
+        sources = [self.split_sentences(text) for text in texts]
+        scores = self.score_sentences(query, sources)
+        compressed = []
+        for text, sentences, source_scores in zip(texts, sources, scores):
+            if len(text) <= self.max_source_chars:
+                compressed.append(text)
+                continue
+            selected = self.select_sentences(sentences, source_scores)
+            if not selected:
+                # Not even one sentence fits, so keep the beginning of the chunk
+                compressed.append(text[: self.max_source_chars])
+                continue
+            parts = []
+            for position, index in enumerate(selected):
+                if position > 0 and index != selected[position - 1] + 1:
+                    parts.append(OMISSION)
+                elif position > 0:
+                    parts.append(" ")
+                parts.append(sentences[index])
+            compressed.append("".join(parts))
+        return compressed
+
+    def compress_results(
+        self, query: str, results: list[Document], model: str
+    ) -> tuple[list[Document], dict[str, Any]]:
+        """
+        Returns copies of the results with their content compressed, and the tokens saved and time spent to report.
+        The citations are built from the other fields of the results, so they are kept as is
+        """
+        start = time.perf_counter()
+        contents = [result.content or "" for result in results]
+        compressed = self.compress(query, contents)
+        compression_ms = Approach.elapsed_ms(start)
+        # Counted per source through the cache, so the sources that were short enough to keep as is are only
+        # tokenized once
+        return [dataclasses.replace(result, content=content) for result, content in zip(results, compressed)], {
+            "original_tokens": sum(token_count_cache.count(content, model) for content in contents),
+            "compressed_tokens": sum(token_count_cache.count(content, model) for content in compressed),
+            "compression_ms": compression_ms,
+        }
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from typing import Optional
+
+from openai import AsyncOpenAI
+
+from core.conversationstore import Conversation, ConversationStore
+from core.modelhelper import token_count_cache
+
+SUMMARY_PROMPT = """Resuma a conversa abaixo entre um usuário e um assistente jurídico em no máximo {max_words} palavras.
+Mantenha os fatos estabelecidos, os nomes dos documentos citados, os números de processos, os valores e os prazos, e as perguntas do usuário que ainda não foram respondidas.
+Se houver um resumo anterior, incorpore-o ao novo resumo. Responda apenas com o resumo.
+"""
+
+# Heading of the summary when it takes the place of the summarized messages in the prompts
+SUMMARY_HEADING = "Resumo da conversa anterior:\n"
+
+
+class ConversationSummarizer:
+    """
+    Replaces the older messages of long conversations with a running summary, so that the prompts of each turn stay
+    about the same size instead of growing up to the model limit. The summary is refreshed in the background once the
+    answer has been sent, when the messages since the last summary, except the most recent ones, exceed
+    trigger_tokens. It is kept with the conversation in the conversation store, and used from the next turn on
+    """
+
+    def __init__(
+        self,
+        *,
+        openai_client: AsyncOpenAI,
+        chatgpt_model: str,
+        chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
+        conversation_store: ConversationStore,
+        trigger_tokens: int = 1000,
+        keep_recent_messages: int = 4,
+        max_summary_words: int = 200,
+    ):
+        self.openai_client = openai_client
+        self.chatgpt_model = chatgpt_model
+        self.chatgpt_deployment = chatgpt_deployment
+        self.conversation_store = conversation_store
+        self.trigger_tokens = trigger_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.max_summary_words = max_summary_words
+        # The refreshes still running, by session, so that the tasks aren't garbage collected and each session
+        # only has one at a time
+        self.refreshes: dict[str, asyncio.Task] = {}
+
+    def get_summary_end(self, conversation: Conversation) -> Optional[int]:
+        """Returns the index of the first message to keep as is if the messages before it should be summarized."""
+        end = len(conversation.messages) - self.keep_recent_messages
+        # Nothing to summarize when the history is shorter than the recent messages, which makes end negative, or when
+        # the older messages are all in the summary already
+        if end <= conversation.summarized_count:
+            return None
+        older_messages = conversation.messages[conversation.summarized_count : end]
+        older_tokens = sum(
+            token_count_cache.count(message["content"], self.chatgpt_model)
+            for message in older_messages
+            if isinstance(message["content"], str)
+        )
+        return end if older_tokens > self.trigger_tokens else None
+
+    def schedule_refresh(self, session_state: str, conversation: Conversation):
+        """Starts refreshing the summary in the background if the conversation has grown enough since the last one."""
+        if session_state in self.refreshes:
+            return
+        end = self.get_summary_end(conversation)
+        if end is None:
+            return
+        task = asyncio.create_task(self.refresh(session_state, conversation, end))
+        self.refreshes[session_state] = task
+        task.add_done_callback(lambda _: self.refreshes.pop(session_state, None))
+
+    async def summarize(self, previous_summary: Optional[str], messages: list[dict]) -> str:
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        if previous_summary:
+            transcript = f"{previous_summary}\n\n{transcript}"
+        chat_completion = await self.openai_client.chat.completions.create(
+            # Azure OpenAI takes the deployment name as the model name
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT.format(max_words=self.max_summary_words)},
+                {"role": "user", "content": transcript},
+            ],
+            temperature=0.0,
+            # About 2 tokens per word of Portuguese
+            max_tokens=self.max_summary_words * 2,
+            n=1,
+        )
+        return SUMMARY_HEADING + (chat_completion.choices[0].message.content or "").strip()
+
+    async def refresh(self, session_state: str, conversation: Conversation, end: int):
+        try:
+            summary = await self.summarize(
+                conversation.summary, conversation.messages[conversation.summarized_count : end]
+            )
+            # Another turn may have been saved in the meantime, so the summary is added to the latest version of the
+            # conversation, unless its summarized messages have been edited since
+            latest = self.conversation_store.get(session_state)
+            if latest is None or latest.messages[:end] != conversation.messages[:end] or latest.summarized_count >= end:
+                return
+            latest.summary = summary
+            latest.summarized_count = end
+            self.conversation_store.save(session_state, latest)
+        except Exception:
+            logging.exception("Could not summarize the conversation")
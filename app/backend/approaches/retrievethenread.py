@@ -5,8 +5,11 @@ from azure.search.documents.models import VectorQuery
 from openai import AsyncOpenAI
 
 from approaches.approach import Approach, ThoughtStep
+from approaches.contextcompressor import ContextCompressor
 from core.authentication import AuthenticationHelper
-from core.messagebuilder import MessageBuilder
+from core.cache import TTLCache
+from core.messagebuilder import MessageBuilder, PromptPrefixCache
+from core.modelhelper import get_token_limit, num_tokens_from_text, pack_sources
 
 
 class RetrieveThenReadApproach(Approach):
@@ -26,6 +29,8 @@ class RetrieveThenReadApproach(Approach):
         + "Se a pergunta do usuário não esitver em Português, traduza-a para o Português. Forneça as respostas apenas em Português."
     )
 
+    RESPONSE_TOKEN_LIMIT = 1024
+
     # shots/sample conversation
     question = """
         'Qual é o valor médio desses contratos?'
@@ -39,6 +44,8 @@ class RetrieveThenReadApproach(Approach):
 
     answer = "O valor médio dos contratos é de R$ 322.349,99. Isso é calculado adicionando os valores totais (R$ 154.800,00, R$ 469.899,99, R$ 663.500,00, R$ 1.200,00) e dividindo pelo número de contratos (4). Por favor, note que este é um cálculo simplificado e pode não levar em consideração outros fatores que poderiam afetar o valor médio dos contratos. É sempre uma boa ideia consultar um consultor financeiro ou contador para cálculos mais precisos."
 
+    few_shots = [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
     def __init__(
         self,
         *,
@@ -54,6 +61,10 @@ class RetrieveThenReadApproach(Approach):
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[TTLCache] = None,
+        search_cache: Optional[TTLCache] = None,
+        retrievable_fields: Optional[list[str]] = None,
+        context_compressor: Optional[ContextCompressor] = None,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -68,6 +79,14 @@ class RetrieveThenReadApproach(Approach):
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.retrievable_fields = retrievable_fields
+        self.context_compressor = context_compressor
+        self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        # The system prompt and the sample conversation are normalized and counted once, see PromptPrefixCache
+        self.prompt_prefixes = PromptPrefixCache()
+        self.prompt_prefixes.get(self.system_chat_template, chatgpt_model, self.few_shots)
 
     async def run(
         self,
@@ -91,7 +110,7 @@ class RetrieveThenReadApproach(Approach):
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
         if has_vector:
-            vectors.append(await self.compute_text_embedding(q))
+            vectors.append(await self.compute_text_embedding(q, use_cache=not overrides.get("bypass_cache")))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
@@ -105,23 +124,35 @@ class RetrieveThenReadApproach(Approach):
             use_semantic_captions,
             minimum_search_score,
             minimum_reranker_score,
+            include_vectors=overrides.get("include_vectors", False),
+            use_cache=not overrides.get("bypass_cache"),
         )
 
         user_content = [q]
 
         template = overrides.get("prompt_template", self.system_chat_template)
         model = self.chatgpt_model
-        message_builder = MessageBuilder(template, model)
-
-        # Process results
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
+        prefix = self.prompt_prefixes.get(template, model, self.few_shots)
+        message_builder = MessageBuilder(prefix, model)
+
+        # Optionally keep only the sentences of each source that are relevant to the question. Semantic captions are
+        # already short extracts
+        source_results = results
+        compression_props: dict[str, Any] = {}
+        if self.context_compressor and overrides.get("compress_sources", True) and not use_semantic_captions:
+            source_results, compression_props = self.context_compressor.compress_results(q, results, model)
+
+        # Process results, keeping only the sources that fit in the prompt with the response
+        sources_content = self.get_sources_content(source_results, use_semantic_captions, use_image_citation=False)
+        prompt_tokens = prefix.token_count + num_tokens_from_text(q, model)
+        sources_content, packing_props = pack_sources(
+            sources_content, model, self.chatgpt_token_limit - self.RESPONSE_TOKEN_LIMIT - prompt_tokens
+        )
 
         # Append user message
         content = "\n".join(sources_content)
         user_content = q + "\n" + f"Sources:\n {content}"
-        message_builder.insert_message("user", user_content)
-        message_builder.insert_message("assistant", self.answer)
-        message_builder.insert_message("user", self.question)
+        message_builder.insert_message("user", user_content, index=len(prefix.messages))
         updated_messages = message_builder.messages
         chat_completion = (
             await self.openai_client.chat.completions.create(
@@ -129,7 +160,7 @@ class RetrieveThenReadApproach(Approach):
                 model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
                 messages=updated_messages,
                 temperature=overrides.get("temperature", 0.0),
-                max_tokens=1024,
+                max_tokens=self.RESPONSE_TOKEN_LIMIT,
                 n=1,
             )
         ).model_dump()
@@ -153,13 +184,18 @@ class RetrieveThenReadApproach(Approach):
                     "Search results",
                     [result.serialize_for_results() for result in results],
                 ),
+                *(
+                    [ThoughtStep("Compress sources", "Kept the sentences relevant to the question", compression_props)]
+                    if compression_props
+                    else []
+                ),
                 ThoughtStep(
                     "Prompt to generate answer",
                     [str(message) for message in updated_messages],
                     (
-                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
+                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment, **packing_props}
                         if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
+                        else {"model": self.chatgpt_model, **packing_props}
                     ),
                 ),
             ],
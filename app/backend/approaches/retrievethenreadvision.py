@@ -1,6 +1,9 @@
+import time
 from typing import Any, AsyncGenerator, Awaitable, Callable, Optional, Union
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI
 from openai.types.chat import (
@@ -10,8 +13,9 @@ from openai.types.chat import (
 
 from approaches.approach import Approach, ThoughtStep
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
-from core.messagebuilder import MessageBuilder
+from core.cache import TTLCache
+from core.imageshelper import fetch_images
+from core.messagebuilder import MessageBuilder, PromptPrefixCache
 
 
 class RetrieveThenReadVisionApproach(Approach):
@@ -21,6 +25,8 @@ class RetrieveThenReadVisionApproach(Approach):
     (answer) with that prompt.
     """
 
+    VECTOR_FIELDS = ["embedding", "imageEmbedding"]
+
     system_chat_template_gpt4v = (
         "You are an intelligent assistant helping analyze the Annual Financial Report of  Ltd., The documents contain text, graphs, tables and images. "
         + "Each image source has the file name in the top left corner of the image with coordinates (10,10) pixels and is in the format SourceFileName:<file_name> "
@@ -49,7 +55,11 @@ class RetrieveThenReadVisionApproach(Approach):
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
-        vision_token_provider: Callable[[], Awaitable[str]]
+        vision_token_provider: Callable[[], Awaitable[str]],
+        embedding_cache: Optional[TTLCache] = None,
+        search_cache: Optional[TTLCache] = None,
+        retrievable_fields: Optional[list[str]] = None,
+        vision_session: Optional[aiohttp.ClientSession] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -66,6 +76,13 @@ class RetrieveThenReadVisionApproach(Approach):
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.retrievable_fields = retrievable_fields
+        self.vision_session = vision_session
+        # The system prompt is normalized and counted once, see PromptPrefixCache
+        self.prompt_prefixes = PromptPrefixCache()
+        self.prompt_prefixes.get(self.system_chat_template_gpt4v, gpt4v_model)
 
     async def run(
         self,
@@ -92,20 +109,16 @@ class RetrieveThenReadVisionApproach(Approach):
         use_semantic_ranker = overrides.get("semantic_ranker") and has_text
 
         # If retrieval mode includes vectors, compute an embedding for the query
-
-        vectors = []
+        start = time.perf_counter()
+        vectors: list[VectorQuery] = []
         if has_vector:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(q)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(q)
-                )
-                vectors.append(vector)
+            vectors = await self.compute_vectors(q, vector_fields, use_cache=not overrides.get("bypass_cache"))
+        vectors_ms = self.elapsed_ms(start)
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
 
+        start = time.perf_counter()
         results = await self.search(
             top,
             query_text,
@@ -115,14 +128,17 @@ class RetrieveThenReadVisionApproach(Approach):
             use_semantic_captions,
             minimum_search_score,
             minimum_reranker_score,
+            include_vectors=overrides.get("include_vectors", False),
+            use_cache=not overrides.get("bypass_cache"),
         )
+        search_ms = self.elapsed_ms(start)
 
         image_list: list[ChatCompletionContentPartImageParam] = []
         user_content: list[ChatCompletionContentPartParam] = [{"text": q, "type": "text"}]
 
         template = overrides.get("prompt_template", self.system_chat_template_gpt4v)
         model = self.gpt4v_model
-        message_builder = MessageBuilder(template, model)
+        message_builder = MessageBuilder(self.prompt_prefixes.get(template, model), model)
 
         # Process results
 
@@ -131,12 +147,13 @@ class RetrieveThenReadVisionApproach(Approach):
         if include_gtpV_text:
             content = "\n".join(sources_content)
             user_content.append({"text": content, "type": "text"})
+        start = time.perf_counter()
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
+            for url in await fetch_images(self.blob_container_client, results):
                 if url:
                     image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
+        fetch_images_ms = self.elapsed_ms(start)
 
         # Append user message
         message_builder.insert_message("user", user_content)
@@ -168,11 +185,14 @@ class RetrieveThenReadVisionApproach(Approach):
                         "top": top,
                         "filter": filter,
                         "vector_fields": vector_fields,
+                        "vectors_ms": vectors_ms,
+                        "search_ms": search_ms,
                     },
                 ),
                 ThoughtStep(
                     "Search results",
                     [result.serialize_for_results() for result in results],
+                    {"fetch_images_ms": fetch_images_ms},
                 ),
                 ThoughtStep(
                     "Prompt to generate answer",
@@ -0,0 +1,168 @@
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+# Pronouns and references that point back to an earlier message, so the question can't be searched as is
+ANAPHORA_TERMS = {
+    # Portuguese
+    "ele",
+    "ela",
+    "eles",
+    "elas",
+    "dele",
+    "dela",
+    "deles",
+    "delas",
+    "nele",
+    "nela",
+    "lhe",
+    "lhes",
+    "isso",
+    "isto",
+    "aquilo",
+    "disso",
+    "disto",
+    "daquilo",
+    "nisso",
+    "nisto",
+    "esse",
+    "essa",
+    "esses",
+    "essas",
+    "este",
+    "esta",
+    "estes",
+    "estas",
+    "desse",
+    "dessa",
+    "deste",
+    "desta",
+    "nesse",
+    "nessa",
+    "neste",
+    "nesta",
+    "aquele",
+    "aquela",
+    "daquele",
+    "daquela",
+    "mesmo",
+    "mesma",
+    "referido",
+    "referida",
+    "anterior",
+    "acima",
+    # English
+    "it",
+    "its",
+    "this",
+    "that",
+    "these",
+    "those",
+    "they",
+    "them",
+    "their",
+    "he",
+    "she",
+    "him",
+    "her",
+    "previous",
+    "above",
+    "former",
+    "latter",
+}
+
+# Common Portuguese words that are not English words, to tell whether the question is written in Portuguese
+PORTUGUESE_TERMS = {
+    "o",
+    "os",
+    "da",
+    "das",
+    "dos",
+    "de",
+    "e",
+    "é",
+    "que",
+    "qual",
+    "quais",
+    "quem",
+    "como",
+    "quando",
+    "onde",
+    "para",
+    "por",
+    "pelo",
+    "pela",
+    "com",
+    "sem",
+    "um",
+    "uma",
+    "na",
+    "nas",
+    "em",
+    "ao",
+    "aos",
+    "não",
+    "há",
+    "posso",
+    "pode",
+    "deve",
+}
+# Letters that are used in Portuguese but not in English
+PORTUGUESE_LETTERS = re.compile(r"[ãõçáéíóúâêôà]")
+
+
+@dataclass
+class QueryRewriteDecision:
+    rewrite: bool
+    reason: str
+    props: dict[str, Any] = field(default_factory=dict)
+
+
+class QueryRewritePolicy:
+    """
+    Decides for each chat turn whether the search query must be generated by the chat model, or whether the user
+    question can be searched as is, saving a chat completion round trip. The documents are in Portuguese and the
+    rewrite also translates the question, so only questions that look Portuguese are searched as is
+    """
+
+    def __init__(
+        self,
+        max_user_messages: int = 1,
+        min_question_words: int = 3,
+        max_question_words: int = 30,
+        anaphora_terms: Optional[set[str]] = None,
+    ):
+        # By default only the first turn can skip the rewrite, later turns usually need context from the history
+        self.max_user_messages = max_user_messages
+        self.min_question_words = min_question_words
+        # Long questions are condensed into a keyword query, which ranks better than the full text
+        self.max_question_words = max_question_words
+        self.anaphora_terms = ANAPHORA_TERMS if anaphora_terms is None else anaphora_terms
+
+    def decide(self, history: list[dict[str, str]]) -> QueryRewriteDecision:
+        question = history[-1]["content"]
+        words = re.findall(r"\w+", unicodedata.normalize("NFC", question).casefold())
+        user_messages = sum(1 for message in history if message["role"] == "user")
+        anaphora = sorted(set(words) & self.anaphora_terms)
+        portuguese = bool(set(words) & PORTUGUESE_TERMS) or PORTUGUESE_LETTERS.search(" ".join(words)) is not None
+        props = {
+            "user_messages": user_messages,
+            "question_words": len(words),
+            "anaphora": anaphora,
+            "portuguese": portuguese,
+        }
+
+        if user_messages > self.max_user_messages:
+            return QueryRewriteDecision(True, f"Conversation has {user_messages} user messages", props)
+        if len(words) < self.min_question_words:
+            return QueryRewriteDecision(True, f"Question has fewer than {self.min_question_words} words", props)
+        if len(words) > self.max_question_words:
+            return QueryRewriteDecision(True, f"Question has more than {self.max_question_words} words", props)
+        if anaphora:
+            return QueryRewriteDecision(True, f"Question refers to earlier messages: {', '.join(anaphora)}", props)
+        if not portuguese:
+            return QueryRewriteDecision(
+                True, "Question doesn't look Portuguese, it is translated by the rewrite", props
+            )
+        return QueryRewriteDecision(False, "Question is searched as is", props)
@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+from typing import Any, Dict, List, MutableMapping, Union
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.core.exceptions import ResourceNotFoundError
+from azure.identity.aio import AzureDeveloperCliCredential
+from azure.search.documents.models import VectorizedQuery
+
+from prepdocslib.indexprofile import INDEX_PROFILES, IndexProfile
+from prepdocslib.searchmanager import SearchManager
+from prepdocslib.strategy import SearchInfo
+
+logger = logging.getLogger("ingester")
+
+SAMPLE_FIELDS = ["id", "content", "category", "sourcepage", "sourcefile", "embedding"]
+
+
+class IndexProfileComparison:
+    """
+    Copies a sample of documents from an existing search index into one new index per index profile, then reports the
+    size of each index and the latency of vector queries against it
+    """
+
+    def __init__(
+        self,
+        search_service: str,
+        source_index: str,
+        profiles: List[IndexProfile],
+        sample_size: int,
+        query_count: int,
+        keep_indexes: bool,
+        credential: Union[AsyncTokenCredential, AzureKeyCredential],
+    ):
+        self.endpoint = f"https://{search_service}.search.windows.net/"
+        self.source_index = source_index
+        self.profiles = profiles
+        self.sample_size = sample_size
+        self.query_count = query_count
+        self.keep_indexes = keep_indexes
+        self.credential = credential
+
+    def search_info(self, index_name: str) -> SearchInfo:
+        return SearchInfo(endpoint=self.endpoint, credential=self.credential, index_name=index_name)
+
+    async def load_sample(self) -> List[Dict[str, Any]]:
+        async with self.search_info(self.source_index).create_search_client() as search_client:
+            results = await search_client.search(search_text="", select=SAMPLE_FIELDS, top=self.sample_size)
+            documents = [{field: document.get(field) for field in SAMPLE_FIELDS} async for document in results]
+        if not documents or not documents[0].get("embedding"):
+            raise ValueError(
+                f"Index {self.source_index} has no documents with retrievable embeddings to copy, it must use the default profile"
+            )
+        return documents
+
+    async def wait_for_documents(self, search_info: SearchInfo, document_count: int) -> MutableMapping[str, Any]:
+        # Index statistics are refreshed by the service every few minutes at most
+        async with search_info.create_search_index_client() as search_index_client:
+            for _ in range(60):
+                index_statistics = await search_index_client.get_index_statistics(search_info.index_name)
+                if index_statistics["document_count"] >= document_count and index_statistics["vector_index_size"]:
+                    return index_statistics
+                await asyncio.sleep(10)
+        logger.warning("Statistics for %s may not be up to date yet", search_info.index_name)
+        return index_statistics
+
+    async def measure_queries(self, search_info: SearchInfo, documents: List[Dict[str, Any]]) -> List[float]:
+        latencies = []
+        async with search_info.create_search_client() as search_client:
+            for document in documents[: self.query_count]:
+                start = time.perf_counter()
+                results = await search_client.search(
+                    search_text=None,
+                    vector_queries=[
+                        VectorizedQuery(vector=document["embedding"], k_nearest_neighbors=50, fields="embedding")
+                    ],
+                    select=["id"],
+                    top=10,
+                )
+                async for _ in results:
+                    pass
+                latencies.append((time.perf_counter() - start) * 1000)
+        return latencies
+
+    async def compare_profile(self, profile: IndexProfile, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+        search_info = self.search_info(f"{self.source_index}-{profile.name}")
+        async with search_info.create_search_index_client() as search_index_client:
+            try:
+                await search_index_client.delete_index(search_info.index_name)
+            except ResourceNotFoundError:
+                pass
+        search_manager = SearchManager(search_info, index_profile=profile)
+        search_manager.embedding_dimensions = len(documents[0]["embedding"])
+        await search_manager.create_index()
+        logger.info("Copying %d documents into %s", len(documents), search_info.index_name)
+        async with search_info.create_search_client() as search_client:
+            await search_manager.upload_documents(search_client, documents)
+
+        index_statistics = await self.wait_for_documents(search_info, len(documents))
+        latencies = await self.measure_queries(search_info, documents)
+
+        if not self.keep_indexes:
+            async with search_info.create_search_index_client() as search_index_client:
+                await search_index_client.delete_index(search_info.index_name)
+        return {
+            "profile": profile.name,
+            "documents": index_statistics["document_count"],
+            "storage_mb": index_statistics["storage_size"] / 2**20,
+            "vector_index_mb": index_statistics["vector_index_size"] / 2**20,
+            "p50_ms": statistics.median(latencies),
+            "p95_ms": statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0],
+        }
+
+    async def run(self):
+        documents = await self.load_sample()
+        rows = [await self.compare_profile(profile, documents) for profile in self.profiles]
+        print(f"{'profile':<20}{'documents':>10}{'storage MB':>12}{'vector MB':>12}{'p50 ms':>10}{'p95 ms':>10}")
+        for row in rows:
+            print(
+                f"{row['profile']:<20}{row['documents']:>10}{row['storage_mb']:>12.1f}{row['vector_index_mb']:>12.1f}"
+                f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the index size and vector query latency of the search index profiles, using a sample of the documents of an existing index.",
+        epilog="Example: compareindexprofiles.py --searchservice mysearch --index myindex --profiles default scalar",
+    )
+    parser.add_argument(
+        "--searchservice",
+        required=True,
+        help="Name of the Azure AI Search service where the indexes will be created (must exist already)",
+    )
+    parser.add_argument(
+        "--index",
+        required=True,
+        help="Name of an existing Azure AI Search index with retrievable embeddings to sample documents from",
+    )
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        default=list(INDEX_PROFILES),
+        choices=list(INDEX_PROFILES),
+        help="Optional. Index profiles to compare, defaults to all of them",
+    )
+    parser.add_argument(
+        "--samplesize", type=int, default=10000, help="Optional. Number of documents to copy into each index"
+    )
+    parser.add_argument(
+        "--querycount", type=int, default=100, help="Optional. Number of vector queries to time against each index"
+    )
+    parser.add_argument(
+        "--keepindexes", action="store_true", help="Optional. Don't delete the indexes created for the comparison"
+    )
+    parser.add_argument(
+        "--searchkey",
+        required=False,
+        help="Optional. Use this Azure AI Search account key instead of the current user identity to login (use az login to set current user for Azure)",
+    )
+    parser.add_argument(
+        "--tenantid", required=False, help="Optional. Use this to define the Azure directory where to authenticate)"
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(format="%(message)s")
+        logger.setLevel(logging.INFO)
+
+    credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
+        AzureKeyCredential(args.searchkey)
+        if args.searchkey
+        else AzureDeveloperCliCredential(tenant_id=args.tenantid, process_timeout=60)
+    )
+    comparison = IndexProfileComparison(
+        search_service=args.searchservice,
+        source_index=args.index,
+        profiles=[INDEX_PROFILES[name] for name in args.profiles],
+        sample_size=args.samplesize,
+        query_count=args.querycount,
+        keep_indexes=args.keepindexes,
+        credential=credential,
+    )
+    asyncio.run(comparison.run())
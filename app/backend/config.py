@@ -14,3 +14,8 @@ CONFIG_VECTOR_SEARCH_ENABLED = "vector_search_enabled"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
 CONFIG_INGESTER = "ingester"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_VISION_SESSION = "vision_session"
+CONFIG_CONVERSATION_STORE = "conversation_store"
+CONFIG_STREAM_COALESCE_MS = "stream_coalesce_ms"
@@ -0,0 +1,181 @@
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from opentelemetry import metrics
+
+meter = metrics.get_meter("app.cache")
+cache_lookups = meter.create_counter("app.cache.lookups", description="Cache lookups, by cache name and result")
+
+
+class SqliteCacheBackend:
+    """
+    Cache entries stored in a SQLite database file, so that all the worker processes of a host can share them
+    """
+
+    PURGE_INTERVAL = 100
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        # Write-ahead logging lets readers in other processes proceed while an entry is being written
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, generation INTEGER NOT NULL)"
+        )
+        self.writes = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self.connection.execute(
+            "SELECT value FROM cache WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)", (key, value, time.time() + ttl)
+        )
+        self.writes += 1
+        if self.writes % self.PURGE_INTERVAL == 0:
+            self.connection.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+
+    def get_generation(self, name: str) -> int:
+        row = self.connection.execute("SELECT generation FROM generations WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def increment_generation(self, name: str) -> int:
+        self.connection.execute(
+            "INSERT INTO generations (name, generation) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET generation = generation + 1",
+            (name,),
+        )
+        return self.get_generation(name)
+
+    def close(self):
+        self.connection.close()
+
+
+class CacheGeneration:
+    """
+    Counter incremented whenever the data behind a cache changes, so that the entries cached before the change are
+    no longer used. It is kept in the shared backend when there is one, so that other processes see the increments
+    """
+
+    def __init__(self, name: str, shared_backend: Optional[SqliteCacheBackend] = None):
+        self.name = name
+        self.shared_backend = shared_backend
+        self.generation = 0
+
+    def get(self) -> int:
+        if self.shared_backend is not None:
+            try:
+                self.generation = self.shared_backend.get_generation(self.name)
+            except sqlite3.Error:
+                logging.exception("Could not read the %s generation", self.name)
+        return self.generation
+
+    def increment(self) -> int:
+        if self.shared_backend is not None:
+            try:
+                self.generation = self.shared_backend.increment_generation(self.name)
+                return self.generation
+            except sqlite3.Error:
+                logging.exception("Could not increment the %s generation", self.name)
+        self.generation += 1
+        return self.generation
+
+
+class TTLCache:
+    """
+    In-process least recently used cache whose entries expire after ttl seconds, optionally backed by a shared
+    cache so that entries computed by one worker process can be reused by the others
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_size: int = 1000,
+        ttl: float = 3600,
+        shared_backend: Optional[SqliteCacheBackend] = None,
+        generation: Optional[CacheGeneration] = None,
+    ):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared_backend = shared_backend
+        self.generation = generation
+        self.entries: OrderedDict[str, Tuple[float, bytes]] = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def versioned_key(self, key: str) -> str:
+        # Entries cached under an older generation are never looked up again and age out of the cache
+        if self.generation is None:
+            return f"{self.name}:{key}"
+        return f"{self.name}:{self.generation.get()}:{key}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        key = self.versioned_key(key)
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.record_lookup("hit")
+                return value
+            del self.entries[key]
+        if self.shared_backend is not None:
+            try:
+                shared_value = self.shared_backend.get(key)
+            except sqlite3.Error:
+                logging.exception("Could not read from the shared %s cache", self.name)
+                shared_value = None
+            if shared_value is not None:
+                self.set_local(key, shared_value)
+                self.record_lookup("shared_hit")
+                return shared_value
+        self.record_lookup("miss")
+        return None
+
+    def set(self, key: str, value: bytes):
+        key = self.versioned_key(key)
+        self.set_local(key, value)
+        if self.shared_backend is not None:
+            try:
+                self.shared_backend.set(key, value, self.ttl)
+            except sqlite3.Error:
+                logging.exception("Could not write to the shared %s cache", self.name)
+
+    def set_local(self, key: str, value: bytes):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def record_lookup(self, result: str):
+        if result == "hit":
+            self.hits += 1
+        elif result == "shared_hit":
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+        cache_lookups.add(1, {"cache": self.name, "result": result})
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,149 @@
+import dataclasses
+import json
+import unicodedata
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from .cache import SqliteCacheBackend, TTLCache
+from .modelhelper import token_count_cache
+
+
+@dataclass
+class ConversationTurn:
+    """The retrieval done to answer the user message at question_index in the conversation."""
+
+    question_index: int
+    search_queries: list[str]
+    query_variants: int
+    doc_ids: list[str]
+
+
+@dataclass
+class Conversation:
+    """
+    State of a conversation kept on the server between turns: its NFC-normalized messages, the number of tokens in
+    their content for the model that last answered, when they were counted, the retrieval done for each question,
+    and optionally a summary of its first summarized_count messages
+    """
+
+    owner: Optional[str]
+    messages: list[dict[str, Any]] = field(default_factory=list)
+    model: Optional[str] = None
+    token_counts: list[Optional[int]] = field(default_factory=list)
+    turns: list[ConversationTurn] = field(default_factory=list)
+    summary: Optional[str] = None
+    summarized_count: int = 0
+
+    @staticmethod
+    def normalize(message: dict[str, Any]) -> dict[str, Any]:
+        content = message["content"]
+        if isinstance(content, str):
+            content = unicodedata.normalize("NFC", content)
+        return {"role": message["role"], "content": content}
+
+    def update(self, messages: list[dict[str, Any]]) -> int:
+        """
+        Replaces the messages with the ones sent by the client, keeping the stored messages that they start with.
+        Only the messages after those are normalized, and the retrieval of the questions after them is forgotten.
+        Returns the number of messages kept.
+        """
+        kept = 0
+        for stored, message in zip(self.messages, messages):
+            # The client usually sends back the normalized text, so the normalization is only needed on a mismatch
+            if stored["role"] != message["role"] or (
+                stored["content"] != message["content"] and stored != self.normalize(message)
+            ):
+                break
+            kept += 1
+
+        self.messages = self.messages[:kept] + [self.normalize(message) for message in messages[kept:]]
+        self.token_counts = self.token_counts[:kept] + [None] * (len(messages) - kept)
+        self.turns = [turn for turn in self.turns if turn.question_index < kept]
+        if kept < self.summarized_count:
+            # The summary covers messages that have been edited since
+            self.summary = None
+            self.summarized_count = 0
+        if self.model:
+            # Counts stored by another process are added to the token count cache, so they aren't counted again
+            for message, count in zip(self.messages, self.token_counts):
+                if count is not None and isinstance(message["content"], str):
+                    token_count_cache.add(message["content"], self.model, count)
+        return kept
+
+    def get_history(self) -> list[dict[str, Any]]:
+        """Returns the messages to build the prompts from, with the summarized messages replaced by their summary."""
+        if not self.summary:
+            return list(self.messages)
+        return [{"role": "system", "content": self.summary}, *self.messages[self.summarized_count :]]
+
+    def get_turn(self, question_index: int) -> Optional[ConversationTurn]:
+        for turn in self.turns:
+            if turn.question_index == question_index:
+                return turn
+        return None
+
+    def record_turn(self, search_queries: list[str], query_variants: int, doc_ids: list[str], model: str):
+        """Records the retrieval for the last message, and the token counts of the messages counted for the prompt."""
+        question_index = len(self.messages) - 1
+        self.turns = [turn for turn in self.turns if turn.question_index != question_index]
+        self.turns.append(ConversationTurn(question_index, search_queries, query_variants, doc_ids))
+        if model != self.model:
+            self.model = model
+            self.token_counts = [None] * len(self.messages)
+        # Messages left out of the prompt by the history truncation were never counted, and are left uncounted
+        self.token_counts = [
+            (
+                count
+                if count is not None or not isinstance(message["content"], str)
+                else token_count_cache.get(message["content"], model)
+            )
+            for message, count in zip(self.messages, self.token_counts)
+        ]
+
+    def add_answer(self, content: str):
+        self.messages.append({"role": "assistant", "content": unicodedata.normalize("NFC", content)})
+        self.token_counts.append(None)
+
+    def to_json(self) -> bytes:
+        return json.dumps(dataclasses.asdict(self), ensure_ascii=False).encode()
+
+    @classmethod
+    def from_json(cls, value: bytes) -> "Conversation":
+        data = json.loads(value)
+        data["turns"] = [ConversationTurn(**turn) for turn in data["turns"]]
+        return cls(**data)
+
+
+class ConversationStore:
+    """
+    Conversations kept on the server, keyed by the session_state returned to the client, so that a follow-up turn
+    only normalizes and counts the messages added since the previous turn, and can reuse its retrieval.
+    The most recently used conversations are kept in memory, and optionally in a SQLite database shared by the worker
+    processes. Conversations are only resumed for the user that started them.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 86400, shared_backend: Optional[SqliteCacheBackend] = None):
+        self.cache = TTLCache("conversations", max_size=max_size, ttl=ttl, shared_backend=shared_backend)
+
+    def resume(
+        self, session_state: Any, messages: list[dict[str, Any]], owner: Optional[str]
+    ) -> tuple[str, Conversation]:
+        """
+        Returns the session id and the conversation with the messages sent by the client. A new session is started
+        when the session_state doesn't belong to a stored conversation of the same user.
+        """
+        conversation = self.get(session_state) if isinstance(session_state, str) else None
+        if conversation is None or conversation.owner != owner:
+            # Session ids are random, so that they can't be guessed to resume the conversation of another user
+            session_state = uuid.uuid4().hex
+            conversation = Conversation(owner=owner)
+        conversation.update(messages)
+        return session_state, conversation
+
+    def get(self, session_state: str) -> Optional[Conversation]:
+        value = self.cache.get(session_state)
+        return Conversation.from_json(value) if value is not None else None
+
+    def save(self, session_state: str, conversation: Conversation):
+        self.cache.set(session_state, conversation.to_json())
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import logging
 import math
@@ -22,16 +23,29 @@ class ImageURL(TypedDict, total=False):
     """Specifies the detail level of the image."""
 
 
+# Page images can be stored as PNG (the default), JPEG or WebP, see BlobManager in prepdocslib
+PAGE_IMAGE_MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".webp": "image/webp"}
+
+# Number of base64 characters decoded when reading image dimensions from the image header
+IMAGE_HEADER_BASE64_LENGTH = 4096
+
+# Maximum number of page images downloaded at the same time for one answer
+MAX_IMAGE_FETCH_CONCURRENCY = 8
+
+
 async def download_blob_as_base64(blob_container_client: ContainerClient, file_path: str) -> Optional[str]:
-    base_name, _ = os.path.splitext(file_path)
-    image_filename = base_name + ".png"
+    base_name, ext = os.path.splitext(file_path)
+    ext = ext.lower()
+    if ext not in PAGE_IMAGE_MIME_TYPES:
+        ext = ".png"
+    image_filename = base_name + ext
     try:
         blob = await blob_container_client.get_blob_client(image_filename).download_blob()
         if not blob.properties:
             logging.warning(f"No blob exists for {image_filename}")
             return None
         img = base64.b64encode(await blob.readall()).decode("utf-8")
-        return f"data:image/png;base64,{img}"
+        return f"data:{PAGE_IMAGE_MIME_TYPES[ext]};base64,{img}"
     except ResourceNotFoundError:
         logging.warning(f"No blob exists for {image_filename}")
         return None
@@ -47,12 +61,41 @@ async def fetch_image(blob_container_client: ContainerClient, result: Document)
     return None
 
 
+async def fetch_images(
+    blob_container_client: ContainerClient,
+    results: list[Document],
+    max_concurrency: int = MAX_IMAGE_FETCH_CONCURRENCY,
+) -> list[Optional[ImageURL]]:
+    """Fetches the page images of the search results concurrently, returning them in the order of the results."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(result: Document) -> Optional[ImageURL]:
+        async with semaphore:
+            return await fetch_image(blob_container_client, result)
+
+    # Several sections of the same page share its image, so download each page once
+    results_by_page: dict[str, Document] = {}
+    for result in results:
+        if result.sourcepage and result.sourcepage not in results_by_page:
+            results_by_page[result.sourcepage] = result
+    images = await asyncio.gather(*(fetch(result) for result in results_by_page.values()))
+    images_by_page = dict(zip(results_by_page, images))
+    return [images_by_page.get(result.sourcepage) if result.sourcepage else None for result in results]
+
+
 def get_image_dims(image_uri: str) -> tuple[int, int]:
     # From https://github.com/openai/openai-cookbook/pull/881/files
     if re.match(r"data:image\/\w+;base64", image_uri):
-        image_uri = re.sub(r"data:image\/\w+;base64,", "", image_uri)
-        image = Image.open(BytesIO(base64.b64decode(image_uri)))
-        return image.size
+        data_start = image_uri.index(",") + 1
+        # The dimensions live in the image header (PNG IHDR, WebP VP8 chunk, JPEG SOF marker),
+        # so try reading them from a short prefix before falling back to decoding the whole image
+        try:
+            header = base64.b64decode(image_uri[data_start : data_start + IMAGE_HEADER_BASE64_LENGTH])
+            with Image.open(BytesIO(header)) as image:
+                return image.size
+        except Exception:
+            image = Image.open(BytesIO(base64.b64decode(image_uri[data_start:])))
+            return image.size
     else:
         raise ValueError("Image must be a base64 string.")
 
@@ -1,5 +1,7 @@
 import unicodedata
-from collections.abc import Mapping
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass
 from typing import List, Union
 
 from openai.types.chat import (
@@ -12,6 +14,20 @@ from openai.types.chat import (
 
 from .modelhelper import num_tokens_from_messages
 
+# Number of distinct prompt prefixes kept per approach, they only differ with the prompt overrides
+PROMPT_PREFIX_CACHE_SIZE = 32
+
+
+@dataclass(frozen=True)
+class PromptPrefix:
+    """
+    The normalized system message and few-shot examples that start a prompt, with their token count.
+    The messages are shared by every prompt built from the prefix, so they must not be modified.
+    """
+
+    messages: tuple[ChatCompletionMessageParam, ...]
+    token_count: int
+
 
 class MessageBuilder:
     """
@@ -25,10 +41,14 @@ class MessageBuilder:
         insert_message(self, role: str, content: str, index: int = 1): Inserts a new message to the conversation.
     """
 
-    def __init__(self, system_content: str, chatgpt_model: str):
-        self.messages: list[ChatCompletionMessageParam] = [
-            ChatCompletionSystemMessageParam(role="system", content=unicodedata.normalize("NFC", system_content))
-        ]
+    def __init__(self, system_content: Union[str, PromptPrefix], chatgpt_model: str):
+        self.messages: list[ChatCompletionMessageParam]
+        if isinstance(system_content, PromptPrefix):
+            self.messages = list(system_content.messages)
+        else:
+            self.messages = [
+                ChatCompletionSystemMessageParam(role="system", content=unicodedata.normalize("NFC", system_content))
+            ]
         self.model = chatgpt_model
 
     def insert_message(self, role: str, content: Union[str, List[ChatCompletionContentPartParam]], index: int = 1):
@@ -64,3 +84,34 @@ class MessageBuilder:
                 if "image_url" not in part:
                     part["text"] = unicodedata.normalize("NFC", part["text"])
             return content
+
+
+class PromptPrefixCache:
+    """
+    Builds the prompt prefixes of an approach once and keeps the most recently used ones, so that each request only
+    normalizes and counts the tokens of the history and the new question.
+    Reusing the same prefix also keeps the start of the prompt identical across requests, for prompt caching.
+    """
+
+    def __init__(self, max_size: int = PROMPT_PREFIX_CACHE_SIZE):
+        self.max_size = max_size
+        self.prefixes: OrderedDict[tuple, PromptPrefix] = OrderedDict()
+
+    def get(self, system_content: str, model: str, few_shots: Sequence[Mapping[str, str]] = ()) -> PromptPrefix:
+        key = (model, system_content, tuple((shot["role"], shot["content"]) for shot in few_shots))
+        prefix = self.prefixes.get(key)
+        if prefix is not None:
+            self.prefixes.move_to_end(key)
+            return prefix
+
+        message_builder = MessageBuilder(system_content, model)
+        for shot in reversed(few_shots):
+            message_builder.insert_message(shot["role"], shot["content"])
+        prefix = PromptPrefix(
+            messages=tuple(message_builder.messages),
+            token_count=sum(message_builder.count_tokens_for_message(message) for message in message_builder.messages),
+        )
+        self.prefixes[key] = prefix
+        if len(self.prefixes) > self.max_size:
+            self.prefixes.popitem(last=False)
+        return prefix
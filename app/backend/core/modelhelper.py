@@ -1,6 +1,10 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+from collections import OrderedDict
 from collections.abc import Mapping
+from typing import Any
 
 import tiktoken
 
@@ -17,6 +21,12 @@ MODELS_2_TOKEN_LIMITS = {
 }
 
 
+# Sources are only trimmed to fit the prompt if at least this many tokens of them can be kept
+MIN_SOURCE_TOKENS = 100
+
+# Number of distinct message texts whose token counts are kept in memory
+TOKEN_COUNT_CACHE_SIZE = 10000
+
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k", "gpt-4v": "gpt-4-turbo-vision"}
 
 
@@ -26,6 +36,66 @@ def get_token_limit(model_id: str) -> int:
     return MODELS_2_TOKEN_LIMITS[model_id]
 
 
+@functools.lru_cache
+def get_encoding(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+class TokenCountCache:
+    """
+    Least recently used cache of the number of tokens in a text for a model, keyed by a hash of both.
+    The messages of a conversation are sent again on every turn and counted for both the query and the answer prompts,
+    so they are only tokenized the first time they are seen.
+    """
+
+    def __init__(self, max_size: int = TOKEN_COUNT_CACHE_SIZE):
+        self.max_size = max_size
+        self.counts: OrderedDict[bytes, int] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, model: str) -> bytes:
+        # Hashing is much faster than tokenizing, and the texts themselves don't need to be kept
+        return hashlib.blake2b(f"{model}\0{text}".encode(), digest_size=16).digest()
+
+    def count(self, text: str, model: str) -> int:
+        key = self.key(text, model)
+        count = self.counts.get(key)
+        if count is not None:
+            self.counts.move_to_end(key)
+            self.hits += 1
+            return count
+        self.misses += 1
+        count = len(get_encoding(model).encode(text))
+        self.add(text, model, count, key)
+        return count
+
+    def get(self, text: str, model: str) -> int | None:
+        """Returns the count if it is cached, without tokenizing the text."""
+        return self.counts.get(self.key(text, model))
+
+    def add(self, text: str, model: str, count: int, key: bytes | None = None):
+        """Caches a count computed elsewhere, such as by another process."""
+        key = key or self.key(text, model)
+        self.counts[key] = count
+        self.counts.move_to_end(key)
+        if len(self.counts) > self.max_size:
+            self.counts.popitem(last=False)
+
+    def clear(self):
+        self.counts.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+token_count_cache = TokenCountCache()
+
+
+def num_tokens_from_text(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text))
+
+
 def num_tokens_from_messages(message: Mapping[str, object], model: str) -> int:
     """
     Calculate the number of tokens required to encode a message.
@@ -41,24 +111,57 @@ def num_tokens_from_messages(message: Mapping[str, object], model: str) -> int:
         output: 11
     """
 
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
     num_tokens = 2  # For "role" and "content" keys
     for value in message.values():
         if isinstance(value, list):
             # For GPT-4-vision support, based on https://github.com/openai/openai-cookbook/pull/881/files
             for item in value:
-                num_tokens += len(encoding.encode(item["type"]))
+                num_tokens += token_count_cache.count(item["type"], model)
                 if item["type"] == "text":
-                    num_tokens += len(encoding.encode(item["text"]))
+                    num_tokens += token_count_cache.count(item["text"], model)
                 elif item["type"] == "image_url":
                     num_tokens += calculate_image_token_cost(item["image_url"]["url"], item["image_url"]["detail"])
         elif isinstance(value, str):
-            num_tokens += len(encoding.encode(value))
+            num_tokens += token_count_cache.count(value, model)
         else:
             raise ValueError(f"Could not encode unsupported message value type: {type(value)}")
     return num_tokens
 
 
+def pack_sources(
+    sources_content: list[str], model: str, max_tokens: int, min_source_tokens: int = MIN_SOURCE_TOKENS
+) -> tuple[list[str], dict[str, Any]]:
+    """
+    Keeps the sources that fit in max_tokens, in ranking order. The first source that doesn't fit is trimmed to
+    the remaining tokens when at least min_source_tokens are left, and the lower ranked sources after it are dropped.
+    Returns the packed sources and the token usage to report.
+    """
+    encoding = get_encoding(model)
+    packed_sources: list[str] = []
+    used_tokens = 0
+    trimmed = False
+    for source in sources_content:
+        tokens = encoding.encode(source)
+        # One more token for the newline between sources
+        remaining_tokens = max_tokens - used_tokens - 1
+        if len(tokens) <= remaining_tokens:
+            packed_sources.append(source)
+            used_tokens += len(tokens) + 1
+            continue
+        if remaining_tokens >= min_source_tokens:
+            # A multi-byte character split by the cut decodes as a replacement character
+            packed_sources.append(encoding.decode(tokens[:remaining_tokens]).rstrip("\ufffd"))
+            used_tokens += remaining_tokens + 1
+            trimmed = True
+        break
+    return packed_sources, {
+        "sources_tokens": used_tokens,
+        "sources_token_limit": max_tokens,
+        "sources_trimmed": trimmed,
+        "sources_dropped": len(sources_content) - len(packed_sources),
+    }
+
+
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
@@ -0,0 +1,158 @@
+import asyncio
+import contextlib
+import json
+from typing import Any, AsyncGenerator, Optional
+
+from opentelemetry import metrics
+
+meter = metrics.get_meter("app.streaming")
+time_to_first_byte = meter.create_histogram(
+    "app.stream.time_to_first_byte", unit="ms", description="Time from the request to the first event of its stream"
+)
+time_to_first_token = meter.create_histogram(
+    "app.stream.time_to_first_token", unit="ms", description="Time from the request to the first delta of its stream"
+)
+
+# The frame of a delta is written as these around its JSON encoded content, see StreamDelta
+DELTA_FRAME_PREFIX = '{"choices": [{"delta": {"content": '
+DELTA_FRAME_SUFFIX = "}}]}\n"
+
+
+class StreamDelta(dict):
+    """
+    A piece of the content of a streamed answer. It is a chat completion chunk with nothing but the content, so it
+    can be read like the other events of the stream, but only its content needs to be encoded to write it.
+    """
+
+    def __init__(self, content: str):
+        super().__init__(choices=[{"delta": {"content": content}}])
+        self.content = content
+
+    def to_ndjson(self) -> str:
+        return DELTA_FRAME_PREFIX + json.dumps(self.content, ensure_ascii=False) + DELTA_FRAME_SUFFIX
+
+
+async def coalesce_deltas(
+    events: AsyncGenerator[dict[str, Any], None], window: float
+) -> AsyncGenerator[dict[str, Any], None]:
+    """
+    Merges the deltas received within window seconds of the first one into a single delta, so that an answer
+    streamed a token at a time is written in fewer, larger frames. The merged delta is written as soon as the window
+    closes, even if the next event is still being generated, and other events are written right away.
+    """
+    loop = asyncio.get_running_loop()
+    buffer: list[str] = []
+    deadline = 0.0
+    next_event: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(events.__anext__())
+            if buffer:
+                done, _ = await asyncio.wait({next_event}, timeout=max(deadline - loop.time(), 0))
+                if not done:
+                    yield StreamDelta("".join(buffer))
+                    buffer = []
+                    continue
+            try:
+                event = await next_event
+            except StopAsyncIteration:
+                break
+            except Exception:
+                # The deltas received before the error are still written
+                if buffer:
+                    yield StreamDelta("".join(buffer))
+                raise
+            next_event = None
+            if isinstance(event, StreamDelta):
+                if not buffer:
+                    deadline = loop.time() + window
+                buffer.append(event.content)
+                if loop.time() >= deadline:
+                    yield StreamDelta("".join(buffer))
+                    buffer = []
+            else:
+                if buffer:
+                    yield StreamDelta("".join(buffer))
+                    buffer = []
+                yield event
+        if buffer:
+            yield StreamDelta("".join(buffer))
+    finally:
+        if next_event is not None and not next_event.done():
+            next_event.cancel()
+            # The generator can only be closed once the cancelled step has stopped running
+            await asyncio.wait({next_event})
+        # Closing the generator runs its finally blocks, which release the stream it reads from
+        with contextlib.suppress(RuntimeError, StopAsyncIteration):
+            await events.aclose()
+
+
+class FollowupQuestionParser:
+    """
+    Splits a streamed answer into its content and the follow-up questions that end it, written between << and >>,
+    the same way as ChatApproach.extract_followup_questions but a chunk at a time. Markers split across chunks are
+    recognized, each question is returned as soon as its >> arrives, and every chunk is only scanned once.
+    """
+
+    def __init__(self):
+        # Whether the << of the first question has been found, after which nothing is part of the answer
+        self.started = False
+        # Whether the parser is between the << and >> of a question
+        self.in_question = False
+        self.question_parts: list[str] = []
+        # A < or > at the end of the previous chunk, held back as it may be the first half of a marker
+        self.pending = ""
+
+    def feed(self, chunk: str) -> tuple[str, list[str]]:
+        """Returns the content of the answer in the chunk, and the follow-up questions that it completes."""
+        text = self.pending + chunk
+        self.pending = ""
+        if self.started:
+            return "", self.parse_questions(text)
+        start = text.find("<<")
+        if start == -1:
+            if text.endswith("<"):
+                self.pending = "<"
+                return text[:-1], []
+            return text, []
+        self.started = True
+        self.in_question = True
+        return text[:start], self.parse_questions(text, start + 2)
+
+    def close(self) -> str:
+        """Returns the end of the answer held back from the last chunk."""
+        content = "" if self.started else self.pending
+        self.pending = ""
+        return content
+
+    def parse_questions(self, text: str, position: int = 0) -> list[str]:
+        questions = []
+        while position < len(text):
+            if not self.in_question:
+                start = text.find("<<", position)
+                if start == -1:
+                    if text.endswith("<") and len(text) - 1 >= position:
+                        self.pending = "<"
+                    break
+                self.in_question = True
+                position = start + 2
+                continue
+            end = text.find(">", position)
+            if end == -1:
+                self.question_parts.append(text[position:])
+                break
+            self.question_parts.append(text[position:end])
+            if end == len(text) - 1:
+                self.pending = ">"
+                break
+            question = "".join(self.question_parts)
+            self.question_parts = []
+            self.in_question = False
+            # A single > ends the question without completing it, like in extract_followup_questions
+            if text[end + 1] == ">" and question:
+                questions.append(question)
+                position = end + 2
+            else:
+                position = end + 1
+        return questions
@@ -8,6 +8,7 @@ from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential, get_bearer_token_provider
 from azure.keyvault.secrets.aio import SecretClient
 
+from core.cache import CacheGeneration, SqliteCacheBackend
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
@@ -17,6 +18,7 @@ from prepdocslib.embeddings import (
 from prepdocslib.fileprocessor import FileProcessor
 from prepdocslib.filestrategy import FileStrategy
 from prepdocslib.htmlparser import LocalHTMLParser
+from prepdocslib.indexprofile import INDEX_PROFILES, IndexProfile
 from prepdocslib.integratedvectorizerstrategy import (
     IntegratedVectorizerStrategy,
 )
@@ -26,6 +28,7 @@ from prepdocslib.listfilestrategy import (
     ListFileStrategy,
     LocalListFileStrategy,
 )
+from prepdocslib.manifest import IndexManifest
 from prepdocslib.parser import Parser
 from prepdocslib.pdfparser import DocumentAnalysisParser, LocalPdfParser
 from prepdocslib.strategy import DocumentAction, SearchInfo, Strategy
@@ -49,6 +52,7 @@ async def setup_search_info(
     search_key: Union[str, None] = None,
     key_vault_name: Union[str, None] = None,
     search_secret_name: Union[str, None] = None,
+    local_search_path: Union[str, None] = None,
 ) -> SearchInfo:
     if key_vault_name and search_secret_name:
         async with SecretClient(
@@ -64,6 +68,7 @@ async def setup_search_info(
         endpoint=f"https://{search_service}.search.windows.net/",
         credential=search_creds,
         index_name=index_name,
+        local_search_path=local_search_path,
     )
 
 
@@ -75,6 +80,12 @@ def setup_blob_manager(
     subscription_id: str,
     search_images: bool,
     storage_key: Union[str, None] = None,
+    image_format: str = "png",
+    image_quality: int = 85,
+    image_dpi: Union[int, None] = None,
+    image_max_dimension: Union[int, None] = None,
+    upload_concurrency: int = 4,
+    skip_unchanged: bool = False,
 ):
     storage_creds: Union[AsyncTokenCredential, str] = azure_credential if storage_key is None else storage_key
     return BlobManager(
@@ -85,6 +96,23 @@ def setup_blob_manager(
         resourceGroup=storage_resource_group,
         subscriptionId=subscription_id,
         store_page_images=search_images,
+        image_format=image_format,
+        image_quality=image_quality,
+        image_dpi=image_dpi,
+        image_max_dimension=image_max_dimension,
+        max_concurrency=upload_concurrency,
+        skip_unchanged=skip_unchanged,
+    )
+
+
+def setup_index_profile(
+    index_profile: str,
+    hnsw_m: Union[int, None] = None,
+    hnsw_ef_construction: Union[int, None] = None,
+    hnsw_ef_search: Union[int, None] = None,
+) -> IndexProfile:
+    return INDEX_PROFILES[index_profile].with_hnsw_parameters(
+        m=hnsw_m, ef_construction=hnsw_ef_construction, ef_search=hnsw_ef_search
     )
 
 
@@ -286,6 +314,11 @@ if __name__ == "__main__":
         "--index",
         help="Name of the Azure AI Search index where content should be indexed (will be created if it doesn't exist)",
     )
+    parser.add_argument(
+        "--localsearchpath",
+        required=False,
+        help="Optional. Index the content in a local search index stored in this folder instead of Azure AI Search",
+    )
     parser.add_argument(
         "--searchkey",
         required=False,
@@ -373,6 +406,73 @@ if __name__ == "__main__":
         required=False,
         help="Optional, required if --searchimages is specified. Endpoint of Azure AI Vision service to use when embedding images.",
     )
+    parser.add_argument(
+        "--imageformat",
+        required=False,
+        default="png",
+        choices=["png", "jpeg", "webp"],
+        help="Optional. Format used to store page images when --searchimages is specified. JPEG and WebP produce much smaller images than the default PNG",
+    )
+    parser.add_argument(
+        "--imagequality",
+        required=False,
+        default=85,
+        type=int,
+        help="Optional. Encoding quality (1-100) for JPEG and WebP page images",
+    )
+    parser.add_argument(
+        "--imagedpi",
+        required=False,
+        type=int,
+        help="Optional. Resolution used to render page images (defaults to 72 DPI)",
+    )
+    parser.add_argument(
+        "--imagemaxdimension",
+        required=False,
+        type=int,
+        help="Optional. Maximum width or height in pixels of rendered page images, larger pages are scaled down",
+    )
+    parser.add_argument(
+        "--uploadconcurrency",
+        required=False,
+        default=4,
+        type=int,
+        help="Optional. Maximum number of concurrent blob uploads (blocks of a file, or pages of a PDF)",
+    )
+    parser.add_argument(
+        "--skipunchanged",
+        action="store_true",
+        help="Optional. Skip uploading files (and regenerating their page images) whose content matches the blob already in storage",
+    )
+    parser.add_argument(
+        "--manifest",
+        required=False,
+        help="Optional. Path to a local file recording the ids of the sections indexed for each file, used to remove a file's sections without searching for them",
+    )
+    parser.add_argument(
+        "--searchcachepath",
+        required=False,
+        help="Optional. Path to the SQLite file of the app's shared search cache (SEARCH_CACHE_PATH), whose cached results are invalidated once the documents are ingested or removed",
+    )
+    parser.add_argument(
+        "--indexprofile",
+        required=False,
+        default="default",
+        choices=list(INDEX_PROFILES),
+        help="Optional. Vector storage profile used when creating the search index. 'scalar' quantizes the vector index, 'storage-optimized' also doesn't keep retrievable copies of the vectors",
+    )
+    parser.add_argument(
+        "--hnswm", required=False, type=int, help="Optional. HNSW bi-directional link count (m) for new search indexes"
+    )
+    parser.add_argument(
+        "--hnswefconstruction",
+        required=False,
+        type=int,
+        help="Optional. HNSW efConstruction for new search indexes",
+    )
+    parser.add_argument(
+        "--hnswefsearch", required=False, type=int, help="Optional. HNSW efSearch for new search indexes"
+    )
     parser.add_argument(
         "--keyvaultname",
         required=False,
@@ -393,6 +493,8 @@ if __name__ == "__main__":
         logger.setLevel(logging.INFO)
 
     use_int_vectorization = args.useintvectorization and args.useintvectorization.lower() == "true"
+    if use_int_vectorization and args.localsearchpath:
+        raise ValueError("Integrated vectorization can't be used with a local search index")
 
     # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
     azd_credential = (
@@ -419,6 +521,7 @@ if __name__ == "__main__":
             search_key=clean_key_if_exists(args.searchkey),
             key_vault_name=args.keyvaultname,
             search_secret_name=args.searchsecretname,
+            local_search_path=args.localsearchpath,
         )
     )
     blob_manager = setup_blob_manager(
@@ -429,6 +532,12 @@ if __name__ == "__main__":
         subscription_id=args.subscriptionid,
         search_images=args.searchimages,
         storage_key=clean_key_if_exists(args.storagekey),
+        image_format=args.imageformat,
+        image_quality=args.imagequality,
+        image_dpi=args.imagedpi,
+        image_max_dimension=args.imagemaxdimension,
+        upload_concurrency=args.uploadconcurrency,
+        skip_unchanged=args.skipunchanged,
     )
     list_file_strategy = setup_list_file_strategy(
         azure_credential=azd_credential,
@@ -451,6 +560,13 @@ if __name__ == "__main__":
         disable_batch_vectors=args.disablebatchvectors,
     )
 
+    index_profile = setup_index_profile(
+        index_profile=args.indexprofile,
+        hnsw_m=args.hnswm,
+        hnsw_ef_construction=args.hnswefconstruction,
+        hnsw_ef_search=args.hnswefsearch,
+    )
+
     ingestion_strategy: Strategy
     if use_int_vectorization:
         ingestion_strategy = IntegratedVectorizerStrategy(
@@ -464,6 +580,7 @@ if __name__ == "__main__":
             search_analyzer_name=args.searchanalyzername,
             use_acls=args.useacls,
             category=args.category,
+            index_profile=index_profile,
         )
     else:
         file_processors = setup_file_processors(
@@ -489,7 +606,18 @@ if __name__ == "__main__":
             search_analyzer_name=args.searchanalyzername,
             use_acls=args.useacls,
             category=args.category,
+            manifest=IndexManifest(args.manifest) if args.manifest else None,
+            index_profile=index_profile,
         )
 
-    loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
-    loop.close()
+    try:
+        loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
+    finally:
+        # Even a run that failed part way may have changed the index
+        if args.searchcachepath:
+            search_cache_backend = SqliteCacheBackend(args.searchcachepath)
+            generation = CacheGeneration("search", shared_backend=search_cache_backend).increment()
+            search_cache_backend.close()
+            logger.info("Search cache generation is now %d", generation)
+        loop.run_until_complete(blob_manager.close())
+        loop.close()
@@ -1,31 +1,60 @@
+import asyncio
 import datetime
+import hashlib
 import io
 import logging
 import os
 import re
-from typing import List, Optional, Union
+from typing import Callable, List, Optional, Union
 
+import aiohttp
 import fitz  # type: ignore
 from azure.core.credentials_async import AsyncTokenCredential
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.storage.blob import (
+    BlobProperties,
     BlobSasPermissions,
+    ContentSettings,
     UserDelegationKey,
     generate_blob_sas,
 )
-from azure.storage.blob.aio import BlobServiceClient, ContainerClient
+from azure.storage.blob.aio import BlobClient, BlobServiceClient, ContainerClient
 from PIL import Image, ImageDraw, ImageFont
-from pypdf import PdfReader
 
 from .listfilestrategy import File
 
 logger = logging.getLogger("ingester")
 
 
+class PageImage:
+    """
+    A page of a document rendered as an image and stored in blob storage, along with the dimensions it was encoded at.
+    The url is None when no SAS URL can be generated for the blob, such as when the account name is unknown.
+    """
+
+    def __init__(self, blob_name: str, url: Optional[str], width: int, height: int):
+        self.blob_name = blob_name
+        self.url = url
+        self.width = width
+        self.height = height
+
+
 class BlobManager:
     """
     Class to manage uploading and deleting blobs containing citation information from a blob storage account
     """
 
+    # Page image formats, mapped to their PIL format name, blob name extension and content type
+    IMAGE_FORMATS = {
+        "png": ("PNG", ".png", "image/png"),
+        "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+        "webp": ("WEBP", ".webp", "image/webp"),
+    }
+
+    # Maximum number of subrequests the Blob batch API accepts in a single request
+    DELETE_BATCH_SIZE = 256
+
     def __init__(
         self,
         endpoint: str,
@@ -35,50 +64,195 @@ class BlobManager:
         resourceGroup: str,
         subscriptionId: str,
         store_page_images: bool = False,
+        image_format: str = "png",
+        image_quality: int = 85,
+        image_dpi: Optional[int] = None,
+        image_max_dimension: Optional[int] = None,
+        max_concurrency: int = 4,
+        max_single_put_size: int = 4 * 1024 * 1024,
+        max_block_size: int = 4 * 1024 * 1024,
+        connection_pool_size: int = 16,
+        skip_unchanged: bool = False,
     ):
+        if image_format not in BlobManager.IMAGE_FORMATS:
+            raise ValueError(
+                f"Unsupported page image format {image_format}, expected one of {', '.join(BlobManager.IMAGE_FORMATS)}"
+            )
         self.endpoint = endpoint
         self.credential = credential
         self.account = account
         self.container = container
         self.store_page_images = store_page_images
+        self.image_format = image_format
+        self.image_quality = image_quality
+        self.image_dpi = image_dpi
+        self.image_max_dimension = image_max_dimension
         self.resourceGroup = resourceGroup
         self.subscriptionId = subscriptionId
         self.user_delegation_key: Optional[UserDelegationKey] = None
+        self.max_concurrency = max_concurrency
+        self.max_single_put_size = max_single_put_size
+        self.max_block_size = max_block_size
+        self.connection_pool_size = connection_pool_size
+        self.service_client: Optional[BlobServiceClient] = None
+        self.container_client: Optional[ContainerClient] = None
+        self.container_exists: Optional[bool] = None
+        self.container_lock = asyncio.Lock()
+        self.skip_unchanged = skip_unchanged
+        self.skipped_blobs = 0
+        self.skipped_bytes = 0
 
-    async def upload_blob(self, file: File) -> Optional[List[str]]:
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential, max_single_put_size=4 * 1024 * 1024
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
-            if not await container_client.exists():
+    def get_container_client(self) -> ContainerClient:
+        """
+        Returns the container client shared by all operations of this manager, creating the underlying
+        service client and its connection pool on first use
+        """
+        if self.container_client is None:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connection_pool_size))
+            self.service_client = BlobServiceClient(
+                account_url=self.endpoint,
+                credential=self.credential,
+                transport=AioHttpTransport(session=session, session_owner=True),
+                max_single_put_size=self.max_single_put_size,
+                max_block_size=self.max_block_size,
+            )
+            self.container_client = self.service_client.get_container_client(self.container)
+        return self.container_client
+
+    async def ensure_container(self, create: bool = True) -> bool:
+        """
+        Checks whether the container exists, and creates it if requested, only calling the service the first time
+        """
+        container_client = self.get_container_client()
+        async with self.container_lock:
+            if self.container_exists is None:
+                self.container_exists = await container_client.exists()
+            if not self.container_exists and create:
                 await container_client.create_container()
+                self.container_exists = True
+        return self.container_exists
+
+    async def close(self):
+        if self.container_client is not None:
+            await self.container_client.close()
+            self.container_client = None
+        if self.service_client is not None:
+            await self.service_client.close()
+            self.service_client = None
+        self.container_exists = None
+
+    async def get_blob_properties(self, blob_name: str) -> Optional[BlobProperties]:
+        try:
+            return await self.get_container_client().get_blob_client(blob_name).get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+
+    def record_skipped_blob(self, blob_name: str, size: int):
+        logger.info("Skipping upload of unchanged blob %s", blob_name)
+        self.skipped_blobs += 1
+        self.skipped_bytes += size
+
+    def log_skipped_uploads(self):
+        if self.skip_unchanged:
+            logger.info(
+                "Skipped %d unchanged blobs, saving %.1f MB of uploads", self.skipped_blobs, self.skipped_bytes / 2**20
+            )
 
+    async def upload_blob(self, file: File) -> Optional[List[PageImage]]:
+        container_client = self.get_container_client()
+        await self.ensure_container()
+
+        blob_name = BlobManager.blob_name_from_file_name(file.content.name)
+        source_md5: Optional[str] = None
+        properties: Optional[BlobProperties] = None
+        if self.skip_unchanged:
+            source_md5 = BlobManager.file_md5(file.content.name)
+            properties = await self.get_blob_properties(blob_name)
+        if source_md5 is not None and properties is not None and BlobManager.blob_md5(properties) == source_md5:
+            self.record_skipped_blob(blob_name, properties.size)
+        else:
             # Re-open and upload the original file
             with open(file.content.name, "rb") as reopened_file:
-                blob_name = BlobManager.blob_name_from_file_name(file.content.name)
                 logger.info("Uploading blob for whole file -> %s", blob_name)
-                await container_client.upload_blob(blob_name, reopened_file, overwrite=True)
+                await container_client.upload_blob(
+                    blob_name,
+                    reopened_file,
+                    overwrite=True,
+                    max_concurrency=self.max_concurrency,
+                    metadata={"md5": source_md5} if source_md5 else None,
+                )
 
-            if self.store_page_images:
-                if os.path.splitext(file.content.name)[1].lower() == ".pdf":
-                    return await self.upload_pdf_blob_images(service_client, container_client, file)
-                else:
-                    logger.info("File %s is not a PDF, skipping image upload", file.content.name)
+        if self.store_page_images:
+            if os.path.splitext(file.content.name)[1].lower() == ".pdf":
+                return await self.upload_pdf_blob_images(file, source_md5)
+            else:
+                logger.info("File %s is not a PDF, skipping image upload", file.content.name)
 
         return None
 
     def get_managedidentity_connectionstring(self):
         return f"ResourceId=/subscriptions/{self.subscriptionId}/resourceGroups/{self.resourceGroup}/providers/Microsoft.Storage/storageAccounts/{self.account};"
 
-    async def upload_pdf_blob_images(
-        self, service_client: BlobServiceClient, container_client: ContainerClient, file: File
-    ) -> List[str]:
-        with open(file.content.name, "rb") as reopened_file:
-            reader = PdfReader(reopened_file)
-            page_count = len(reader.pages)
+    def render_page(self, page: fitz.Page) -> Image.Image:
+        """
+        Renders a PDF page at the configured DPI, scaled down if needed so that neither side exceeds image_max_dimension
+        """
+        # PDF user space is 72 points per inch, which is also what get_pixmap() renders at by default
+        zoom = (self.image_dpi or 72) / 72
+        if self.image_max_dimension:
+            longest_side = max(page.rect.width, page.rect.height) * zoom
+            if longest_side > self.image_max_dimension:
+                zoom *= self.image_max_dimension / longest_side
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+    def encode_image(self, image: Image.Image) -> io.BytesIO:
+        pil_format, _, _ = BlobManager.IMAGE_FORMATS[self.image_format]
+        output = io.BytesIO()
+        if pil_format == "PNG":
+            image.save(output, format=pil_format)
+        else:
+            # Lossy formats trade some fidelity for much smaller blobs and base64 payloads sent to GPT-4V
+            image.save(output, format=pil_format, quality=self.image_quality)
+        output.seek(0)
+        return output
+
+    def image_settings(self) -> str:
+        """
+        Identifies the settings page images are rendered with, so that images rendered differently are not reused
+        """
+        return f"{self.image_format}:{self.image_quality}:{self.image_dpi or 72}:{self.image_max_dimension or 0}"
+
+    async def get_unchanged_page_image(
+        self, blob_name: str, source_md5: str, start_time: datetime.datetime, expiry_time: datetime.datetime
+    ) -> Optional[PageImage]:
+        """
+        Returns the existing page image if it was rendered from the same source file with the same settings
+        """
+        properties = await self.get_blob_properties(blob_name)
+        if (
+            properties is None
+            or properties.metadata.get("source_md5") != source_md5
+            or properties.metadata.get("image_settings") != self.image_settings()
+        ):
+            return None
+        self.record_skipped_blob(blob_name, properties.size)
+        return self.page_image_from_blob_client(
+            self.get_container_client().get_blob_client(blob_name),
+            int(properties.metadata["width"]),
+            int(properties.metadata["height"]),
+            start_time,
+            expiry_time,
+        )
+
+    async def upload_pdf_blob_images(self, file: File, source_md5: Optional[str] = None) -> List[PageImage]:
+        container_client = self.get_container_client()
         doc = fitz.open(file.content.name)
-        sas_uris = []
         start_time = datetime.datetime.now(datetime.timezone.utc)
         expiry_time = start_time + datetime.timedelta(days=1)
+        _, _, content_type = BlobManager.IMAGE_FORMATS[self.image_format]
+        if not self.user_delegation_key and self.service_client is not None:
+            self.user_delegation_key = await self.service_client.get_user_delegation_key(start_time, expiry_time)
 
         font = None
         try:
@@ -89,76 +263,170 @@ class BlobManager:
             except OSError:
                 logger.info("Unable to find arial.ttf or FreeMono.ttf, using default font")
 
-        for i in range(page_count):
-            blob_name = BlobManager.blob_image_name_from_file_page(file.content.name, i)
-            logger.info("Converting page %s to image and uploading -> %s", i, blob_name)
-
-            doc = fitz.open(file.content.name)
-            page = doc.load_page(i)
-            pix = page.get_pixmap()
-            original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
-
-            # Create a new image with additional space for text
-            text_height = 40  # Height of the text area
-            new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
-
-            # Paste the original image onto the new image
-            new_img.paste(original_img, (0, text_height))
-
-            # Draw the text on the white area
-            draw = ImageDraw.Draw(new_img)
-            text = f"SourceFileName:{blob_name}"
-
-            # 10 pixels from the top and left of the image
-            x = 10
-            y = 10
-            draw.text((x, y), text, font=font, fill="black")
-
-            output = io.BytesIO()
-            new_img.save(output, format="PNG")
-            output.seek(0)
-
-            blob_client = await container_client.upload_blob(blob_name, output, overwrite=True)
-            if not self.user_delegation_key:
-                self.user_delegation_key = await service_client.get_user_delegation_key(start_time, expiry_time)
-
-            if blob_client.account_name is not None:
-                sas_token = generate_blob_sas(
-                    account_name=blob_client.account_name,
-                    container_name=blob_client.container_name,
-                    blob_name=blob_client.blob_name,
-                    user_delegation_key=self.user_delegation_key,
-                    permission=BlobSasPermissions(read=True),
-                    expiry=expiry_time,
-                    start=start_time,
+        # Bounds both the number of uploads in flight and the number of encoded pages held in memory
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def upload_page(i: int) -> PageImage:
+            async with semaphore:
+                blob_name = BlobManager.blob_image_name_from_file_page(file.content.name, i, self.image_format)
+                if source_md5 is not None:
+                    page_image = await self.get_unchanged_page_image(blob_name, source_md5, start_time, expiry_time)
+                    if page_image is not None:
+                        return page_image
+                logger.info("Converting page %s to image and uploading -> %s", i, blob_name)
+
+                original_img = self.render_page(doc.load_page(i))
+
+                # Create a new image with additional space for text
+                text_height = 40  # Height of the text area
+                new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
+
+                # Paste the original image onto the new image
+                new_img.paste(original_img, (0, text_height))
+
+                # Draw the text on the white area
+                draw = ImageDraw.Draw(new_img)
+                text = f"SourceFileName:{blob_name}"
+
+                # 10 pixels from the top and left of the image
+                x = 10
+                y = 10
+                draw.text((x, y), text, font=font, fill="black")
+
+                output = self.encode_image(new_img)
+
+                metadata = None
+                if source_md5 is not None:
+                    metadata = {
+                        "source_md5": source_md5,
+                        "image_settings": self.image_settings(),
+                        "width": str(new_img.width),
+                        "height": str(new_img.height),
+                    }
+                blob_client = await container_client.upload_blob(
+                    blob_name,
+                    output,
+                    overwrite=True,
+                    content_settings=ContentSettings(content_type=content_type),
+                    metadata=metadata,
                 )
-                sas_uris.append(f"{blob_client.url}?{sas_token}")
 
-        return sas_uris
+            return self.page_image_from_blob_client(blob_client, new_img.width, new_img.height, start_time, expiry_time)
+
+        try:
+            results = await asyncio.gather(*(upload_page(i) for i in range(doc.page_count)))
+        finally:
+            doc.close()
+
+        # One image per page, so that they can be looked up by page number
+        return list(results)
+
+    def page_image_from_blob_client(
+        self,
+        blob_client: BlobClient,
+        width: int,
+        height: int,
+        start_time: datetime.datetime,
+        expiry_time: datetime.datetime,
+    ) -> PageImage:
+        if blob_client.account_name is None:
+            return PageImage(blob_name=blob_client.blob_name, url=None, width=width, height=height)
+        sas_token = generate_blob_sas(
+            account_name=blob_client.account_name,
+            container_name=blob_client.container_name,
+            blob_name=blob_client.blob_name,
+            user_delegation_key=self.user_delegation_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=expiry_time,
+            start=start_time,
+        )
+        return PageImage(
+            blob_name=blob_client.blob_name, url=f"{blob_client.url}?{sas_token}", width=width, height=height
+        )
 
     async def remove_blob(self, path: Optional[str] = None):
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
-            if not await container_client.exists():
-                return
-            if path is None:
-                prefix = None
-                blobs = container_client.list_blob_names()
-            else:
-                prefix = os.path.splitext(os.path.basename(path))[0]
-                blobs = container_client.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0])
-            async for blob_path in blobs:
-                # This still supports PDFs split into individual pages, but we could remove in future to simplify code
-                if (
-                    prefix is not None
-                    and (
-                        not re.match(rf"{prefix}-\d+\.pdf", blob_path) or not re.match(rf"{prefix}-\d+\.png", blob_path)
-                    )
-                ) or (path is not None and blob_path == os.path.basename(path)):
-                    continue
-                logger.info("Removing blob %s", blob_path)
-                await container_client.delete_blob(blob_path)
+        container_client = self.get_container_client()
+        if not await self.ensure_container(create=False):
+            return
+        if path is None:
+            blobs = container_client.list_blob_names()
+            is_blob_of_path = None
+        else:
+            prefix = os.path.splitext(os.path.basename(path))[0]
+            blobs = container_client.list_blob_names(name_starts_with=prefix)
+            is_blob_of_path = BlobManager.blob_names_matcher(path)
+
+        # Deletes go out in batches, a few batches at a time, as names are listed
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        tasks: List[asyncio.Task] = []
+        progress = {"removed": 0, "failed": 0}
+
+        async def delete_batch(batch: List[str]):
+            try:
+                responses = await container_client.delete_blobs(*batch, raise_on_any_failure=False)
+                async for response in responses:
+                    # Blobs that are already gone are not worth reporting as failures
+                    if response.status_code in (202, 404):
+                        progress["removed"] += 1
+                    else:
+                        progress["failed"] += 1
+                        logger.warning("Failed to remove blob, status %s", response.status_code)
+                logger.info("Removed %d blobs so far", progress["removed"])
+            finally:
+                semaphore.release()
+
+        batch: List[str] = []
+        async for blob_path in blobs:
+            if is_blob_of_path is not None and not is_blob_of_path(blob_path):
+                continue
+            batch.append(blob_path)
+            if len(batch) == BlobManager.DELETE_BATCH_SIZE:
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(delete_batch(batch)))
+                batch = []
+        if batch:
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(delete_batch(batch)))
+        await asyncio.gather(*tasks)
+
+        if progress["removed"] or progress["failed"]:
+            logger.info(
+                "Removed %d blobs%s",
+                progress["removed"],
+                f", {progress['failed']} failed" if progress["failed"] else "",
+            )
+
+    @classmethod
+    def blob_names_matcher(cls, path: str) -> Callable[[str], bool]:
+        """
+        Returns a predicate matching exactly the blobs stored for a file: the file itself, its page images in any
+        supported format, and the individual page PDFs written by earlier versions of this script
+        """
+        filename = os.path.basename(path)
+        prefix = os.path.splitext(filename)[0]
+        extensions = "|".join(re.escape(extension) for _, extension, _ in cls.IMAGE_FORMATS.values())
+        page_pattern = re.compile(rf"{re.escape(prefix)}-\d+(?:\.pdf|{extensions})")
+        return lambda blob_name: blob_name == filename or page_pattern.fullmatch(blob_name) is not None
+
+    @classmethod
+    def file_md5(cls, path: str) -> str:
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(4 * 1024 * 1024), b""):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    @classmethod
+    def blob_md5(cls, properties: BlobProperties) -> Optional[str]:
+        """
+        Returns the hex MD5 of a blob's content, preferring the value recorded in its metadata on upload, since the
+        service only computes content_md5 itself for blobs uploaded in a single request
+        """
+        if properties.metadata and "md5" in properties.metadata:
+            return properties.metadata["md5"]
+        if properties.content_settings.content_md5:
+            return bytes(properties.content_settings.content_md5).hex()
+        return None
 
     @classmethod
     def sourcepage_from_file_page(cls, filename, page=0) -> str:
@@ -168,8 +436,9 @@ class BlobManager:
             return os.path.basename(filename)
 
     @classmethod
-    def blob_image_name_from_file_page(cls, filename, page=0) -> str:
-        return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + ".png"
+    def blob_image_name_from_file_page(cls, filename, page=0, image_format="png") -> str:
+        _, extension, _ = cls.IMAGE_FORMATS[image_format]
+        return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + extension
 
     @classmethod
     def blob_name_from_file_name(cls, filename) -> str:
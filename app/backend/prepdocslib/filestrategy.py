@@ -1,10 +1,12 @@
 import logging
-from typing import List, Optional
+from typing import Callable, List, Optional
 
 from .blobmanager import BlobManager
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
 from .fileprocessor import FileProcessor
+from .indexprofile import IndexProfile
 from .listfilestrategy import File, ListFileStrategy
+from .manifest import IndexManifest
 from .searchmanager import SearchManager, Section
 from .strategy import DocumentAction, SearchInfo, Strategy
 
@@ -50,6 +52,8 @@ class FileStrategy(Strategy):
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         category: Optional[str] = None,
+        manifest: Optional[IndexManifest] = None,
+        index_profile: Optional[IndexProfile] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -61,6 +65,8 @@ class FileStrategy(Strategy):
         self.search_info = search_info
         self.use_acls = use_acls
         self.category = category
+        self.manifest = manifest
+        self.index_profile = index_profile
 
     async def setup(self):
         search_manager = SearchManager(
@@ -70,12 +76,13 @@ class FileStrategy(Strategy):
             False,
             self.embeddings,
             search_images=self.image_embeddings is not None,
+            index_profile=self.index_profile,
         )
         await search_manager.create_index()
 
     async def run(self):
         search_manager = SearchManager(
-            self.search_info, self.search_analyzer_name, self.use_acls, False, self.embeddings
+            self.search_info, self.search_analyzer_name, self.use_acls, False, self.embeddings, manifest=self.manifest
         )
         if self.document_action == DocumentAction.Add:
             files = self.list_file_strategy.list()
@@ -83,14 +90,27 @@ class FileStrategy(Strategy):
                 try:
                     sections = await parse_file(file, self.file_processors, self.category, self.image_embeddings)
                     if sections:
-                        blob_sas_uris = await self.blob_manager.upload_blob(file)
-                        blob_image_embeddings: Optional[List[List[float]]] = None
-                        if self.image_embeddings and blob_sas_uris:
-                            blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
-                        await search_manager.update_content(sections, blob_image_embeddings)
+                        page_images = await self.blob_manager.upload_blob(file)
+                        blob_image_embeddings: Optional[List[Optional[List[float]]]] = None
+                        if self.image_embeddings and page_images:
+                            # Only the pages with a URL can be embedded, the others keep their slot empty
+                            pages = [(i, page_image.url) for i, page_image in enumerate(page_images) if page_image.url]
+                            embeddings = (
+                                await self.image_embeddings.create_embeddings([url for _, url in pages])
+                                if pages
+                                else []
+                            )
+                            blob_image_embeddings = [None] * len(page_images)
+                            for (i, _), embedding in zip(pages, embeddings):
+                                blob_image_embeddings[i] = embedding
+                        await search_manager.update_content(sections, blob_image_embeddings, page_images)
                 finally:
                     if file:
                         file.close()
+            self.blob_manager.log_skipped_uploads()
+            if search_manager.failed_section_count:
+                # The sections that failed were logged as they happened, and are left out of the manifest
+                raise Exception(f"Failed to index {search_manager.failed_section_count} sections, see the errors above")
         elif self.document_action == DocumentAction.Remove:
             paths = self.list_file_strategy.list_paths()
             async for path in paths:
@@ -112,12 +132,15 @@ class UploadUserFileStrategy:
         file_processors: dict[str, FileProcessor],
         embeddings: Optional[OpenAIEmbeddings] = None,
         image_embeddings: Optional[ImageEmbeddings] = None,
+        on_index_changed: Optional[Callable[[], None]] = None,
     ):
         self.file_processors = file_processors
         self.embeddings = embeddings
         self.image_embeddings = image_embeddings
         self.search_info = search_info
         self.search_manager = SearchManager(self.search_info, None, True, False, self.embeddings)
+        # Called after each change to the index, such as to invalidate cached search results
+        self.on_index_changed = on_index_changed
 
     async def add_file(self, file: File):
         if self.image_embeddings:
@@ -125,9 +148,13 @@ class UploadUserFileStrategy:
         sections = await parse_file(file, self.file_processors)
         if sections:
             await self.search_manager.update_content(sections)
+            if self.on_index_changed:
+                self.on_index_changed()
 
     async def remove_file(self, filename: str, oid: str):
         if filename is None or filename == "":
             logging.warning("Filename is required to remove a file")
             return
         await self.search_manager.remove_content(filename, oid)
+        if self.on_index_changed:
+            self.on_index_changed()
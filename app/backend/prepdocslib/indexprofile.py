@@ -0,0 +1,63 @@
+from typing import Optional
+
+
+class IndexProfile:
+    """
+    Settings for the vector fields of a search index, trading off index size and query latency against recall
+    To learn more, please visit https://learn.microsoft.com/azure/search/vector-search-how-to-configure-compression-storage
+    """
+
+    COMPRESSIONS = ["scalar"]
+
+    def __init__(
+        self,
+        name: str,
+        compression: Optional[str] = None,
+        rerank_with_original_vectors: bool = True,
+        default_oversampling: Optional[float] = None,
+        stored_vectors: bool = True,
+        hnsw_m: int = 4,
+        hnsw_ef_construction: int = 400,
+        hnsw_ef_search: int = 500,
+    ):
+        if compression is not None and compression not in IndexProfile.COMPRESSIONS:
+            raise ValueError(
+                f"Unsupported vector compression {compression}, expected one of {', '.join(IndexProfile.COMPRESSIONS)}"
+            )
+        self.name = name
+        # Scalar quantization stores vectors as int8 in the vector index, roughly a quarter of the float32 size
+        self.compression = compression
+        # Rescore the compressed search results with the full precision vectors, over-fetching by default_oversampling
+        self.rerank_with_original_vectors = rerank_with_original_vectors
+        self.default_oversampling = default_oversampling
+        # When not stored, vectors can't be retrieved in search results, but no retrievable copy is kept on disk
+        self.stored_vectors = stored_vectors
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.hnsw_ef_search = hnsw_ef_search
+
+    def with_hnsw_parameters(
+        self, m: Optional[int] = None, ef_construction: Optional[int] = None, ef_search: Optional[int] = None
+    ) -> "IndexProfile":
+        return IndexProfile(
+            name=self.name,
+            compression=self.compression,
+            rerank_with_original_vectors=self.rerank_with_original_vectors,
+            default_oversampling=self.default_oversampling,
+            stored_vectors=self.stored_vectors,
+            hnsw_m=m or self.hnsw_m,
+            hnsw_ef_construction=ef_construction or self.hnsw_ef_construction,
+            hnsw_ef_search=ef_search or self.hnsw_ef_search,
+        )
+
+
+INDEX_PROFILES = {
+    # Full precision vectors, retrievable in search results
+    "default": IndexProfile("default"),
+    # Quantized vector index, rescored with the original vectors
+    "scalar": IndexProfile("scalar", compression="scalar", default_oversampling=4),
+    # Quantized vector index, without a retrievable copy of the vectors
+    "storage-optimized": IndexProfile(
+        "storage-optimized", compression="scalar", default_oversampling=4, stored_vectors=False
+    ),
+}
@@ -24,6 +24,7 @@ from azure.search.documents.indexes.models import (
 
 from .blobmanager import BlobManager
 from .embeddings import AzureOpenAIEmbeddingService
+from .indexprofile import IndexProfile
 from .listfilestrategy import ListFileStrategy
 from .searchmanager import SearchManager
 from .strategy import DocumentAction, SearchInfo, Strategy
@@ -48,6 +49,7 @@ class IntegratedVectorizerStrategy(Strategy):
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         category: Optional[str] = None,
+        index_profile: Optional[IndexProfile] = None,
     ):
         if not embeddings or not isinstance(embeddings, AzureOpenAIEmbeddingService):
             raise Exception("Expecting AzureOpenAI embedding service")
@@ -62,6 +64,7 @@ class IntegratedVectorizerStrategy(Strategy):
         self.use_acls = use_acls
         self.category = category
         self.search_info = search_info
+        self.index_profile = index_profile
 
     async def create_embedding_skill(self, index_name: str):
         skillset_name = f"{index_name}-skillset"
@@ -127,6 +130,7 @@ class IntegratedVectorizerStrategy(Strategy):
             use_int_vectorization=True,
             embeddings=self.embeddings,
             search_images=False,
+            index_profile=self.index_profile,
         )
 
         if self.embeddings is None:
@@ -172,6 +176,7 @@ class IntegratedVectorizerStrategy(Strategy):
                 finally:
                     if file:
                         file.close()
+            self.blob_manager.log_skipped_uploads()
         elif self.document_action == DocumentAction.Remove:
             paths = self.list_file_strategy.list_paths()
             async for path in paths:
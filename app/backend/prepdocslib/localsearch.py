@@ -0,0 +1,522 @@
+import json
+import logging
+import math
+import operator
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from azure.search.documents.indexes.models import (
+    SearchableField,
+    SearchField,
+    SearchFieldDataType,
+    SearchIndex,
+    SimpleField,
+)
+from azure.search.documents.models import IndexingResult, VectorizedQuery, VectorQuery
+
+logger = logging.getLogger("ingester")
+
+VECTOR_FIELDS = ["embedding", "imageEmbedding"]
+
+ODATA_TOKEN = re.compile(
+    r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<number>-?\d+(?:\.\d+)?)|(?P<name>[A-Za-z_][\w.]*)|(?P<symbol>[()/,:]))"
+)
+
+Predicate = Callable[[Dict[str, Any], Dict[str, Any]], bool]
+
+
+def text_terms(text: str) -> List[str]:
+    return re.findall(r"\w+", unicodedata.normalize("NFC", text).casefold())
+
+
+class ODataFilter:
+    """
+    Predicate over documents parsed from the subset of OData filters used by the app and prepdocs: comparisons
+    (eq, ne, gt, ge, lt, le), search.in, any() and all() over collections, and the and, or and not operators
+    To learn more, please visit https://learn.microsoft.com/azure/search/search-query-odata-filter
+    """
+
+    COMPARISONS = {
+        "eq": operator.eq,
+        "ne": operator.ne,
+        "gt": operator.gt,
+        "ge": operator.ge,
+        "lt": operator.lt,
+        "le": operator.le,
+    }
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = self.tokenize(expression)
+        self.position = 0
+        self.predicate = self.parse_or()
+        if self.position != len(self.tokens):
+            raise self.error("Unexpected token")
+
+    def __call__(self, document: Dict[str, Any]) -> bool:
+        return self.predicate(document, {})
+
+    def tokenize(self, expression: str) -> List[Tuple[str, str]]:
+        tokens = []
+        position = 0
+        while position < len(expression.rstrip()):
+            match = ODATA_TOKEN.match(expression, position)
+            if not match:
+                raise ValueError(f"Unsupported filter {expression!r} at position {position}")
+            kind = match.lastgroup or ""
+            tokens.append((kind, match.group(kind)))
+            position = match.end()
+        return tokens
+
+    def error(self, message: str) -> ValueError:
+        return ValueError(f"{message} in filter {self.expression!r} at token {self.position}")
+
+    def peek(self, value: Optional[str] = None) -> bool:
+        if self.position >= len(self.tokens):
+            return False
+        return value is None or self.tokens[self.position][1] == value
+
+    def next(self, kind: Optional[str] = None, value: Optional[str] = None) -> str:
+        if self.position >= len(self.tokens):
+            raise self.error("Unexpected end")
+        token_kind, token = self.tokens[self.position]
+        if (kind and token_kind != kind) or (value and token != value):
+            raise self.error(f"Expected {value or kind}")
+        self.position += 1
+        return token
+
+    def parse_or(self) -> Predicate:
+        operands = [self.parse_and()]
+        while self.peek("or"):
+            self.next()
+            operands.append(self.parse_and())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda document, variables: any(operand(document, variables) for operand in operands)
+
+    def parse_and(self) -> Predicate:
+        operands = [self.parse_unary()]
+        while self.peek("and"):
+            self.next()
+            operands.append(self.parse_unary())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda document, variables: all(operand(document, variables) for operand in operands)
+
+    def parse_unary(self) -> Predicate:
+        if self.peek("not"):
+            self.next()
+            operand = self.parse_unary()
+            return lambda document, variables: not operand(document, variables)
+        return self.parse_primary()
+
+    def parse_primary(self) -> Predicate:
+        if self.peek("("):
+            self.next()
+            predicate = self.parse_or()
+            self.next(value=")")
+            return predicate
+        name = self.next(kind="name")
+        if name == "search.in":
+            return self.parse_search_in()
+        if self.peek("/"):
+            return self.parse_collection(name)
+        comparison = self.COMPARISONS.get(self.next(kind="name"))
+        if comparison is None:
+            raise self.error("Unsupported comparison")
+        literal = self.parse_literal()
+
+        def compare(document: Dict[str, Any], variables: Dict[str, Any]) -> bool:
+            value = self.resolve(name, document, variables)
+            if value is None or literal is None:
+                return comparison(value, literal) if comparison in (operator.eq, operator.ne) else False
+            return comparison(value, literal)
+
+        return compare
+
+    def parse_search_in(self) -> Predicate:
+        self.next(value="(")
+        name = self.next(kind="name")
+        self.next(value=",")
+        values = self.parse_literal()
+        delimiters = " ,"
+        if self.peek(","):
+            self.next()
+            delimiters = self.parse_literal()
+        self.next(value=")")
+        allowed = {value for value in re.split(f"[{re.escape(delimiters)}]+", values) if value}
+        return lambda document, variables: self.resolve(name, document, variables) in allowed
+
+    def parse_collection(self, name: str) -> Predicate:
+        self.next(value="/")
+        quantifier = self.next(kind="name")
+        if quantifier not in ("any", "all"):
+            raise self.error("Unsupported collection operator")
+        self.next(value="(")
+        variable = self.next(kind="name")
+        self.next(value=":")
+        inner = self.parse_or()
+        self.next(value=")")
+        quantify = any if quantifier == "any" else all
+        return lambda document, variables: quantify(
+            inner(document, {**variables, variable: item}) for item in self.resolve(name, document, variables) or []
+        )
+
+    def parse_literal(self) -> Any:
+        kind = self.tokens[self.position][0] if self.position < len(self.tokens) else ""
+        token = self.next()
+        if kind == "string":
+            return token[1:-1].replace("''", "'")
+        if kind == "number":
+            return float(token) if "." in token else int(token)
+        if token in ("true", "false"):
+            return token == "true"
+        if token == "null":
+            return None
+        raise self.error("Expected a literal")
+
+    @staticmethod
+    def resolve(name: str, document: Dict[str, Any], variables: Dict[str, Any]) -> Any:
+        return variables[name] if name in variables else document.get(name)
+
+
+class LocalSearchResults:
+    """
+    Search results that can be iterated over directly or by page, like the results of SearchClient.search
+    """
+
+    def __init__(self, documents: List[Dict[str, Any]]):
+        self.documents = documents
+
+    async def __aiter__(self) -> AsyncIterator[Dict[str, Any]]:
+        for document in self.documents:
+            yield document
+
+    async def by_page(self) -> AsyncIterator["LocalSearchResults"]:
+        yield self
+
+
+class LocalSearchClient:
+    """
+    In-process search index implementing the subset of SearchClient used by the app and prepdocs, for offline
+    development, tests and small tenants. Documents are stored as JSON and vectors as NumPy arrays, which are memory
+    mapped when the index is loaded. Text is ranked with BM25 and vectors by exhaustive cosine similarity, and hybrid
+    queries are fused with reciprocal rank fusion like Azure AI Search does. Semantic ranking isn't available.
+    Writes are kept in memory and saved when the client is closed, so a single process should write to the index at
+    a time, other processes reload it once it is saved.
+    """
+
+    # Same defaults as the BM25 similarity of Azure AI Search
+    K1 = 1.2
+    B = 0.75
+    RRF_K = 60
+    DEFAULT_TOP = 50
+
+    def __init__(self, path: str, index_name: str):
+        self.directory = os.path.join(path, index_name)
+        self.index_name = index_name
+        self.metadata_path = os.path.join(self.directory, "index.json")
+        self.loaded_mtime: Optional[float] = None
+        # Whether documents were written or deleted since the index was last saved
+        self.changed = False
+        self.load()
+
+    async def __aenter__(self) -> "LocalSearchClient":
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        # Saving rewrites the whole index, so it is done once for all the batches written by the client
+        if self.changed:
+            self.save()
+
+    def vector_path(self, field: str) -> str:
+        return os.path.join(self.directory, f"{field}.npy")
+
+    def load(self):
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self.vector_ids: Dict[str, List[str]] = {}
+        self.vectors: Dict[str, np.ndarray] = {}
+        if os.path.exists(self.metadata_path):
+            self.loaded_mtime = os.stat(self.metadata_path).st_mtime
+            with open(self.metadata_path, encoding="utf-8") as metadata_file:
+                metadata = json.load(metadata_file)
+            self.documents = metadata["documents"]
+            for field, ids in metadata["vectors"].items():
+                self.vector_ids[field] = ids
+                self.vectors[field] = np.load(self.vector_path(field), mmap_mode="r")
+        self.vector_rows = {field: {id: row for row, id in enumerate(ids)} for field, ids in self.vector_ids.items()}
+        self.vector_norms = {field: np.linalg.norm(vectors, axis=1) for field, vectors in self.vectors.items()}
+
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.lengths: Dict[str, int] = {}
+        for id, document in self.documents.items():
+            self.index_text(id, document.get("content"))
+
+    def reload_if_changed(self):
+        # Another process, such as prepdocs, may have updated the index since it was loaded. The writes that are not
+        # saved yet would be lost by reloading, and they are saved over the other changes anyway
+        if self.changed:
+            return
+        mtime = os.stat(self.metadata_path).st_mtime if os.path.exists(self.metadata_path) else None
+        if mtime != self.loaded_mtime:
+            self.load()
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for field, vectors in self.vectors.items():
+            temporary_path = self.vector_path(field) + ".tmp"
+            with open(temporary_path, "wb") as vector_file:
+                np.save(vector_file, vectors)
+            os.replace(temporary_path, self.vector_path(field))
+        # The metadata is written last, so that other processes only reload once the vectors are in place
+        temporary_path = self.metadata_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as metadata_file:
+            json.dump({"documents": self.documents, "vectors": self.vector_ids}, metadata_file)
+        os.replace(temporary_path, self.metadata_path)
+        self.loaded_mtime = os.stat(self.metadata_path).st_mtime
+        self.changed = False
+
+    def index_text(self, id: str, content: Optional[str]):
+        term_counts = Counter(text_terms(content or ""))
+        for term, count in term_counts.items():
+            self.postings.setdefault(term, {})[id] = count
+        self.lengths[id] = sum(term_counts.values())
+
+    def unindex_text(self, id: str):
+        for term in set(text_terms(self.documents[id].get("content") or "")):
+            postings = self.postings.get(term, {})
+            postings.pop(id, None)
+            if not postings:
+                self.postings.pop(term, None)
+        self.lengths.pop(id, None)
+
+    def set_vectors(self, field: str, vectors_by_id: Dict[str, List[float]]):
+        ids = self.vector_ids.setdefault(field, [])
+        rows = self.vector_rows.setdefault(field, {})
+        dimensions = len(next(iter(vectors_by_id.values())))
+        # Memory mapped vectors are read-only, so they are copied into memory on the first write
+        vectors = np.array(self.vectors.get(field, np.empty((0, dimensions), dtype=np.float32)), dtype=np.float32)
+        new_vectors = []
+        for id, vector in vectors_by_id.items():
+            if id in rows:
+                vectors[rows[id]] = vector
+            else:
+                rows[id] = len(ids)
+                ids.append(id)
+                new_vectors.append(vector)
+        if new_vectors:
+            vectors = np.vstack([vectors, np.array(new_vectors, dtype=np.float32)])
+        self.vectors[field] = vectors
+        self.vector_norms[field] = np.linalg.norm(vectors, axis=1)
+
+    def remove_vectors(self, removed_ids: set, fields: Optional[List[str]] = None):
+        for field, ids in self.vector_ids.items():
+            if fields is not None and field not in fields:
+                continue
+            keep = np.array([id not in removed_ids for id in ids], dtype=bool)
+            if keep.all():
+                continue
+            self.vector_ids[field] = [id for id in ids if id not in removed_ids]
+            self.vectors[field] = np.array(self.vectors[field][keep])
+            self.vector_norms[field] = self.vector_norms[field][keep]
+            self.vector_rows[field] = {id: row for row, id in enumerate(self.vector_ids[field])}
+
+    @staticmethod
+    def indexing_result(
+        key: str, succeeded: bool, status_code: int, error_message: Optional[str] = None
+    ) -> IndexingResult:
+        # The service sets these fields, so the model only accepts them when deserializing a response
+        return IndexingResult.deserialize(
+            {"key": key, "status": succeeded, "statusCode": status_code, "errorMessage": error_message}
+        )
+
+    def write_documents(self, documents: List[Dict[str, Any]], merge: bool) -> List[IndexingResult]:
+        self.reload_if_changed()
+        results = []
+        vectors_by_field: Dict[str, Dict[str, List[float]]] = {}
+        # The vectors of replaced documents that the new version doesn't have
+        removed_by_field: Dict[str, set] = {}
+        for document in documents:
+            id = document["id"]
+            if merge and id not in self.documents:
+                results.append(self.indexing_result(id, False, 404, f"Document not found: {id}"))
+                continue
+            fields = {key: value for key, value in document.items() if key not in VECTOR_FIELDS}
+            if id in self.documents:
+                self.unindex_text(id)
+            self.documents[id] = {**self.documents[id], **fields} if merge else fields
+            self.index_text(id, self.documents[id].get("content"))
+            for field in VECTOR_FIELDS:
+                if document.get(field):
+                    vectors_by_field.setdefault(field, {})[id] = document[field]
+                elif not merge and id in self.vector_rows.get(field, {}):
+                    removed_by_field.setdefault(field, set()).add(id)
+            results.append(self.indexing_result(id, True, 200 if merge else 201))
+        for field, removed_ids in removed_by_field.items():
+            self.remove_vectors(removed_ids, [field])
+        for field, vectors_by_id in vectors_by_field.items():
+            self.set_vectors(field, vectors_by_id)
+        self.changed = self.changed or any(result.succeeded for result in results)
+        return results
+
+    async def upload_documents(self, documents: List[Dict[str, Any]], **kwargs) -> List[IndexingResult]:
+        return self.write_documents(documents, merge=False)
+
+    async def merge_documents(self, documents: List[Dict[str, Any]], **kwargs) -> List[IndexingResult]:
+        return self.write_documents(documents, merge=True)
+
+    async def delete_documents(self, documents: List[Dict[str, Any]], **kwargs) -> List[IndexingResult]:
+        self.reload_if_changed()
+        removed_ids = set()
+        for document in documents:
+            id = document["id"]
+            if id in self.documents:
+                self.unindex_text(id)
+                del self.documents[id]
+                removed_ids.add(id)
+        self.remove_vectors(removed_ids)
+        self.changed = self.changed or bool(removed_ids)
+        # Like the service, deleting a document that doesn't exist succeeds
+        return [self.indexing_result(document["id"], True, 200) for document in documents]
+
+    def rank_text(self, search_text: str, candidates: set) -> List[Tuple[str, float]]:
+        if not self.lengths:
+            return []
+        average_length = sum(self.lengths.values()) / len(self.lengths) or 1
+        scores: Dict[str, float] = {}
+        for term in set(text_terms(search_text)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.documents) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for id, count in postings.items():
+                if id in candidates:
+                    length_norm = self.K1 * (1 - self.B + self.B * self.lengths[id] / average_length)
+                    scores[id] = scores.get(id, 0.0) + idf * count * (self.K1 + 1) / (count + length_norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def rank_vectors(self, query: VectorQuery, candidates: set) -> List[Tuple[str, float]]:
+        if not isinstance(query, VectorizedQuery):
+            raise ValueError("The local search index only supports vectorized queries")
+        query_vector = np.asarray(query.vector, dtype=np.float32)
+        query_norm = np.linalg.norm(query_vector) or 1.0
+        k = query.k_nearest_neighbors or self.DEFAULT_TOP
+        scores: Dict[str, float] = {}
+        for field in (field.strip() for field in (query.fields or "").split(",")):
+            if field not in self.vectors:
+                continue
+            ids = self.vector_ids[field]
+            if len(candidates) == len(self.documents):
+                rows = np.arange(len(ids))
+            else:
+                rows = np.array([row for row, id in enumerate(ids) if id in candidates], dtype=np.int64)
+            if not len(rows):
+                continue
+            norms = self.vector_norms[field][rows]
+            similarities = (self.vectors[field][rows] @ query_vector) / np.where(norms, norms, 1.0) / query_norm
+            best = np.argpartition(-similarities, k - 1)[:k] if len(rows) > k else np.arange(len(rows))
+            for index in best:
+                # Cosine distance is turned into a score the same way as Azure AI Search does
+                score = float(1 / (2 - similarities[index]))
+                id = ids[rows[index]]
+                scores[id] = max(score, scores.get(id, 0.0))
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def fuse(self, ranked_lists: List[List[Tuple[str, float]]]) -> List[Tuple[str, float]]:
+        scores: Dict[str, float] = {}
+        for ranked in ranked_lists:
+            for rank, (id, _) in enumerate(ranked, start=1):
+                scores[id] = scores.get(id, 0.0) + 1 / (self.RRF_K + rank)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def select_fields(self, id: str, select: Optional[List[str]]) -> Dict[str, Any]:
+        document = dict(self.documents[id])
+        for field in VECTOR_FIELDS:
+            if (select is None or field in select) and id in self.vector_rows.get(field, {}):
+                document[field] = self.vectors[field][self.vector_rows[field][id]].tolist()
+        if select is not None:
+            document = {key: value for key, value in document.items() if key in select}
+        return document
+
+    async def search(
+        self,
+        search_text: Optional[str] = None,
+        *,
+        filter: Optional[str] = None,
+        top: Optional[int] = None,
+        vector_queries: Optional[List[VectorQuery]] = None,
+        select: Optional[List[str]] = None,
+        order_by: Optional[List[str]] = None,
+        query_type: Optional[str] = None,
+        query_language: Optional[str] = None,
+        query_speller: Optional[str] = None,
+        semantic_configuration_name: Optional[str] = None,
+        query_caption: Optional[str] = None,
+    ) -> LocalSearchResults:
+        self.reload_if_changed()
+        predicate = ODataFilter(filter) if filter else None
+        candidates = {id for id, document in self.documents.items() if predicate is None or predicate(document)}
+
+        ranked_lists = []
+        if search_text and search_text.strip() not in ("", "*"):
+            ranked_lists.append(self.rank_text(search_text, candidates))
+        for vector_query in vector_queries or []:
+            ranked_lists.append(self.rank_vectors(vector_query, candidates))
+
+        ranked: List[Tuple[str, float]]
+        if not ranked_lists:
+            ranked = [(id, 1.0) for id in sorted(candidates)]
+        elif len(ranked_lists) == 1:
+            ranked = ranked_lists[0]
+        else:
+            ranked = self.fuse(ranked_lists)
+
+        for order in reversed(order_by or []):
+            field, _, direction = order.partition(" ")
+            ranked.sort(
+                key=lambda item: (self.documents[item[0]].get(field) is not None, self.documents[item[0]].get(field)),
+                reverse=direction.strip().lower() == "desc",
+            )
+
+        documents = []
+        for id, score in ranked[: self.DEFAULT_TOP if top is None else top]:
+            document = self.select_fields(id, select)
+            # Semantic ranking and captions are only available in Azure AI Search
+            document.update({"@search.score": score, "@search.reranker_score": None, "@search.captions": None})
+            documents.append(document)
+        return LocalSearchResults(documents)
+
+    def get_index(self) -> SearchIndex:
+        """Returns the definition of the fields of the index, like SearchIndexClient.get_index."""
+        return SearchIndex(
+            name=self.index_name,
+            fields=[
+                SimpleField(name="id", type="Edm.String", key=True, filterable=True, sortable=True),
+                SearchableField(name="content", type="Edm.String"),
+                SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
+                SimpleField(name="sourcepage", type="Edm.String", filterable=True, facetable=True),
+                SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True),
+                SimpleField(
+                    name="oids", type=SearchFieldDataType.Collection(SearchFieldDataType.String), filterable=True
+                ),
+                SimpleField(
+                    name="groups", type=SearchFieldDataType.Collection(SearchFieldDataType.String), filterable=True
+                ),
+                *(
+                    SearchField(
+                        name=field,
+                        type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                        vector_search_dimensions=self.vectors[field].shape[1],
+                    )
+                    for field in VECTOR_FIELDS
+                    if field in self.vectors
+                ),
+            ],
+        )
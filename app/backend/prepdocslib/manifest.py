@@ -0,0 +1,42 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("ingester")
+
+
+class IndexManifest:
+    """
+    Local record of the search document ids written for each source file, so that the sections of a file can be
+    removed from the index without searching for them first
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, List[str]] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as manifest_file:
+                self.entries = json.load(manifest_file)
+            logger.info("Loaded index manifest %s with %d files", path, len(self.entries))
+
+    def get(self, sourcefile: str) -> Optional[List[str]]:
+        return self.entries.get(sourcefile)
+
+    def add(self, sourcefile: str, ids: List[str]):
+        # Keep ids from earlier runs, a file that shrinks still has its old sections in the index
+        existing_ids = self.entries.get(sourcefile, [])
+        known_ids = set(existing_ids)
+        self.entries[sourcefile] = existing_ids + [id for id in ids if id not in known_ids]
+
+    def remove(self, sourcefile: str):
+        self.entries.pop(sourcefile, None)
+
+    def clear(self):
+        self.entries = {}
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(self.entries, manifest_file)
+        os.replace(temp_path, self.path)
@@ -1,11 +1,16 @@
 import asyncio
+import json
 import logging
 import os
-from typing import List, Optional
+from typing import AsyncGenerator, Dict, List, Optional
 
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import (
     HnswAlgorithmConfiguration,
     HnswParameters,
+    ScalarQuantizationCompressionConfiguration,
+    ScalarQuantizationParameters,
     SearchableField,
     SearchField,
     SearchFieldDataType,
@@ -16,19 +21,26 @@ from azure.search.documents.indexes.models import (
     SemanticSearch,
     SimpleField,
     VectorSearch,
+    VectorSearchCompressionConfiguration,
     VectorSearchProfile,
     VectorSearchVectorizer,
 )
 
-from .blobmanager import BlobManager
+from .blobmanager import BlobManager, PageImage
 from .embeddings import OpenAIEmbeddings
+from .indexprofile import INDEX_PROFILES, IndexProfile
 from .listfilestrategy import File
+from .manifest import IndexManifest
 from .strategy import SearchInfo
 from .textsplitter import SplitPage
 
 logger = logging.getLogger("ingester")
 
 
+class KeyPagingNotSupported(Exception):
+    """Raised when the sections of an index can't be paged by key, because its id field is not sortable"""
+
+
 class Section:
     """
     A section of a page that is stored in a search service. These sections are used as context by Azure OpenAI service
@@ -46,6 +58,17 @@ class SearchManager:
     To learn more, please visit https://learn.microsoft.com/azure/search/search-what-is-azure-search
     """
 
+    # The service accepts at most 1000 documents and 16 MB per indexing request
+    MAX_BATCH_SIZE = 1000
+    MAX_BATCH_BYTES = 14 * 1024 * 1024
+    # Per-document statuses that the service documents as transient (throttling, conflicts, unavailability)
+    RETRIABLE_STATUS_CODES = {409, 422, 429, 503}
+    MAX_UPLOAD_ATTEMPTS = 3
+    UPLOAD_RETRY_DELAY = 1
+    MAX_DELETE_CONCURRENCY = 4
+    # It can take a few seconds for search results to reflect deletions
+    REMOVAL_REFRESH_DELAY = 2
+
     def __init__(
         self,
         search_info: SearchInfo,
@@ -54,6 +77,8 @@ class SearchManager:
         use_int_vectorization: bool = False,
         embeddings: Optional[OpenAIEmbeddings] = None,
         search_images: bool = False,
+        manifest: Optional[IndexManifest] = None,
+        index_profile: Optional[IndexProfile] = None,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
@@ -63,14 +88,22 @@ class SearchManager:
         # Integrated vectorization uses the ada-002 model with 1536 dimensions
         self.embedding_dimensions = self.embeddings.open_ai_dimensions if self.embeddings else 1536
         self.search_images = search_images
+        self.manifest = manifest
+        self.index_profile = index_profile or INDEX_PROFILES["default"]
+        # Sections that could not be indexed, even after retrying the transient failures
+        self.failed_section_count = 0
 
     async def create_index(self, vectorizers: Optional[List[VectorSearchVectorizer]] = None):
         logger.info("Ensuring search index %s exists", self.search_info.index_name)
+        if self.search_info.local_search_path:
+            # The local index is created along with its first documents and doesn't need a schema
+            return
 
         async with self.search_info.create_search_index_client() as search_index_client:
             fields = [
                 (
-                    SimpleField(name="id", type="Edm.String", key=True)
+                    # Sortable so that sections can be paged through by key when removing them
+                    SimpleField(name="id", type="Edm.String", key=True, filterable=True, sortable=True)
                     if not self.use_int_vectorization
                     else SearchField(
                         name="id",
@@ -87,17 +120,7 @@ class SearchManager:
                     type="Edm.String",
                     analyzer_name=self.search_analyzer_name,
                 ),
-                SearchField(
-                    name="embedding",
-                    type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                    hidden=False,
-                    searchable=True,
-                    filterable=False,
-                    sortable=False,
-                    facetable=False,
-                    vector_search_dimensions=self.embedding_dimensions,
-                    vector_search_profile_name="embedding_config",
-                ),
+                self.vector_field("embedding", self.embedding_dimensions),
                 SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(
                     name="sourcepage",
@@ -130,19 +153,8 @@ class SearchManager:
             if self.use_int_vectorization:
                 fields.append(SearchableField(name="parent_id", type="Edm.String", filterable=True))
             if self.search_images:
-                fields.append(
-                    SearchField(
-                        name="imageEmbedding",
-                        type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                        hidden=False,
-                        searchable=True,
-                        filterable=False,
-                        sortable=False,
-                        facetable=False,
-                        vector_search_dimensions=1024,
-                        vector_search_profile_name="embedding_config",
-                    ),
-                )
+                fields.append(self.vector_field("imageEmbedding", 1024))
+                fields.extend(self.image_dimension_fields())
 
             index = SearchIndex(
                 name=self.search_info.index_name,
@@ -161,7 +173,12 @@ class SearchManager:
                     algorithms=[
                         HnswAlgorithmConfiguration(
                             name="hnsw_config",
-                            parameters=HnswParameters(metric="cosine"),
+                            parameters=HnswParameters(
+                                metric="cosine",
+                                m=self.index_profile.hnsw_m,
+                                ef_construction=self.index_profile.hnsw_ef_construction,
+                                ef_search=self.index_profile.hnsw_ef_search,
+                            ),
                         )
                     ],
                     profiles=[
@@ -171,9 +188,13 @@ class SearchManager:
                             vectorizer=(
                                 f"{self.search_info.index_name}-vectorizer" if self.use_int_vectorization else None
                             ),
+                            compression_configuration_name=(
+                                "compression_config" if self.index_profile.compression else None
+                            ),
                         ),
                     ],
                     vectorizers=vectorizers,
+                    compressions=self.vector_compressions(),
                 ),
             )
             if self.search_info.index_name not in [name async for name in search_index_client.list_index_names()]:
@@ -181,71 +202,316 @@ class SearchManager:
                 await search_index_client.create_index(index)
             else:
                 logger.info("Search index %s already exists", self.search_info.index_name)
+                if self.search_images:
+                    # Indexes created before page image dimensions were recorded need the new fields added
+                    existing_index = await search_index_client.get_index(self.search_info.index_name)
+                    existing_field_names = {field.name for field in existing_index.fields}
+                    missing_fields = [
+                        field for field in self.image_dimension_fields() if field.name not in existing_field_names
+                    ]
+                    if missing_fields:
+                        logger.info(
+                            "Adding page image dimension fields to search index %s", self.search_info.index_name
+                        )
+                        existing_index.fields.extend(missing_fields)
+                        await search_index_client.create_or_update_index(existing_index)
 
-    async def update_content(self, sections: List[Section], image_embeddings: Optional[List[List[float]]] = None):
-        MAX_BATCH_SIZE = 1000
-        section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
+    def vector_field(self, name: str, dimensions: int) -> SearchField:
+        return SearchField(
+            name=name,
+            type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+            hidden=not self.index_profile.stored_vectors,
+            # Only set when turned off, as the property can't be changed on existing fields
+            stored=None if self.index_profile.stored_vectors else False,
+            searchable=True,
+            filterable=False,
+            sortable=False,
+            facetable=False,
+            vector_search_dimensions=dimensions,
+            vector_search_profile_name="embedding_config",
+        )
+
+    def vector_compressions(self) -> Optional[List[VectorSearchCompressionConfiguration]]:
+        if self.index_profile.compression == "scalar":
+            return [
+                ScalarQuantizationCompressionConfiguration(
+                    name="compression_config",
+                    rerank_with_original_vectors=self.index_profile.rerank_with_original_vectors,
+                    default_oversampling=self.index_profile.default_oversampling,
+                    parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+                )
+            ]
+        return None
+
+    def image_dimension_fields(self) -> List[SearchField]:
+        return [
+            SimpleField(name="imageWidth", type=SearchFieldDataType.Int32),
+            SimpleField(name="imageHeight", type=SearchFieldDataType.Int32),
+        ]
+
+    async def update_content(
+        self,
+        sections: List[Section],
+        image_embeddings: Optional[List[Optional[List[float]]]] = None,
+        page_images: Optional[List[PageImage]] = None,
+    ):
+        """
+        Uploads the sections to the index. The image embeddings and the page images, when given, have one entry per
+        page of the document, and are looked up by the page number of each section.
+        """
+        section_batches = [sections[i : i + self.MAX_BATCH_SIZE] for i in range(0, len(sections), self.MAX_BATCH_SIZE)]
 
         async with self.search_info.create_search_client() as search_client:
-            for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{section.content.filename_to_id()}-page-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section.split_page.text,
-                        "category": section.category,
-                        "sourcepage": (
-                            BlobManager.blob_image_name_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                            if image_embeddings
-                            else BlobManager.sourcepage_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                        ),
-                        "sourcefile": section.content.filename(),
-                        **section.content.acls,
-                    }
-                    for section_index, section in enumerate(batch)
-                ]
-                if self.embeddings:
-                    embeddings = await self.embeddings.create_embeddings(
-                        texts=[section.split_page.text for section in batch]
-                    )
-                    for i, document in enumerate(documents):
-                        document["embedding"] = embeddings[i]
-                if image_embeddings:
-                    for i, (document, section) in enumerate(zip(documents, batch)):
-                        document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
+            # Embeddings for the next batch are computed while the previous batch is being uploaded
+            upload_task: Optional[asyncio.Task] = None
+            sourcefiles: Dict[str, str] = {}
+            uploaded_ids: List[str] = []
+            try:
+                for batch_index, batch in enumerate(section_batches):
+                    documents = [
+                        {
+                            "id": f"{section.content.filename_to_id()}-page-{section_index + batch_index * self.MAX_BATCH_SIZE}",
+                            "content": section.split_page.text,
+                            "category": section.category,
+                            "sourcepage": (
+                                page_images[section.split_page.page_num].blob_name
+                                if page_images and section.split_page.page_num < len(page_images)
+                                else (
+                                    BlobManager.blob_image_name_from_file_page(
+                                        filename=section.content.filename(),
+                                        page=section.split_page.page_num,
+                                    )
+                                    if image_embeddings
+                                    else BlobManager.sourcepage_from_file_page(
+                                        filename=section.content.filename(),
+                                        page=section.split_page.page_num,
+                                    )
+                                )
+                            ),
+                            "sourcefile": section.content.filename(),
+                            **section.content.acls,
+                        }
+                        for section_index, section in enumerate(batch)
+                    ]
+                    if self.embeddings:
+                        embeddings = await self.embeddings.create_embeddings(
+                            texts=[section.split_page.text for section in batch]
+                        )
+                        for i, document in enumerate(documents):
+                            document["embedding"] = embeddings[i]
+                    for document, section in zip(documents, batch):
+                        page_num = section.split_page.page_num
+                        if image_embeddings and page_num < len(image_embeddings):
+                            if (image_embedding := image_embeddings[page_num]) is not None:
+                                document["imageEmbedding"] = image_embedding
+                        if page_images and page_num < len(page_images):
+                            document["imageWidth"] = page_images[page_num].width
+                            document["imageHeight"] = page_images[page_num].height
+
+                    if upload_task is not None:
+                        uploaded_ids.extend(await upload_task)
+                    upload_task = asyncio.create_task(self.upload_documents(search_client, documents))
+                    for document in documents:
+                        sourcefiles[document["id"]] = document["sourcefile"]
+                if upload_task is not None:
+                    uploaded_ids.extend(await upload_task)
+            except BaseException:
+                if upload_task is not None and not upload_task.done():
+                    upload_task.cancel()
+                raise
+        # Only the sections that were indexed are recorded, so the manifest never claims a file is fully indexed
+        written_ids: Dict[str, List[str]] = {}
+        for id in uploaded_ids:
+            written_ids.setdefault(sourcefiles[id], []).append(id)
+        if self.manifest is not None and written_ids:
+            for sourcefile, ids in written_ids.items():
+                self.manifest.add(sourcefile, ids)
+            self.manifest.save()
+
+    @classmethod
+    def estimate_document_size(cls, document: dict) -> int:
+        """
+        Estimates the size of a document once serialized to JSON, without paying for serializing its vectors
+        """
+        size = 2
+        for key, value in document.items():
+            if isinstance(value, list) and value and isinstance(value[0], float):
+                # A float takes at most 24 characters, plus a separator
+                field_size = len(value) * 25
+            else:
+                field_size = len(json.dumps(value))
+            size += len(key) + field_size + 4
+        return size
 
-                await search_client.upload_documents(documents)
+    def split_documents_by_size(self, documents: List[dict]) -> List[List[dict]]:
+        batches: List[List[dict]] = []
+        batch: List[dict] = []
+        batch_size = 0
+        for document in documents:
+            document_size = SearchManager.estimate_document_size(document)
+            if batch and batch_size + document_size > self.MAX_BATCH_BYTES:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(document)
+            batch_size += document_size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def upload_documents(self, search_client: SearchClient, documents: List[dict]) -> List[str]:
+        """
+        Uploads documents in requests that stay under the service's payload limit, retrying the individual documents
+        that failed with a transient error. Returns the ids of the documents that were indexed
+        """
+        uploaded_ids: List[str] = []
+        for batch in self.split_documents_by_size(documents):
+            for attempt in range(self.MAX_UPLOAD_ATTEMPTS):
+                results = await search_client.upload_documents(batch)
+                uploaded_ids.extend(result.key for result in results if result.succeeded)
+                failed = {result.key: result for result in results if not result.succeeded}
+                if not failed:
+                    break
+                retriable = [
+                    document
+                    for document in batch
+                    if document["id"] in failed and failed[document["id"]].status_code in self.RETRIABLE_STATUS_CODES
+                ]
+                for key, result in failed.items():
+                    if result.status_code not in self.RETRIABLE_STATUS_CODES:
+                        logger.error("Failed to index section %s: %s", key, result.error_message)
+                        self.failed_section_count += 1
+                if not retriable:
+                    break
+                if attempt == self.MAX_UPLOAD_ATTEMPTS - 1:
+                    self.failed_section_count += len(retriable)
+                    for document in retriable:
+                        logger.error(
+                            "Failed to index section %s after %d attempts: %s",
+                            document["id"],
+                            self.MAX_UPLOAD_ATTEMPTS,
+                            failed[document["id"]].error_message,
+                        )
+                    break
+                logger.info("Retrying %d sections that failed to index", len(retriable))
+                await asyncio.sleep(self.UPLOAD_RETRY_DELAY * 2**attempt)
+                batch = retriable
+        return uploaded_ids
 
     async def remove_content(self, path: Optional[str] = None, only_oid: Optional[str] = None):
         logger.info(
             "Removing sections from '{%s or '<all>'}' from search index '%s'", path, self.search_info.index_name
         )
         async with self.search_info.create_search_client() as search_client:
-            while True:
-                filter = None if path is None else f"sourcefile eq '{os.path.basename(path)}'"
-                max_results = 1000
+            sourcefile = None if path is None else os.path.basename(path)
+            manifest_ids = None
+            if sourcefile is not None and only_oid is None and self.manifest is not None:
+                manifest_ids = self.manifest.get(sourcefile)
+            if manifest_ids is not None:
+                logger.info("Removing %d sections recorded in the index manifest", len(manifest_ids))
+                removed_count = await self.delete_ids(search_client, self.batch_ids(manifest_ids))
+            else:
+                filter = None if sourcefile is None else f"sourcefile eq '{sourcefile}'"
+                try:
+                    removed_count = await self.delete_ids(
+                        search_client, self.find_ids_to_remove(search_client, filter, only_oid)
+                    )
+                except KeyPagingNotSupported:
+                    logger.info("Search index id field is not sortable, removing sections without key paging")
+                    removed_count = await self.remove_without_key_paging(search_client, filter, only_oid)
+            logger.info("Removed %d sections from index", removed_count)
+        if self.manifest is not None and only_oid is None:
+            if sourcefile is None:
+                self.manifest.clear()
+            else:
+                self.manifest.remove(sourcefile)
+            self.manifest.save()
+
+    async def batch_ids(self, ids: List[str]) -> AsyncGenerator[List[str], None]:
+        for i in range(0, len(ids), self.MAX_BATCH_SIZE):
+            yield ids[i : i + self.MAX_BATCH_SIZE]
+
+    async def find_ids_to_remove(
+        self, search_client: SearchClient, filter: Optional[str], only_oid: Optional[str]
+    ) -> AsyncGenerator[List[str], None]:
+        """
+        Pages through the sections matching the filter, fetching only their keys. Pages are read by key order, so
+        deleting the sections already found doesn't shift the pages still to come, and there is no need to wait for
+        deletions to be reflected in search results.
+        Raises KeyPagingNotSupported before yielding anything if the id field of the index is not sortable.
+        """
+        select = ["id", "oids"] if only_oid else ["id"]
+        last_id: Optional[str] = None
+        while True:
+            clauses = [filter] if filter else []
+            if last_id is not None:
+                clauses.append(f"id gt '{last_id}'")
+            page_filter = (
+                " and ".join(f"({clause})" for clause in clauses) if len(clauses) > 1 else next(iter(clauses), None)
+            )
+            try:
                 result = await search_client.search(
-                    search_text="", filter=filter, top=max_results, include_total_count=True
+                    search_text="", filter=page_filter, select=select, order_by=["id asc"], top=self.MAX_BATCH_SIZE
                 )
-                result_count = await result.get_count()
-                if result_count == 0:
-                    break
-                documents_to_remove = []
-                async for document in result:
-                    # If only_oid is set, only remove documents that have only this oid
-                    if not only_oid or document.get("oids") == [only_oid]:
-                        documents_to_remove.append({"id": document["id"]})
-                if len(documents_to_remove) == 0:
-                    if result_count < max_results:
-                        break
-                    else:
-                        continue
-                removed_docs = await search_client.delete_documents(documents_to_remove)
-                logger.info("Removed %d sections from index", len(removed_docs))
-                # It can take a few seconds for search results to reflect changes, so wait a bit
-                await asyncio.sleep(2)
+                documents = [document async for document in result]
+            except HttpResponseError as error:
+                if last_id is None and error.status_code == 400:
+                    raise KeyPagingNotSupported() from error
+                raise
+            if not documents:
+                break
+            # If only_oid is set, only remove documents that have only this oid
+            yield [document["id"] for document in documents if not only_oid or document.get("oids") == [only_oid]]
+            if len(documents) < self.MAX_BATCH_SIZE:
+                break
+            last_id = documents[-1]["id"]
+
+    async def remove_without_key_paging(
+        self, search_client: SearchClient, filter: Optional[str], only_oid: Optional[str]
+    ) -> int:
+        """
+        Removes the sections matching the filter from indexes created before the id field was sortable. The first
+        page of results is deleted and the search repeated once the deletion is reflected, skipping the sections
+        that were kept because they are shared with other users.
+        """
+        select = ["id", "oids"] if only_oid else ["id"]
+        removed_count = 0
+        kept_count = 0
+        while True:
+            result = await search_client.search(
+                search_text="", filter=filter, select=select, skip=kept_count or None, top=self.MAX_BATCH_SIZE
+            )
+            documents = [document async for document in result]
+            # If only_oid is set, only remove documents that have only this oid
+            ids = [document["id"] for document in documents if not only_oid or document.get("oids") == [only_oid]]
+            kept_count += len(documents) - len(ids)
+            if ids:
+                removed_docs = await search_client.delete_documents([{"id": id} for id in ids])
+                removed_count += len(removed_docs)
+            if len(documents) < self.MAX_BATCH_SIZE:
+                break
+            if ids:
+                await asyncio.sleep(self.REMOVAL_REFRESH_DELAY)
+        return removed_count
+
+    async def delete_ids(self, search_client: SearchClient, id_batches: AsyncGenerator[List[str], None]) -> int:
+        """
+        Deletes batches of sections by key as they are produced, with a few delete requests in flight at a time
+        """
+        semaphore = asyncio.Semaphore(self.MAX_DELETE_CONCURRENCY)
+        removed_counts: List[int] = []
+
+        async def delete_batch(ids: List[str]):
+            try:
+                removed_docs = await search_client.delete_documents([{"id": id} for id in ids])
+                removed_counts.append(len(removed_docs))
+            finally:
+                semaphore.release()
+
+        tasks = []
+        async for ids in id_batches:
+            if not ids:
+                continue
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(delete_batch(ids)))
+        await asyncio.gather(*tasks)
+        return sum(removed_counts)
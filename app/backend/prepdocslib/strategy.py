@@ -1,12 +1,14 @@
 from abc import ABC
 from enum import Enum
-from typing import Union
+from typing import Optional, Union, cast
 
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient, SearchIndexerClient
 
+from .localsearch import LocalSearchClient
+
 USER_AGENT = "azure-search-chat-demo/1.0.0"
 
 
@@ -16,12 +18,22 @@ class SearchInfo:
     To learn more, please visit https://learn.microsoft.com/azure/search/search-what-is-azure-search
     """
 
-    def __init__(self, endpoint: str, credential: Union[AsyncTokenCredential, AzureKeyCredential], index_name: str):
+    def __init__(
+        self,
+        endpoint: str,
+        credential: Union[AsyncTokenCredential, AzureKeyCredential],
+        index_name: str,
+        local_search_path: Optional[str] = None,
+    ):
         self.endpoint = endpoint
         self.credential = credential
         self.index_name = index_name
+        # When set, documents are indexed in a LocalSearchClient stored in this folder instead of Azure AI Search
+        self.local_search_path = local_search_path
 
     def create_search_client(self) -> SearchClient:
+        if self.local_search_path:
+            return cast(SearchClient, LocalSearchClient(self.local_search_path, self.index_name))
         return SearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential)
 
     def create_search_index_client(self) -> SearchIndexClient:
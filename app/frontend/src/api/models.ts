@@ -32,6 +32,13 @@ export type ChatAppRequestOverrides = {
     use_oid_security_filter?: boolean;
     use_groups_security_filter?: boolean;
     use_gpt4v?: boolean;
+    speculative_retrieval?: boolean;
+    query_variants?: number;
+    retrieval_budget_ms?: number;
+    compress_sources?: boolean;
+    always_rewrite_query?: boolean;
+    include_vectors?: boolean;
+    bypass_cache?: boolean;
     gpt4v_input?: GPT4VInput;
     vector_fields: VectorFieldOptions[];
 };
@@ -84,15 +84,19 @@ const Chat = () => {
         let answer: string = "";
         let askResponse: ChatAppResponse = {} as ChatAppResponse;
 
+        const showResponse = () => {
+            const latestResponse: ChatAppResponse = {
+                ...askResponse,
+                choices: [{ ...askResponse.choices[0], message: { content: answer, role: askResponse.choices[0].message.role } }]
+            };
+            setIsLoading(false);
+            setStreamedAnswers([...answers, [question, latestResponse]]);
+        };
         const updateState = (newContent: string) => {
             return new Promise(resolve => {
                 setTimeout(() => {
                     answer += newContent;
-                    const latestResponse: ChatAppResponse = {
-                        ...askResponse,
-                        choices: [{ ...askResponse.choices[0], message: { content: answer, role: askResponse.choices[0].message.role } }]
-                    };
-                    setStreamedAnswers([...answers, [question, latestResponse]]);
+                    showResponse();
                     resolve(null);
                 }, 33);
             });
@@ -103,12 +107,24 @@ const Chat = () => {
                 if (event["choices"] && event["choices"][0]["context"] && event["choices"][0]["context"]["data_points"]) {
                     event["choices"][0]["message"] = event["choices"][0]["delta"];
                     askResponse = event as ChatAppResponse;
+                    showResponse();
                 } else if (event["choices"] && event["choices"][0]["delta"]["content"]) {
-                    setIsLoading(false);
                     await updateState(event["choices"][0]["delta"]["content"]);
+                } else if (event["choices"] && event["choices"][0]["context"] && !askResponse.choices) {
+                    // The thought of a stage that completed before the data points, shown while the next stage runs
+                    event["choices"][0]["message"] = event["choices"][0]["delta"];
+                    askResponse = event as ChatAppResponse;
+                    showResponse();
                 } else if (event["choices"] && event["choices"][0]["context"]) {
-                    // Update context with new keys from latest event
-                    askResponse.choices[0].context = { ...askResponse.choices[0].context, ...event["choices"][0]["context"] };
+                    // Update context with new keys from latest event, the thoughts of the stages are added up
+                    const context = askResponse.choices[0].context;
+                    const thoughts = event["choices"][0]["context"]["thoughts"];
+                    askResponse.choices[0].context = {
+                        ...context,
+                        ...event["choices"][0]["context"],
+                        thoughts: thoughts ? [...(context.thoughts ?? []), ...thoughts] : context.thoughts
+                    };
+                    showResponse();
                 } else if (event["error"]) {
                     throw Error(event["error"]);
                 }
@@ -272,6 +288,9 @@ const Chat = () => {
         setSelectedAnswer(index);
     };
 
+    // The thoughts of the answer being streamed can be opened before it is complete
+    const displayedAnswers = isStreaming ? streamedAnswers : answers;
+
     const onToggleTab = (tab: AnalysisPanelTabs, index: number) => {
         if (activeAnalysisPanelTab === tab && selectedAnswer === index) {
             setActiveAnalysisPanelTab(undefined);
@@ -368,13 +387,13 @@ const Chat = () => {
                     </div>
                 </div>
 
-                {answers.length > 0 && activeAnalysisPanelTab && (
+                {displayedAnswers.length > selectedAnswer && activeAnalysisPanelTab && (
                     <AnalysisPanel
                         className={styles.chatAnalysisPanel}
                         activeCitation={activeCitation}
                         onActiveTabChanged={x => onToggleTab(x, selectedAnswer)}
                         citationHeight="810px"
-                        answer={answers[selectedAnswer][1]}
+                        answer={displayedAnswers[selectedAnswer][1]}
                         activeTab={activeAnalysisPanelTab}
                     />
                 )}
@@ -0,0 +1,6 @@
+ #!/bin/sh
+
+. ./scripts/loadenv.sh
+
+echo "Running compareindexprofiles.py. Arguments to script: $@"
+  ./.venv/bin/python ./app/backend/compareindexprofiles.py --searchservice "$AZURE_SEARCH_SERVICE" --index "$AZURE_SEARCH_INDEX" $@
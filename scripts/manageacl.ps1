@@ -9,5 +9,12 @@ if (Test-Path -Path "/usr") {
   $venvPythonPath = "./.venv/bin/python"
 }
 
+if ($env:SEARCH_CACHE_PATH) {
+  $searchCachePathArg = "--search-cache-path $env:SEARCH_CACHE_PATH"
+}
+
+# manageacl.py shares the search cache code of the backend, to invalidate its cached results
+$env:PYTHONPATH = "./app/backend"
+
 Write-Host "Running manageacl.py. Arguments to script: $args"
-Start-Process -FilePath $venvPythonPath -ArgumentList "./scripts/manageacl.py --search-service $env:AZURE_SEARCH_SERVICE --index $env:AZURE_SEARCH_INDEX $args" -Wait -NoNewWindow
+Start-Process -FilePath $venvPythonPath -ArgumentList "./scripts/manageacl.py --search-service $env:AZURE_SEARCH_SERVICE --index $env:AZURE_SEARCH_INDEX $searchCachePathArg $args" -Wait -NoNewWindow
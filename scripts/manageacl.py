@@ -2,7 +2,7 @@ import argparse
 import asyncio
 import json
 import logging
-from typing import Any, Union
+from typing import Any, Optional, Union
 
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
@@ -14,6 +14,8 @@ from azure.search.documents.indexes.models import (
     SimpleField,
 )
 
+from core.cache import CacheGeneration, SqliteCacheBackend
+
 
 class ManageAcl:
     """
@@ -29,6 +31,7 @@ class ManageAcl:
         acl_type: str,
         acl: str,
         credentials: Union[AsyncTokenCredential, AzureKeyCredential],
+        search_cache_path: Optional[str] = None,
     ):
         """
         Initializes the command
@@ -49,6 +52,8 @@ class ManageAcl:
             The actual value of the acl, if the acl action is add or remove
         credentials
             Credentials for the azure search service
+        search_cache_path
+            Path to the SQLite file of the app's shared search cache (SEARCH_CACHE_PATH), whose cached results are invalidated once the acls are updated
         """
         self.service_name = service_name
         self.index_name = index_name
@@ -57,6 +62,7 @@ class ManageAcl:
         self.acl_action = acl_action
         self.acl_type = acl_type
         self.acl = acl
+        self.search_cache_path = search_cache_path
 
     async def run(self):
         endpoint = f"https://{self.service_name}.search.windows.net"
@@ -79,6 +85,17 @@ class ManageAcl:
                 raise Exception(f"Unknown action {self.acl_action}")
 
             logging.info("ACLs updated")
+        if self.acl_action != "view":
+            self.invalidate_search_cache()
+
+    def invalidate_search_cache(self):
+        # The security filter of cached search results was evaluated against the previous acls
+        if not self.search_cache_path:
+            return
+        search_cache_backend = SqliteCacheBackend(self.search_cache_path)
+        generation = CacheGeneration("search", shared_backend=search_cache_backend).increment()
+        search_cache_backend.close()
+        logging.info("Search cache generation is now %d", generation)
 
     async def view_acl(self, search_client: SearchClient):
         async for document in await self.get_documents(search_client):
@@ -162,6 +179,7 @@ async def main(args: Any):
         acl_type=args.acl_type,
         acl=args.acl,
         credentials=search_credential,
+        search_cache_path=args.search_cache_path,
     )
     await command.run()
 
@@ -198,6 +216,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--tenant-id", required=False, help="Optional. Use this to define the Azure directory where to authenticate)"
     )
+    parser.add_argument(
+        "--search-cache-path",
+        required=False,
+        help="Optional. Path to the SQLite file of the app's shared search cache (SEARCH_CACHE_PATH), whose cached results are invalidated once the acls are updated",
+    )
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     args = parser.parse_args()
     if args.verbose:
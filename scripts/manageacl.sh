@@ -2,5 +2,10 @@
 
 . ./scripts/loadenv.sh
 
+if [ -n "$SEARCH_CACHE_PATH" ]; then
+  searchCachePathArg="--search-cache-path $SEARCH_CACHE_PATH"
+fi
+
 echo "Running manageacl.py. Arguments to script: $@"
-  ./.venv/bin/python ./scripts/manageacl.py --search-service "$AZURE_SEARCH_SERVICE" --index "$AZURE_SEARCH_INDEX" $@
+# manageacl.py shares the search cache code of the backend, to invalidate its cached results
+  PYTHONPATH=./app/backend ./.venv/bin/python ./scripts/manageacl.py --search-service "$AZURE_SEARCH_SERVICE" --index "$AZURE_SEARCH_INDEX" $searchCachePathArg $@
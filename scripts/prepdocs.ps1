@@ -27,6 +27,16 @@ if ($env:AZURE_USE_AUTHENTICATION) {
 if ($env:AZURE_SEARCH_ANALYZER_NAME) {
   $searchAnalyzerNameArg = "--searchanalyzername $env:AZURE_SEARCH_ANALYZER_NAME"
 }
+
+if ($env:AZURE_SEARCH_INDEX_PROFILE) {
+  $indexProfileArg = "--indexprofile $env:AZURE_SEARCH_INDEX_PROFILE"
+}
+if ($env:SEARCH_CACHE_PATH) {
+  $searchCachePathArg = "--searchcachepath $env:SEARCH_CACHE_PATH"
+}
+if ($env:LOCAL_SEARCH_PATH) {
+  $localSearchPathArg = "--localsearchpath $env:LOCAL_SEARCH_PATH"
+}
 if ($env:AZURE_VISION_ENDPOINT) {
   $visionEndpointArg = "--visionendpoint $env:AZURE_VISION_ENDPOINT"
 }
@@ -74,7 +84,7 @@ $argumentList = "./app/backend/prepdocs.py $dataArg --verbose " + `
 "--subscriptionid $env:AZURE_SUBSCRIPTION_ID " + `
 "--storageaccount $env:AZURE_STORAGE_ACCOUNT --container $env:AZURE_STORAGE_CONTAINER --storageresourcegroup $env:AZURE_STORAGE_RESOURCE_GROUP " + `
 "--searchservice $env:AZURE_SEARCH_SERVICE --index $env:AZURE_SEARCH_INDEX " + `
-"$searchAnalyzerNameArg $searchSecretNameArg " + `
+"$searchAnalyzerNameArg $searchSecretNameArg $indexProfileArg $searchCachePathArg $localSearchPathArg " + `
 "--openaihost `"$env:OPENAI_HOST`" --openaimodelname `"$env:AZURE_OPENAI_EMB_MODEL_NAME`" $openaiDimensionsArg " + `
 "--openaiservice `"$env:AZURE_OPENAI_SERVICE`" --openaideployment `"$env:AZURE_OPENAI_EMB_DEPLOYMENT`" " + `
 "--openaikey `"$env:OPENAI_API_KEY`" --openaiorg `"$env:OPENAI_ORGANIZATION`" " + `
@@ -21,6 +21,18 @@ if [ -n "$AZURE_SEARCH_ANALYZER_NAME" ]; then
   searchAnalyzerNameArg="--searchanalyzername $AZURE_SEARCH_ANALYZER_NAME"
 fi
 
+if [ -n "$AZURE_SEARCH_INDEX_PROFILE" ]; then
+  indexProfileArg="--indexprofile $AZURE_SEARCH_INDEX_PROFILE"
+fi
+
+if [ -n "$SEARCH_CACHE_PATH" ]; then
+  searchCachePathArg="--searchcachepath $SEARCH_CACHE_PATH"
+fi
+
+if [ -n "$LOCAL_SEARCH_PATH" ]; then
+  localSearchPathArg="--localsearchpath $LOCAL_SEARCH_PATH"
+fi
+
 if [ -n "$AZURE_USE_AUTHENTICATION" ]; then
   aclArg="--useacls"
 fi
@@ -72,7 +84,7 @@ fi
 --subscriptionid $AZURE_SUBSCRIPTION_ID  \
 --storageaccount "$AZURE_STORAGE_ACCOUNT" --container "$AZURE_STORAGE_CONTAINER" --storageresourcegroup $AZURE_STORAGE_RESOURCE_GROUP \
 --searchservice "$AZURE_SEARCH_SERVICE" --index "$AZURE_SEARCH_INDEX" \
-$searchAnalyzerNameArg $searchSecretNameArg \
+$searchAnalyzerNameArg $searchSecretNameArg $indexProfileArg $searchCachePathArg $localSearchPathArg \
 --openaihost "$OPENAI_HOST" --openaimodelname "$AZURE_OPENAI_EMB_MODEL_NAME" $openAiDimensionsArg \
 --openaiservice "$AZURE_OPENAI_SERVICE" --openaideployment "$AZURE_OPENAI_EMB_DEPLOYMENT"  \
 --openaikey "$OPENAI_API_KEY" --openaiorg "$OPENAI_ORGANIZATION" \
@@ -23,6 +23,7 @@ from openai.types.create_embedding_response import Usage
 
 import app
 import core
+from approaches.approach import Approach
 from core.authentication import AuthenticationHelper
 
 from .mocks import (
@@ -49,6 +50,12 @@ async def mock_search(self, *args, **kwargs):
     return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"))
 
 
+@pytest.fixture(autouse=True)
+def mock_elapsed_ms(monkeypatch):
+    # The timings reported in the thoughts would otherwise change from run to run, and break the snapshots
+    monkeypatch.setattr(Approach, "elapsed_ms", staticmethod(lambda start: 0.0))
+
+
 @pytest.fixture
 def mock_get_secret(monkeypatch):
     monkeypatch.setattr(SecretClient, "get_secret", MockKeyVaultSecretClient().get_secret)
@@ -176,7 +183,7 @@ def mock_openai_chatcompletion(monkeypatch):
             answer = "From the provided sources, the impact of interest rates and GDP growth on financial markets can be observed through the line graph. [Financial Market Analysis Report 2023-7.png]"
         else:
             answer = "The capital of France is Paris. [Benefit_Options-2.pdf]."
-            if messages[0]["content"].find("Generate 3 very brief follow-up questions") > -1:
+            if messages[0]["content"].find("Gere 3 perguntas de acompanhamento") > -1:
                 answer = "The capital of France is Paris. [Benefit_Options-2.pdf]. <<What is the capital of Spain?>>"
         if "stream" in kwargs and kwargs["stream"] is True:
             return AsyncChatCompletionIterator(answer)
@@ -39,6 +39,14 @@ class MockBlob:
         buffer.write(b"test")
 
 
+class MockIndexingResult:
+    def __init__(self, key: str, succeeded: bool = True, status_code: int = 201, error_message: Optional[str] = None):
+        self.key = key
+        self.succeeded = succeeded
+        self.status_code = status_code
+        self.error_message = error_message
+
+
 class MockKeyVaultSecret:
     def __init__(self, value):
         self.value = value
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+import time
 from unittest import mock
 
 import pytest
@@ -9,6 +10,7 @@ from httpx import Request, Response
 from openai import BadRequestError
 
 import app
+from core.streaming import StreamDelta
 
 
 def fake_response(http_code):
@@ -693,3 +695,38 @@ async def test_format_as_ndjson():
 
     result = [line async for line in app.format_as_ndjson(gen())]
     assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_deltas():
+    async def gen():
+        yield {"choices": [{"delta": {"role": "assistant"}, "context": {"data_points": {"text": []}}}]}
+        yield StreamDelta("The capital ")
+        yield StreamDelta("of France is Paris.")
+
+    result = [line async for line in app.format_as_ndjson(gen(), coalesce_ms=50)]
+    assert result == [
+        '{"choices": [{"delta": {"role": "assistant"}, "context": {"data_points": {"text": []}}}]}\n',
+        '{"choices": [{"delta": {"content": "The capital of France is Paris."}}]}\n',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_time_to_first_byte(monkeypatch):
+    time_to_first_byte = mock.Mock()
+    time_to_first_token = mock.Mock()
+    monkeypatch.setattr(app, "time_to_first_byte", time_to_first_byte)
+    monkeypatch.setattr(app, "time_to_first_token", time_to_first_token)
+
+    async def gen():
+        yield {"choices": [{"delta": {"role": "assistant"}, "context": {"thoughts": []}}]}
+        yield StreamDelta("The capital ")
+        yield StreamDelta("of France is Paris.")
+
+    start_time = time.perf_counter()
+    [line async for line in app.format_as_ndjson(gen(), start_time=start_time)]
+
+    # Each metric is only recorded once per stream
+    time_to_first_byte.record.assert_called_once()
+    time_to_first_token.record.assert_called_once()
+    assert 0 <= time_to_first_byte.record.call_args[0][0] <= time_to_first_token.record.call_args[0][0]
@@ -3,6 +3,8 @@ import sys
 from tempfile import NamedTemporaryFile
 
 import pytest
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobProperties, UserDelegationKey
 
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.listfilestrategy import File
@@ -10,6 +12,24 @@ from prepdocslib.listfilestrategy import File
 from .mocks import MockAzureCredential
 
 
+class MockAsyncIterator:
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.items:
+            return self.items.pop(0)
+        raise StopAsyncIteration
+
+
+class MockResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
 @pytest.fixture
 def blob_manager(monkeypatch):
     return BlobManager(
@@ -49,7 +69,7 @@ async def test_upload_and_remove(monkeypatch, mock_env, blob_manager):
 
             class AsyncBlobItemsIterator:
                 def __init__(self, file):
-                    self.files = [file, "dontdelete.pdf"]
+                    self.files = [file, file.split(".pdf")[0] + "-0.png", "dontdelete.pdf"]
 
                 def __aiter__(self):
                     return self
@@ -63,13 +83,16 @@ async def test_upload_and_remove(monkeypatch, mock_env, blob_manager):
 
         monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.list_blob_names", mock_list_blob_names)
 
-        async def mock_delete_blob(self, name, *args, **kwargs):
-            assert name == filename
-            return True
+        deleted_blobs = []
+
+        async def mock_delete_blobs(self, *names, **kwargs):
+            deleted_blobs.extend(names)
+            return MockAsyncIterator([MockResponse(202) for _ in names])
 
-        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blob", mock_delete_blob)
+        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blobs", mock_delete_blobs)
 
         await blob_manager.remove_blob(f.content.name)
+        assert sorted(deleted_blobs) == sorted([filename, filename.split(".pdf")[0] + "-0.png"])
 
 
 @pytest.mark.asyncio
@@ -113,13 +136,16 @@ async def test_upload_and_remove_all(monkeypatch, mock_env, blob_manager):
 
         monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.list_blob_names", mock_list_blob_names)
 
-        async def mock_delete_blob(self, name, *args, **kwargs):
-            assert name == filename
-            return True
+        deleted_blobs = []
 
-        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blob", mock_delete_blob)
+        async def mock_delete_blobs(self, *names, **kwargs):
+            deleted_blobs.extend(names)
+            return MockAsyncIterator([MockResponse(202) for _ in names])
+
+        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blobs", mock_delete_blobs)
 
         await blob_manager.remove_blob()
+        assert deleted_blobs == [filename]
 
 
 @pytest.mark.asyncio
@@ -149,6 +175,42 @@ async def test_create_container_upon_upload(monkeypatch, mock_env, blob_manager)
         await blob_manager.upload_blob(f)
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_container_checked_once(monkeypatch, mock_env, blob_manager):
+    calls = {"exists": 0, "create_container": 0, "upload_blob": 0}
+
+    async def mock_exists(*args, **kwargs):
+        calls["exists"] += 1
+        return False
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    async def mock_create_container(*args, **kwargs):
+        calls["create_container"] += 1
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.create_container", mock_create_container)
+
+    async def mock_upload_blob(self, name, *args, **kwargs):
+        calls["upload_blob"] += 1
+        assert kwargs["max_concurrency"] == blob_manager.max_concurrency
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    with NamedTemporaryFile(suffix=".pdf") as temp_file1, NamedTemporaryFile(suffix=".pdf") as temp_file2:
+        await blob_manager.upload_blob(File(temp_file1.file))
+        container_client = blob_manager.container_client
+        await blob_manager.upload_blob(File(temp_file2.file))
+        assert blob_manager.container_client is container_client
+
+    assert calls == {"exists": 1, "create_container": 1, "upload_blob": 2}
+
+    await blob_manager.close()
+    assert blob_manager.service_client is None
+    assert blob_manager.container_client is None
+
+
 @pytest.mark.asyncio
 @pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
 async def test_upload_blob_no_image(monkeypatch, mock_env, caplog):
@@ -191,14 +253,233 @@ async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
 
     monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
 
-    async def mock_delete_blob(*args, **kwargs):
-        assert False, "delete_blob() shouldn't have been called"
+    async def mock_delete_blobs(*args, **kwargs):
+        assert False, "delete_blobs() shouldn't have been called"
 
-    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blob", mock_delete_blob)
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blobs", mock_delete_blobs)
 
     await blob_manager.remove_blob()
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_remove_all_in_batches(monkeypatch, mock_env, blob_manager, caplog):
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    blob_names = [f"doc{i}-0.png" for i in range(600)]
+
+    def mock_list_blob_names(*args, **kwargs):
+        return MockAsyncIterator(blob_names)
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.list_blob_names", mock_list_blob_names)
+
+    batches = []
+
+    async def mock_delete_blobs(self, *names, **kwargs):
+        assert kwargs["raise_on_any_failure"] is False
+        batches.append(names)
+        # One of the blobs was already deleted by someone else, and one fails
+        return MockAsyncIterator([MockResponse({0: 404, 1: 500}.get(i, 202)) for i in range(len(names))])
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blobs", mock_delete_blobs)
+
+    with caplog.at_level("INFO"):
+        await blob_manager.remove_blob()
+    assert [len(batch) for batch in batches] == [256, 256, 88]
+    assert sorted(name for batch in batches for name in batch) == sorted(blob_names)
+    assert "Removed 597 blobs, 3 failed" in caplog.text
+
+
+def test_blob_names_matcher():
+    matches = BlobManager.blob_names_matcher("data/foo.pdf")
+    assert matches("foo.pdf")
+    assert matches("foo-0.png")
+    assert matches("foo-12.jpg")
+    assert matches("foo-3.webp")
+    assert matches("foo-3.pdf")
+    assert not matches("foo-bar.pdf")
+    assert not matches("foo-1.png.bak")
+    assert not matches("foo.docx")
+    assert not matches("foobar-1.png")
+    # Regex characters in file names are matched literally
+    matches = BlobManager.blob_names_matcher("a+b (1).pdf")
+    assert matches("a+b (1)-0.png")
+    assert not matches("aab (1)-0.png")
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_upload_pdf_blob_images_jpeg(monkeypatch, mock_env):
+    blob_manager = BlobManager(
+        endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        container=os.environ["AZURE_STORAGE_CONTAINER"],
+        account=os.environ["AZURE_STORAGE_ACCOUNT"],
+        resourceGroup=os.environ["AZURE_STORAGE_RESOURCE_GROUP"],
+        subscriptionId=os.environ["AZURE_SUBSCRIPTION_ID"],
+        store_page_images=True,
+        image_format="jpeg",
+        image_quality=60,
+        image_dpi=144,
+        image_max_dimension=1000,
+    )
+
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    uploaded_images = {}
+
+    class MockUploadedBlobClient:
+        def __init__(self, name):
+            self.account_name = os.environ["AZURE_STORAGE_ACCOUNT"]
+            self.container_name = os.environ["AZURE_STORAGE_CONTAINER"]
+            self.blob_name = name
+            self.url = f"https://test.blob.core.windows.net/{name}"
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        if name.endswith(".jpg"):
+            assert kwargs["content_settings"].content_type == "image/jpeg"
+            uploaded_images[name] = data.read()
+        return MockUploadedBlobClient(name)
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    async def mock_get_user_delegation_key(*args, **kwargs):
+        key = UserDelegationKey()
+        key.signed_oid = "oid"
+        key.signed_tid = "tid"
+        key.signed_start = "2024-01-01T00:00:00Z"
+        key.signed_expiry = "2024-01-02T00:00:00Z"
+        key.signed_service = "b"
+        key.signed_version = "2021-08-06"
+        key.value = "dGVzdGtleQ=="
+        return key
+
+    monkeypatch.setattr(
+        "azure.storage.blob.aio.BlobServiceClient.get_user_delegation_key", mock_get_user_delegation_key
+    )
+
+    with open("tests/test-data/ja_RTL_TopToBottom_Test.pdf", "rb") as pdf_file:
+        page_images = await blob_manager.upload_blob(File(pdf_file))
+
+    assert page_images is not None
+    assert [page_image.blob_name for page_image in page_images] == [
+        "ja_RTL_TopToBottom_Test-0.jpg",
+        "ja_RTL_TopToBottom_Test-1.jpg",
+    ]
+    for page_image in page_images:
+        assert page_image.url.startswith(f"https://test.blob.core.windows.net/{page_image.blob_name}?")
+        # Landscape page rendered at 144 DPI is 1684px wide, so it is scaled down to the max dimension
+        assert page_image.width == 1000
+        # Scaled page height plus the 40px source file name banner
+        assert page_image.height == 707 + 40
+        assert uploaded_images[page_image.blob_name][:3] == b"\xff\xd8\xff"
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_upload_blob_skip_unchanged(monkeypatch, mock_env):
+    blob_manager = BlobManager(
+        endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        container=os.environ["AZURE_STORAGE_CONTAINER"],
+        account=os.environ["AZURE_STORAGE_ACCOUNT"],
+        resourceGroup=os.environ["AZURE_STORAGE_RESOURCE_GROUP"],
+        subscriptionId=os.environ["AZURE_SUBSCRIPTION_ID"],
+        store_page_images=True,
+        skip_unchanged=True,
+    )
+
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    # Stand-in for the storage account, keeping the metadata and size of each uploaded blob
+    stored_blobs = {}
+    uploaded_names = []
+
+    async def mock_get_blob_properties(self, *args, **kwargs):
+        if self.blob_name not in stored_blobs:
+            raise ResourceNotFoundError()
+        properties = BlobProperties()
+        properties.metadata, properties.size = stored_blobs[self.blob_name]
+        return properties
+
+    monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        uploaded_names.append(name)
+        stored_blobs[name] = (kwargs["metadata"], len(data.read()))
+        return self.get_blob_client(name)
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    async def mock_get_user_delegation_key(*args, **kwargs):
+        key = UserDelegationKey()
+        key.signed_oid = "oid"
+        key.signed_tid = "tid"
+        key.signed_start = "2024-01-01T00:00:00Z"
+        key.signed_expiry = "2024-01-02T00:00:00Z"
+        key.signed_service = "b"
+        key.signed_version = "2021-08-06"
+        key.value = "dGVzdGtleQ=="
+        return key
+
+    monkeypatch.setattr(
+        "azure.storage.blob.aio.BlobServiceClient.get_user_delegation_key", mock_get_user_delegation_key
+    )
+
+    with open("tests/test-data/ja_RTL_TopToBottom_Test.pdf", "rb") as pdf_file:
+        first_page_images = await blob_manager.upload_blob(File(pdf_file))
+    assert uploaded_names == [
+        "ja_RTL_TopToBottom_Test.pdf",
+        "ja_RTL_TopToBottom_Test-0.png",
+        "ja_RTL_TopToBottom_Test-1.png",
+    ]
+    assert stored_blobs["ja_RTL_TopToBottom_Test.pdf"][0] == {
+        "md5": BlobManager.file_md5("tests/test-data/ja_RTL_TopToBottom_Test.pdf")
+    }
+    assert blob_manager.skipped_blobs == 0
+
+    uploaded_names.clear()
+    with open("tests/test-data/ja_RTL_TopToBottom_Test.pdf", "rb") as pdf_file:
+        second_page_images = await blob_manager.upload_blob(File(pdf_file))
+    assert uploaded_names == []
+    assert blob_manager.skipped_blobs == 3
+    assert blob_manager.skipped_bytes == sum(size for _, size in stored_blobs.values())
+    assert first_page_images is not None and second_page_images is not None
+    assert [(image.blob_name, image.width, image.height) for image in second_page_images] == [
+        (image.blob_name, image.width, image.height) for image in first_page_images
+    ]
+
+    # Page images rendered with different settings are regenerated even though the source file is unchanged
+    blob_manager.image_dpi = 144
+    with open("tests/test-data/ja_RTL_TopToBottom_Test.pdf", "rb") as pdf_file:
+        await blob_manager.upload_blob(File(pdf_file))
+    assert uploaded_names == ["ja_RTL_TopToBottom_Test-0.png", "ja_RTL_TopToBottom_Test-1.png"]
+
+    await blob_manager.close()
+
+
+def test_unsupported_image_format(mock_env):
+    with pytest.raises(ValueError, match="Unsupported page image format"):
+        BlobManager(
+            endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            container=os.environ["AZURE_STORAGE_CONTAINER"],
+            account=os.environ["AZURE_STORAGE_ACCOUNT"],
+            resourceGroup=os.environ["AZURE_STORAGE_RESOURCE_GROUP"],
+            subscriptionId=os.environ["AZURE_SUBSCRIPTION_ID"],
+            image_format="gif",
+        )
+
+
 def test_get_managed_identity_connection_string(mock_env, blob_manager):
     assert (
         blob_manager.get_managedidentity_connectionstring()
@@ -214,3 +495,9 @@ def test_sourcepage_from_file_page():
 def test_blob_name_from_file_name():
     assert BlobManager.blob_name_from_file_name("tmp/test.pdf") == "test.pdf"
     assert BlobManager.blob_name_from_file_name("tmp/test.html") == "test.html"
+
+
+def test_blob_image_name_from_file_page():
+    assert BlobManager.blob_image_name_from_file_page("tmp/test.pdf", 0) == "test-0.png"
+    assert BlobManager.blob_image_name_from_file_page("tmp/test.pdf", 2, "jpeg") == "test-2.jpg"
+    assert BlobManager.blob_image_name_from_file_page("tmp/test.pdf", 2, "webp") == "test-2.webp"
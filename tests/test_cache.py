@@ -0,0 +1,70 @@
+from core.cache import CacheGeneration, SqliteCacheBackend, TTLCache
+
+
+def test_ttlcache_evicts_least_recently_used():
+    cache = TTLCache("test", max_size=2)
+    cache.set("a", b"1")
+    cache.set("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.set("c", b"3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1"
+    assert cache.get("c") == b"3"
+    assert cache.stats() == {"size": 2, "hits": 3, "shared_hits": 0, "misses": 1, "hit_rate": 0.75}
+
+
+def test_ttlcache_expires_entries(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.cache.time.monotonic", lambda: now)
+    cache = TTLCache("test", ttl=10)
+    cache.set("a", b"1")
+    assert cache.get("a") == b"1"
+
+    now = 1011.0
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_ttlcache_shared_backend(tmp_path):
+    path = str(tmp_path / "cache.db")
+    worker1 = TTLCache("test", shared_backend=SqliteCacheBackend(path))
+    worker2 = TTLCache("test", shared_backend=SqliteCacheBackend(path))
+
+    worker1.set("a", b"1")
+
+    assert worker2.get("a") == b"1"
+    assert worker2.get("a") == b"1"
+    assert worker2.stats() == {"size": 1, "hits": 1, "shared_hits": 1, "misses": 0, "hit_rate": 1.0}
+    worker1.shared_backend.close()
+    worker2.shared_backend.close()
+
+
+def test_sqlite_backend_expires_entries(tmp_path):
+    backend = SqliteCacheBackend(str(tmp_path / "cache.db"))
+    backend.set("a", b"1", ttl=-1)
+
+    assert backend.get("a") is None
+    backend.close()
+
+
+def test_ttlcache_generation(tmp_path):
+    backend = SqliteCacheBackend(str(tmp_path / "cache.db"))
+    cache = TTLCache("test", shared_backend=backend, generation=CacheGeneration("test", shared_backend=backend))
+    cache.set("a", b"1")
+    assert cache.get("a") == b"1"
+
+    # Another process, such as prepdocs, increments the generation after changing the index
+    CacheGeneration("test", shared_backend=SqliteCacheBackend(str(tmp_path / "cache.db"))).increment()
+
+    assert cache.get("a") is None
+    cache.set("a", b"2")
+    assert cache.get("a") == b"2"
+    backend.close()
+
+
+def test_cache_generation_without_backend():
+    generation = CacheGeneration("test")
+    assert generation.get() == 0
+    assert generation.increment() == 1
+    assert generation.get() == 1
@@ -1,11 +1,17 @@
+import asyncio
 import json
 
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
-from openai.types.chat import ChatCompletion
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
+from approaches.approach import Document, ThoughtStep
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.rewritepolicy import QueryRewritePolicy
+from core.authentication import AuthenticationHelper
+from core.cache import CacheGeneration, TTLCache
+from core.conversationstore import ConversationStore
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
@@ -302,14 +308,15 @@ def test_get_messages_from_history_few_shots(chat_approach):
         max_tokens=chat_approach.chatgpt_token_limit - len(user_query_request),
         few_shots=chat_approach.query_prompt_few_shots,
     )
-    # Make sure messages are in the right order
+    # Make sure messages are in the right order: the system prompt, the 12 few-shot pairs, then the question
+    few_shots = chat_approach.query_prompt_few_shots
+    assert len(few_shots) == 24
+    assert len(messages) == len(few_shots) + 2
     assert messages[0]["role"] == "system"
-    assert messages[1]["role"] == "user"
-    assert messages[2]["role"] == "assistant"
-    assert messages[3]["role"] == "user"
-    assert messages[4]["role"] == "assistant"
-    assert messages[5]["role"] == "user"
-    assert messages[5]["content"] == user_query_request
+    assert [message["role"] for message in messages[1:-1]] == ["user", "assistant"] * 12
+    assert [message["content"] for message in messages[1:-1]] == [few_shot["content"] for few_shot in few_shots]
+    assert messages[-1]["role"] == "user"
+    assert messages[-1]["content"] == user_query_request
 
 
 @pytest.mark.asyncio
@@ -360,3 +367,416 @@ async def test_search_results_filtering_by_scores(
     assert (
         len(filtered_results) == expected_result_count
     ), f"Expected {expected_result_count} results with minimum_search_score={minimum_search_score} and minimum_reranker_score={minimum_reranker_score}"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "include_vectors, retrievable_fields, expected_select",
+    [
+        (False, None, ["id", "content", "category", "sourcepage", "sourcefile"]),
+        (True, None, ["id", "content", "category", "sourcepage", "sourcefile", "embedding"]),
+        # The vectors of a storage-optimized index aren't stored, so they can't be selected
+        (
+            True,
+            ["id", "content", "category", "sourcepage", "sourcefile"],
+            ["id", "content", "category", "sourcepage", "sourcefile"],
+        ),
+    ],
+)
+async def test_search_select(monkeypatch, chat_approach, include_vectors, retrievable_fields, expected_select):
+    search_kwargs = {}
+    chat_approach.retrievable_fields = retrievable_fields
+
+    async def mock_search_select(*args, **kwargs):
+        search_kwargs.update(kwargs)
+        return await mock_search(*args, **kwargs)
+
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    monkeypatch.setattr(SearchClient, "search", mock_search_select)
+
+    await chat_approach.search(
+        top=10,
+        query_text="test query",
+        filter=None,
+        vectors=[],
+        use_semantic_ranker=True,
+        use_semantic_captions=True,
+        minimum_search_score=None,
+        minimum_reranker_score=None,
+        include_vectors=include_vectors,
+    )
+
+    assert search_kwargs["select"] == expected_select
+
+
+@pytest.mark.asyncio
+async def test_search_cached(monkeypatch, chat_approach):
+    search_calls = []
+
+    async def mock_search_counted(*args, **kwargs):
+        search_calls.append(kwargs.get("filter"))
+        return await mock_search(*args, **kwargs)
+
+    generation = CacheGeneration("search")
+    chat_approach.search_cache = TTLCache("search", generation=generation)
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    monkeypatch.setattr(SearchClient, "search", mock_search_counted)
+
+    async def search(filter, use_cache=True):
+        return await chat_approach.search(
+            top=10,
+            query_text="test query",
+            filter=filter,
+            vectors=[],
+            use_semantic_ranker=True,
+            use_semantic_captions=True,
+            minimum_search_score=None,
+            minimum_reranker_score=None,
+            use_cache=use_cache,
+        )
+
+    first = await search("oids/any(g:search.in(g, 'OID_X'))")
+    second = await search("oids/any(g:search.in(g, 'OID_X'))")
+    assert [doc.serialize_for_results() for doc in first] == [doc.serialize_for_results() for doc in second]
+    assert len(search_calls) == 1
+
+    # Another user's security filter must not share the cached results
+    await search("oids/any(g:search.in(g, 'OID_Y'))")
+    assert len(search_calls) == 2
+
+    await search("oids/any(g:search.in(g, 'OID_X'))", use_cache=False)
+    assert len(search_calls) == 3
+
+    generation.increment()
+    await search("oids/any(g:search.in(g, 'OID_X'))")
+    assert len(search_calls) == 4
+
+
+def test_query_overlap(chat_approach):
+    assert chat_approach.query_overlap("capital of France", "What is the capital of France?") == 1.0
+    assert chat_approach.query_overlap("Capital of FRANCE", "what is the capital of france") == 1.0
+    assert chat_approach.query_overlap("capital of Spain", "What is the capital of France?") == 2 / 3
+    assert chat_approach.query_overlap("", "What is the capital of France?") == 1.0
+
+
+class MockChatCompletions:
+    def __init__(self, search_query):
+        self.search_query = search_query
+        self.chat = self
+        self.completions = self
+
+    async def create(self, *args, **kwargs):
+        return ChatCompletion.model_validate(
+            {
+                "id": "test",
+                "object": "chat.completion",
+                "created": 1,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": self.search_query},
+                    }
+                ],
+            }
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "search_query, expected_query, expected_reused",
+    [
+        ("capital of France", "What is the capital of France?", True),
+        ("Paris population", "Paris population", False),
+    ],
+)
+async def test_speculative_retrieval(monkeypatch, chat_approach, search_query, expected_query, expected_reused):
+    searched_queries = []
+
+    async def mock_search_recorded(*args, **kwargs):
+        searched_queries.append(kwargs.get("search_text"))
+        return await mock_search(*args, **kwargs)
+
+    chat_approach.openai_client = MockChatCompletions(search_query)
+    chat_approach.auth_helper = AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id=None,
+        server_app_secret=None,
+        client_app_id=None,
+        tenant_id=None,
+    )
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    monkeypatch.setattr(SearchClient, "search", mock_search_recorded)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the capital of France?"}],
+        {"retrieval_mode": "text", "speculative_retrieval": True},
+        {},
+    )
+    chat_coroutine.close()
+
+    # The speculative search may be cancelled before it is sent when the generated query is used instead
+    assert searched_queries[-1] == expected_query
+    assert searched_queries.count("What is the capital of France?") <= 1
+    search_thought = extra_info["thoughts"][1]
+    assert search_thought.props["speculative_retrieval"] is expected_reused
+    assert search_thought.description == expected_query
+
+
+@pytest.mark.asyncio
+async def test_query_rewrite_policy_skips_rewrite(monkeypatch, chat_approach):
+    class FailingChatCompletions(MockChatCompletions):
+        async def create(self, *args, **kwargs):
+            raise AssertionError("The search query should not be generated")
+
+    searched_queries = []
+
+    async def mock_search_recorded(*args, **kwargs):
+        searched_queries.append(kwargs.get("search_text"))
+        return await mock_search(*args, **kwargs)
+
+    chat_approach.openai_client = FailingChatCompletions("")
+    chat_approach.query_rewrite_policy = QueryRewritePolicy()
+    chat_approach.auth_helper = AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id=None,
+        server_app_secret=None,
+        client_app_id=None,
+        tenant_id=None,
+    )
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    monkeypatch.setattr(SearchClient, "search", mock_search_recorded)
+
+    with pytest.raises(AssertionError):
+        # The policy can't skip the rewrite of a follow-up question
+        await chat_approach.run_until_final_call(
+            [
+                {"role": "user", "content": "Qual é a capital da França?"},
+                {"role": "assistant", "content": "Paris"},
+                {"role": "user", "content": "Qual é a população dela?"},
+            ],
+            {"retrieval_mode": "text"},
+            {},
+        )
+
+    with pytest.raises(AssertionError):
+        # Nor the rewrite of a question that isn't in Portuguese, which is translated by the rewrite
+        await chat_approach.run_until_final_call(
+            [{"role": "user", "content": "What is the capital of France?"}], {"retrieval_mode": "text"}, {}
+        )
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "Qual é a capital da França?"}], {"retrieval_mode": "text"}, {}
+    )
+    chat_coroutine.close()
+
+    assert searched_queries == ["Qual é a capital da França?"]
+    assert [thought.title for thought in extra_info["thoughts"]] == [
+        "Query rewrite policy",
+        "Search using generated search query",
+        "Search results",
+        "Prompt to generate answer",
+    ]
+    assert extra_info["thoughts"][0].props["rewrite"] is False
+
+
+def make_document(id):
+    return Document(
+        id=id,
+        content=f"content {id}",
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        sourcepage=f"{id}.pdf",
+        sourcefile=f"{id}.pdf",
+        oids=None,
+        groups=None,
+        captions=[],
+    )
+
+
+def test_fuse_results(chat_approach):
+    first = [make_document("a"), make_document("b"), make_document("c")]
+    second = [make_document("c"), make_document("d"), make_document("b")]
+
+    fused = chat_approach.fuse_results([first, second], top=3)
+
+    # c and b are found by both queries, c ranks higher overall, then a beats d as it ranks first in its query
+    assert [document.id for document in fused] == ["c", "b", "a"]
+
+
+@pytest.mark.asyncio
+async def test_gather_within_budget(chat_approach):
+    async def search(id, delay):
+        await asyncio.sleep(delay)
+        return [make_document(id)]
+
+    async def failing_search():
+        raise ValueError("Search failed")
+
+    result_lists = await chat_approach.gather_within_budget(
+        [search("fast", 0), search("slow", 10), failing_search()], budget_ms=50
+    )
+    assert [[document.id for document in results] if results else None for results in result_lists] == [
+        ["fast"],
+        None,
+        None,
+    ]
+
+    # When no search finishes within the budget, the first one to finish is waited for
+    result_lists = await chat_approach.gather_within_budget([search("slow", 10), search("late", 0.1)], budget_ms=10)
+    assert result_lists[0] is None
+    assert [document.id for document in result_lists[1]] == ["late"]
+
+    with pytest.raises(ValueError):
+        await chat_approach.gather_within_budget([failing_search()], budget_ms=50)
+
+
+def test_get_search_queries(chat_approach):
+    chat_completion = ChatCompletion.model_validate(
+        {
+            "id": "test",
+            "object": "chat.completion",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "tool_calls",
+                    "message": {
+                        "role": "assistant",
+                        "tool_calls": [
+                            {
+                                "id": "call_1",
+                                "type": "function",
+                                "function": {
+                                    "name": "search_sources",
+                                    "arguments": json.dumps(
+                                        {"search_queries": ["multa contratual", "Multa Contratual", "cláusula penal"]}
+                                    ),
+                                },
+                            }
+                        ],
+                    },
+                }
+            ],
+        }
+    )
+
+    assert chat_approach.get_search_queries(chat_completion, "user query", 3) == ["multa contratual", "cláusula penal"]
+    assert chat_approach.get_search_queries(chat_completion, "user query", 1) == ["multa contratual"]
+
+
+@pytest.mark.asyncio
+async def test_query_variants(monkeypatch, chat_approach):
+    searched_queries = []
+
+    async def mock_search_recorded(*args, **kwargs):
+        searched_queries.append(kwargs.get("search_text"))
+        return await mock_search(*args, **kwargs)
+
+    chat_approach.openai_client = MockChatCompletions("Paris population\nFrance capital city\n0")
+    chat_approach.auth_helper = AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id=None,
+        server_app_secret=None,
+        client_app_id=None,
+        tenant_id=None,
+    )
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    monkeypatch.setattr(SearchClient, "search", mock_search_recorded)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the capital of France?"}],
+        {"retrieval_mode": "text", "query_variants": 3},
+        {},
+    )
+    chat_coroutine.close()
+
+    assert sorted(searched_queries) == ["France capital city", "Paris population"]
+    search_thought = extra_info["thoughts"][1]
+    assert search_thought.description == ["Paris population", "France capital city"]
+    assert search_thought.props["query_variants"] == 2
+    assert search_thought.props["searches_completed"] == 2
+    # The mock returns the same document for every query, so it is only kept once
+    assert len(extra_info["data_points"]["text"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_conversation_store_reuses_search_query(monkeypatch, chat_approach):
+    completions = []
+
+    class MockRecordedChatCompletions(MockChatCompletions):
+        async def create(self, *args, **kwargs):
+            completions.append(kwargs["messages"])
+            return await super().create(*args, **kwargs)
+
+    chat_approach.openai_client = MockRecordedChatCompletions("capital of France")
+    chat_approach.auth_helper = AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id=None,
+        server_app_secret=None,
+        client_app_id=None,
+        tenant_id=None,
+    )
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    chat_approach.conversation_store = ConversationStore()
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    messages = [{"role": "user", "content": "What is the capital of France?"}]
+    context = {"overrides": {"retrieval_mode": "text"}}
+
+    first = await chat_approach.run(messages, context=context)
+    # The answer is regenerated for the same question, so its search query is reused
+    second = await chat_approach.run(messages, session_state=first["choices"][0]["session_state"], context=context)
+
+    assert second["choices"][0]["session_state"] == first["choices"][0]["session_state"]
+    assert len(completions) == 3
+    search_thought = second["choices"][0]["context"]["thoughts"][0]
+    assert search_thought.description == "capital of France"
+    assert search_thought.props["reused_search_query"] is True
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_thoughts(chat_approach):
+    search_thought = ThoughtStep("Search results", [{"id": "file-a-0"}])
+    final_call_started = asyncio.Event()
+    release_final_call = asyncio.Event()
+
+    async def answer():
+        async def chunks():
+            yield ChatCompletionChunk.model_validate(
+                {
+                    "id": "test",
+                    "object": "chat.completion.chunk",
+                    "created": 1,
+                    "model": "gpt-35-turbo",
+                    "choices": [{"delta": {"content": "Paris"}, "index": 0, "finish_reason": None}],
+                }
+            )
+
+        return chunks()
+
+    async def run_until_final_call(*args, thought_listener=None, **kwargs):
+        thought_listener(search_thought)
+        final_call_started.set()
+        await release_final_call.wait()
+        return {"data_points": {"text": []}, "thoughts": [search_thought]}, answer()
+
+    chat_approach.run_until_final_call = run_until_final_call
+    stream = chat_approach.run_with_streaming([{"role": "user", "content": "Capital?"}], {}, {}, session_state="s")
+
+    # The thought is streamed while the following stages are still running
+    first_event = await stream.__anext__()
+    assert final_call_started.is_set() and not release_final_call.is_set()
+    assert first_event["choices"][0]["context"] == {"thoughts": [search_thought]}
+    assert first_event["choices"][0]["session_state"] == "s"
+    release_final_call.set()
+    events = [event async for event in stream]
+
+    assert events[0]["choices"][0]["context"] == {"data_points": {"text": []}, "thoughts": [search_thought]}
+    assert events[1]["choices"][0]["delta"]["content"] == "Paris"
@@ -1,5 +1,7 @@
+import asyncio
 import json
 
+import aiohttp
 import pytest
 from azure.search.documents.indexes.models import SearchField, SearchIndex
 from azure.search.documents.models import (
@@ -9,6 +11,7 @@ from openai.types.chat import ChatCompletion
 
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
 
 from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
 
@@ -146,3 +149,57 @@ async def test_compute_text_embedding(chat_approach, openai_client, mock_openai_
     assert result.vector == [0.0023064255, -0.009327292, -0.0028842222]
     assert result.k_nearest_neighbors == 50
     assert result.fields == "embedding"
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_cached(chat_approach, openai_client, mock_openai_embedding, monkeypatch):
+    mock_openai_embedding(openai_client)
+    create_calls = []
+    create = openai_client.embeddings.create
+
+    async def counting_create(*args, **kwargs):
+        create_calls.append(kwargs["input"])
+        return await create(*args, **kwargs)
+
+    monkeypatch.setattr(openai_client.embeddings, "create", counting_create)
+    chat_approach.embedding_cache = TTLCache("embeddings")
+
+    first = await chat_approach.compute_text_embedding("test  query")
+    second = await chat_approach.compute_text_embedding(" test query ")
+    await chat_approach.compute_text_embedding("test query", use_cache=False)
+
+    assert first.vector == second.vector == [0.0023064255, -0.009327292, -0.0028842222]
+    assert create_calls == ["test query", "test query"]
+    assert chat_approach.embedding_cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_compute_vectors(chat_approach, monkeypatch):
+    async def mock_compute_text_embedding(q, use_cache=True):
+        await asyncio.sleep(0.02)
+        return "text"
+
+    async def mock_compute_image_embedding(q, use_cache=True):
+        return "image"
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", mock_compute_image_embedding)
+
+    vectors = await chat_approach.compute_vectors("test query", ["embedding", "imageEmbedding"])
+
+    assert vectors == ["text", "image"]
+
+
+@pytest.mark.asyncio
+async def test_compute_image_embedding_vision_session(chat_approach, mock_compute_embeddings_call):
+    async def token_provider():
+        return "token"
+
+    chat_approach.vision_token_provider = token_provider
+    async with aiohttp.ClientSession() as vision_session:
+        chat_approach.vision_session = vision_session
+        first = await chat_approach.compute_image_embedding("test query", use_cache=False)
+        second = await chat_approach.compute_image_embedding("other query", use_cache=False)
+
+        assert first.fields == second.fields == "imageEmbedding"
+        assert not vision_session.closed
@@ -0,0 +1,80 @@
+from approaches.approach import Document
+from approaches.contextcompressor import ContextCompressor
+
+CONTRACT = (
+    "O presente contrato tem por objeto a locação do imóvel situado na Rua das Flores. "
+    "O prazo da locação é de 30 meses, conforme o art. 46 da Lei nº 8.245. "
+    "O aluguel mensal é de R$ 2.000,00, reajustado anualmente pelo IGP-M. "
+    "As despesas de condomínio ficam a cargo do locatário. "
+    "Em caso de rescisão antecipada, o locatário pagará multa de três aluguéis. "
+    "A multa será reduzida proporcionalmente ao tempo de contrato cumprido. "
+    "O locatário não poderá sublocar o imóvel sem autorização do locador. "
+    "Fica eleito o foro da comarca de São Paulo."
+)
+
+
+def test_split_sentences():
+    sentences = ContextCompressor.split_sentences(CONTRACT)
+
+    assert len(sentences) == 8
+    # Abbreviations followed by a number don't end a sentence
+    assert sentences[1] == "O prazo da locação é de 30 meses, conforme o art. 46 da Lei nº 8.245."
+
+
+def test_compress():
+    compressor = ContextCompressor(max_source_chars=250, neighbours=1)
+
+    compressed = compressor.compress("Qual é a multa por rescisão antecipada?", [CONTRACT, "Contrato curto."])
+
+    # The best matching sentence is kept with its neighbours
+    assert compressed[0] == (
+        "As despesas de condomínio ficam a cargo do locatário. "
+        "Em caso de rescisão antecipada, o locatário pagará multa de três aluguéis. "
+        "A multa será reduzida proporcionalmente ao tempo de contrato cumprido."
+    )
+    assert len(compressed[0]) < len(CONTRACT)
+    # Sources that already fit are kept as they are
+    assert compressed[1] == "Contrato curto."
+
+
+def test_compress_marks_omissions():
+    compressor = ContextCompressor(max_source_chars=250, neighbours=0)
+
+    compressed = compressor.compress("aluguel mensal e foro", [CONTRACT])
+
+    assert compressed == [
+        "O aluguel mensal é de R$ 2.000,00, reajustado anualmente pelo IGP-M. … "
+        "Fica eleito o foro da comarca de São Paulo."
+    ]
+
+
+def test_compress_without_matching_sentences():
+    compressor = ContextCompressor(max_source_chars=100, neighbours=0)
+
+    compressed = compressor.compress("embargos declaratórios", [CONTRACT])
+
+    assert compressed == ["O presente contrato tem por objeto a locação do imóvel situado na Rua das Flores."]
+
+
+def test_compress_results():
+    compressor = ContextCompressor(max_source_chars=250)
+    result = Document(
+        id="1",
+        content=CONTRACT,
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        sourcepage="contrato.pdf#page=2",
+        sourcefile="contrato.pdf",
+        oids=None,
+        groups=None,
+        captions=[],
+    )
+
+    compressed, props = compressor.compress_results("multa por rescisão", [result], "gpt-35-turbo")
+
+    assert compressed[0].sourcepage == "contrato.pdf#page=2"
+    assert compressed[0].content != CONTRACT
+    assert result.content == CONTRACT
+    assert props["compressed_tokens"] < props["original_tokens"]
+    assert props["compression_ms"] >= 0
@@ -0,0 +1,86 @@
+from core.cache import SqliteCacheBackend
+from core.conversationstore import Conversation, ConversationStore
+from core.modelhelper import token_count_cache
+
+
+def test_resume_new_session():
+    store = ConversationStore()
+
+    session_state, conversation = store.resume(None, [{"role": "user", "content": "Qual é a multa?"}], "oid1")
+
+    assert len(session_state) == 32
+    assert conversation.owner == "oid1"
+    assert conversation.messages == [{"role": "user", "content": "Qual é a multa?"}]
+    assert conversation.token_counts == [None]
+
+
+def test_resume_follow_up():
+    store = ConversationStore()
+    session_state, conversation = store.resume(None, [{"role": "user", "content": "Qual é a multa?"}], "oid1")
+    conversation.record_turn(["multa contrato"], 1, ["doc1"], "gpt-35-turbo")
+    conversation.add_answer("A multa é de três aluguéis.")
+    store.save(session_state, conversation)
+
+    messages = [
+        {"role": "user", "content": "Qual é a multa?"},
+        {"role": "assistant", "content": "A multa é de três aluguéis."},
+        {"role": "user", "content": "E o prazo?"},
+    ]
+    resumed_state, resumed = store.resume(session_state, messages, "oid1")
+
+    assert resumed_state == session_state
+    assert resumed.messages == messages
+    assert resumed.get_turn(0).search_queries == ["multa contrato"]
+    assert resumed.get_turn(0).doc_ids == ["doc1"]
+    assert resumed.get_turn(2) is None
+
+
+def test_resume_other_owner():
+    store = ConversationStore()
+    session_state, conversation = store.resume(None, [{"role": "user", "content": "Qual é a multa?"}], "oid1")
+    store.save(session_state, conversation)
+
+    other_state, other = store.resume(session_state, [{"role": "user", "content": "Qual é a multa?"}], "oid2")
+
+    assert other_state != session_state
+    assert other.owner == "oid2"
+
+
+def test_update_edited_history():
+    conversation = Conversation(owner=None)
+    conversation.update([{"role": "user", "content": "Qual é a multa?"}])
+    conversation.record_turn(["multa"], 1, [], "gpt-35-turbo")
+    conversation.add_answer("Três aluguéis.")
+
+    kept = conversation.update(
+        [
+            {"role": "user", "content": "Qual é o prazo?"},
+            {"role": "assistant", "content": "Três aluguéis."},
+        ]
+    )
+
+    # Everything after the first edited message is processed again
+    assert kept == 0
+    assert conversation.turns == []
+    assert conversation.messages[0]["content"] == "Qual é o prazo?"
+
+
+def test_shared_backend_token_counts(tmp_path):
+    path = str(tmp_path / "conversations.db")
+    worker1 = ConversationStore(shared_backend=SqliteCacheBackend(path))
+    worker2 = ConversationStore(shared_backend=SqliteCacheBackend(path))
+    question = "Quais são os requisitos da rescisão indireta do contrato de trabalho?"
+    session_state, conversation = worker1.resume(None, [{"role": "user", "content": question}], None)
+    token_count_cache.count(question, "gpt-35-turbo")
+    conversation.record_turn([question], 1, [], "gpt-35-turbo")
+    worker1.save(session_state, conversation)
+    expected_count = conversation.token_counts[0]
+    token_count_cache.clear()
+
+    _, resumed = worker2.resume(session_state, [{"role": "user", "content": question}], None)
+
+    # The counts stored by the other worker are reused instead of tokenizing the messages again
+    assert resumed.token_counts == [expected_count]
+    assert token_count_cache.get(question, "gpt-35-turbo") == expected_count
+    worker1.cache.shared_backend.close()
+    worker2.cache.shared_backend.close()
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+from approaches.conversationsummarizer import SUMMARY_HEADING, ConversationSummarizer
+from core.conversationstore import ConversationStore
+
+MESSAGES = [
+    {"role": "user", "content": "Qual é a multa por rescisão antecipada do contrato de locação da Rua das Flores?"},
+    {"role": "assistant", "content": "A multa é de três aluguéis, reduzida proporcionalmente ao tempo cumprido."},
+    {"role": "user", "content": "E qual é o prazo da locação?"},
+    {"role": "assistant", "content": "O prazo da locação é de 30 meses."},
+    {"role": "user", "content": "Quem paga o condomínio?"},
+]
+
+
+class MockSummaryCompletions:
+    def __init__(self):
+        self.chat = self
+        self.completions = self
+        self.requests: list[dict] = []
+
+    async def create(self, *args, **kwargs):
+        self.requests.append(kwargs)
+        return ChatCompletion.model_validate(
+            {
+                "id": "test",
+                "object": "chat.completion",
+                "created": 1,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": "Multa de três aluguéis, prazo de 30 meses."},
+                    }
+                ],
+            }
+        )
+
+
+def create_summarizer(store, trigger_tokens=10):
+    return ConversationSummarizer(
+        openai_client=MockSummaryCompletions(),  # type: ignore[arg-type]
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment=None,
+        conversation_store=store,
+        trigger_tokens=trigger_tokens,
+        keep_recent_messages=3,
+    )
+
+
+def test_get_summary_end():
+    store = ConversationStore()
+    _, conversation = store.resume(None, MESSAGES, None)
+
+    assert create_summarizer(store).get_summary_end(conversation) == 2
+    # The older messages are too short to be worth summarizing
+    assert create_summarizer(store, trigger_tokens=1000).get_summary_end(conversation) is None
+
+
+def test_get_summary_end_short_history():
+    store = ConversationStore()
+    _, conversation = store.resume(None, MESSAGES[:2], None)
+
+    # Fewer messages than are kept as is, so nothing can be summarized however long they are
+    assert create_summarizer(store, trigger_tokens=0).get_summary_end(conversation) is None
+
+    _, conversation = store.resume(None, MESSAGES, None)
+    conversation.summarized_count = 2
+
+    # The older messages are already summarized
+    assert create_summarizer(store, trigger_tokens=0).get_summary_end(conversation) is None
+
+
+@pytest.mark.asyncio
+async def test_schedule_refresh():
+    store = ConversationStore()
+    session_state, conversation = store.resume(None, MESSAGES, None)
+    store.save(session_state, conversation)
+    summarizer = create_summarizer(store)
+
+    summarizer.schedule_refresh(session_state, conversation)
+    # Only one refresh runs at a time for each session
+    summarizer.schedule_refresh(session_state, conversation)
+    await asyncio.gather(*summarizer.refreshes.values())
+
+    assert len(summarizer.openai_client.requests) == 1
+    assert MESSAGES[0]["content"] in summarizer.openai_client.requests[0]["messages"][1]["content"]
+    _, resumed = store.resume(session_state, MESSAGES, None)
+    assert resumed.summarized_count == 2
+    assert resumed.get_history() == [
+        {"role": "system", "content": SUMMARY_HEADING + "Multa de três aluguéis, prazo de 30 meses."},
+        *MESSAGES[2:],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_refresh_after_edit():
+    store = ConversationStore()
+    session_state, conversation = store.resume(None, MESSAGES, None)
+    # The conversation is edited while the summary is generated
+    edited = [{"role": "user", "content": "Qual é o foro do contrato?"}]
+    _, latest = store.resume(session_state, edited, None)
+    store.save(session_state, latest)
+
+    await create_summarizer(store).refresh(session_state, conversation, 2)
+
+    assert store.get(session_state).summary is None
+
+
+def test_update_discards_summary():
+    store = ConversationStore()
+    _, conversation = store.resume(None, MESSAGES, None)
+    conversation.summary = SUMMARY_HEADING + "Multa de três aluguéis."
+    conversation.summarized_count = 2
+
+    conversation.update([MESSAGES[0], {"role": "assistant", "content": "Não sei."}, *MESSAGES[2:]])
+
+    assert conversation.summary is None
+    assert conversation.get_history() == conversation.messages
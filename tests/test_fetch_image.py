@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 import aiohttp
@@ -11,7 +12,8 @@ from azure.core.pipeline.transport import (
 from azure.storage.blob.aio import BlobServiceClient
 
 from approaches.approach import Document
-from core.imageshelper import fetch_image
+from core import imageshelper
+from core.imageshelper import fetch_image, fetch_images
 
 from .mocks import MockAzureCredential
 
@@ -99,3 +101,54 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
     test_document.sourcepage = ""
     image_url = await fetch_image(blob_container_client, test_document)
     assert image_url is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_images(monkeypatch):
+    fetched = []
+    running = 0
+    max_running = 0
+
+    async def mock_fetch_image(blob_container_client, result):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        fetched.append(result.sourcepage)
+        return {"url": f"data:image/png;base64,{result.sourcepage}", "detail": "auto"}
+
+    def make_document(id, sourcepage):
+        return Document(
+            id=id,
+            content="test content",
+            embedding=[],
+            image_embedding=[],
+            category="",
+            sourcepage=sourcepage,
+            sourcefile="test.pdf",
+            oids=[],
+            groups=[],
+            captions=[],
+        )
+
+    monkeypatch.setattr(imageshelper, "fetch_image", mock_fetch_image)
+    results = [
+        make_document("1", "a.pdf#page=1"),
+        make_document("2", "a.pdf#page=2"),
+        make_document("3", "a.pdf#page=1"),
+        make_document("4", None),
+        make_document("5", "b.pdf#page=1"),
+    ]
+
+    images = await fetch_images(None, results, max_concurrency=2)
+
+    assert [image["url"] if image else None for image in images] == [
+        "data:image/png;base64,a.pdf#page=1",
+        "data:image/png;base64,a.pdf#page=2",
+        "data:image/png;base64,a.pdf#page=1",
+        None,
+        "data:image/png;base64,b.pdf#page=1",
+    ]
+    assert sorted(fetched) == ["a.pdf#page=1", "a.pdf#page=2", "b.pdf#page=1"]
+    assert max_running == 2
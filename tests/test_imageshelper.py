@@ -1,6 +1,8 @@
 import base64
+import io
 
 import pytest
+from PIL import Image
 
 from core.imageshelper import calculate_image_token_cost, get_image_dims
 
@@ -32,3 +34,11 @@ def test_get_image_dims_small(small_image, large_image):
     assert get_image_dims(large_image) == (2050, 1238)
     with pytest.raises(ValueError, match="Image must be a base64 string."):
         assert get_image_dims("http://domain.com/image.png")
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "WEBP"])
+def test_get_image_dims_lossy_formats(image_format):
+    output = io.BytesIO()
+    Image.new("RGB", (1700, 2240), "white").save(output, format=image_format, quality=80)
+    image_uri = f"data:image/{image_format.lower()};base64,{base64.b64encode(output.getvalue()).decode('utf-8')}"
+    assert get_image_dims(image_uri) == (1700, 2240)
@@ -0,0 +1,187 @@
+import pytest
+import pytest_asyncio
+from azure.search.documents.models import VectorizedQuery
+
+from prepdocslib.localsearch import LocalSearchClient, ODataFilter
+from prepdocslib.strategy import SearchInfo
+
+DOCUMENTS = [
+    {
+        "id": "file-a-0",
+        "content": "O locatário pagará multa de três aluguéis em caso de rescisão antecipada.",
+        "category": "contratos",
+        "sourcepage": "a.pdf#page=1",
+        "sourcefile": "a.pdf",
+        "oids": ["oid1"],
+        "groups": [],
+        "embedding": [1.0, 0.0, 0.0],
+    },
+    {
+        "id": "file-a-1",
+        "content": "O aluguel mensal é reajustado anualmente pelo IGP-M.",
+        "category": "contratos",
+        "sourcepage": "a.pdf#page=2",
+        "sourcefile": "a.pdf",
+        "oids": ["oid1"],
+        "groups": ["group1"],
+        "embedding": [0.0, 1.0, 0.0],
+    },
+    {
+        "id": "file-b-0",
+        "content": "A petição inicial deve indicar o valor da causa.",
+        "category": "peticoes",
+        "sourcepage": "b.pdf#page=1",
+        "sourcefile": "b.pdf",
+        "oids": [],
+        "groups": ["group2"],
+        "embedding": [0.0, 0.0, 1.0],
+    },
+]
+
+
+@pytest_asyncio.fixture
+async def search_client(tmp_path):
+    search_client = LocalSearchClient(str(tmp_path), "index")
+    await search_client.upload_documents(DOCUMENTS)
+    await search_client.close()
+    return search_client
+
+
+async def search_ids(search_client, *args, **kwargs):
+    return [document["id"] async for document in await search_client.search(*args, **kwargs)]
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        ("category ne 'peticoes'", ["file-a-0", "file-a-1"]),
+        ("sourcefile eq 'b.pdf'", ["file-b-0"]),
+        ("id gt 'file-a-0'", ["file-a-1", "file-b-0"]),
+        ("not search.in(id, 'file-a-0,file-b-0', ',')", ["file-a-1"]),
+        ("oids/any(g:search.in(g, 'oid1, oid2'))", ["file-a-0", "file-a-1"]),
+        (
+            "category eq 'contratos' and (oids/any(g:search.in(g, 'oid2')) or groups/any(g:search.in(g, 'group1')))",
+            ["file-a-1"],
+        ),
+        ("groups/all(g: g ne 'group2')", ["file-a-0", "file-a-1"]),
+        ("sourcepage eq 'O''Brien.pdf'", []),
+    ],
+)
+def test_odata_filter(expression, expected):
+    predicate = ODataFilter(expression)
+
+    assert [document["id"] for document in DOCUMENTS if predicate(document)] == expected
+
+
+@pytest.mark.parametrize("expression", ["category", "category eq", "geo.distance(location, 'x') lt 5", "id eq 'a' )"])
+def test_odata_filter_unsupported(expression):
+    with pytest.raises(ValueError):
+        ODataFilter(expression)
+
+
+@pytest.mark.asyncio
+async def test_search_text(search_client):
+    results = [document async for document in await search_client.search("multa rescisão", top=3)]
+
+    assert [document["id"] for document in results] == ["file-a-0"]
+    assert results[0]["@search.score"] > 0
+    assert results[0]["@search.reranker_score"] is None
+    assert "embedding" in results[0]
+
+
+@pytest.mark.asyncio
+async def test_search_all(search_client):
+    assert await search_ids(search_client, "*", top=2) == ["file-a-0", "file-a-1"]
+    assert await search_ids(search_client, "", filter="sourcefile eq 'a.pdf'", order_by=["id desc"]) == [
+        "file-a-1",
+        "file-a-0",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_search_vectors(search_client):
+    vector_query = VectorizedQuery(vector=[0.1, 0.9, 0.2], k_nearest_neighbors=2, fields="embedding")
+
+    results = [document async for document in await search_client.search(None, vector_queries=[vector_query])]
+
+    assert [document["id"] for document in results] == ["file-a-1", "file-b-0"]
+    assert 0.5 < results[0]["@search.score"] <= 1
+
+
+@pytest.mark.asyncio
+async def test_search_hybrid(search_client):
+    vector_query = VectorizedQuery(vector=[0.0, 0.0, 1.0], k_nearest_neighbors=3, fields="embedding")
+
+    results = await search_client.search(
+        "aluguel", vector_queries=[vector_query], filter="category eq 'contratos'", select=["id", "content"]
+    )
+    documents = [document async for page in results.by_page() async for document in page]
+
+    # Both text and vector matches are fused, and the filter applies to both
+    assert [document["id"] for document in documents] == ["file-a-1", "file-a-0"]
+    assert "embedding" not in documents[0]
+    assert "sourcefile" not in documents[0]
+
+
+@pytest.mark.asyncio
+async def test_merge_and_delete(search_client):
+    results = await search_client.merge_documents([{"id": "file-b-0", "oids": ["oid2"]}, {"id": "missing"}])
+
+    assert [(result.key, result.succeeded, result.status_code) for result in results] == [
+        ("file-b-0", True, 200),
+        ("missing", False, 404),
+    ]
+    assert await search_ids(search_client, "", filter="oids/any(g:search.in(g, 'oid2'))") == ["file-b-0"]
+
+    deleted = await search_client.delete_documents([{"id": "file-a-0"}])
+
+    assert len(deleted) == 1
+    assert await search_ids(search_client, "multa") == []
+    vector_query = VectorizedQuery(vector=[1.0, 0.0, 0.0], k_nearest_neighbors=3, fields="embedding")
+    assert sorted(await search_ids(search_client, None, vector_queries=[vector_query])) == ["file-a-1", "file-b-0"]
+
+
+@pytest.mark.asyncio
+async def test_persistence(search_client, tmp_path):
+    reader = LocalSearchClient(str(tmp_path), "index")
+
+    assert await search_ids(reader, "petição") == ["file-b-0"]
+
+    # Another client, such as prepdocs, updates the index and the reader picks up the change once it is saved
+    await search_client.upload_documents([{**DOCUMENTS[2], "id": "file-c-0", "embedding": [0.0, 0.0, 0.9]}])
+    reader.loaded_mtime = None
+    assert await search_ids(reader, "petição") == ["file-b-0"]
+    await search_client.close()
+    # The modification time may not have changed within the resolution of the file system
+    reader.loaded_mtime = None
+
+    assert await search_ids(reader, "petição") == ["file-b-0", "file-c-0"]
+    vector_query = VectorizedQuery(vector=[0.0, 0.0, 1.0], k_nearest_neighbors=2, fields="embedding")
+    assert sorted(await search_ids(reader, None, vector_queries=[vector_query])) == ["file-b-0", "file-c-0"]
+    assert [field.name for field in reader.get_index().fields if field.name in ("oids", "groups", "embedding")] == [
+        "oids",
+        "groups",
+        "embedding",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_replace_drops_missing_vectors(search_client, tmp_path):
+    await search_client.upload_documents([{**DOCUMENTS[0], "embedding": None}, DOCUMENTS[1]])
+    await search_client.close()
+    reader = LocalSearchClient(str(tmp_path), "index")
+
+    vector_query = VectorizedQuery(vector=[1.0, 0.0, 0.0], k_nearest_neighbors=3, fields="embedding")
+    assert sorted(await search_ids(reader, None, vector_queries=[vector_query])) == ["file-a-1", "file-b-0"]
+    assert "embedding" not in reader.select_fields("file-a-0", None)
+
+
+def test_search_info_local(tmp_path):
+    search_info = SearchInfo(
+        endpoint="https://test.search.windows.net/",
+        credential=None,
+        index_name="index",
+        local_search_path=str(tmp_path),
+    )
+
+    assert isinstance(search_info.create_search_client(), LocalSearchClient)
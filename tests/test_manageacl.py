@@ -7,6 +7,8 @@ from azure.search.documents.indexes.models import (
     SimpleField,
 )
 
+from core.cache import CacheGeneration, SqliteCacheBackend
+
 from .mocks import MockAzureCredential
 from scripts.manageacl import ManageAcl
 
@@ -163,6 +165,35 @@ async def test_add_acl(monkeypatch, capsys):
     ]
 
 
+@pytest.mark.asyncio
+async def test_acl_update_invalidates_search_cache(monkeypatch, tmp_path):
+    async def mock_search(self, *args, **kwargs):
+        return AsyncSearchResultsIterator([{"id": 1, "oids": ["OID_ACL"]}])
+
+    async def mock_merge_documents(self, *args, **kwargs):
+        pass
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
+    search_cache_path = str(tmp_path / "cache.db")
+
+    for acl_action in ["view", "remove"]:
+        command = ManageAcl(
+            service_name="SERVICE",
+            index_name="INDEX",
+            document="a.txt",
+            acl_action=acl_action,
+            acl_type="oids",
+            acl="OID_ACL",
+            credentials=MockAzureCredential(),
+            search_cache_path=search_cache_path,
+        )
+        await command.run()
+
+    # Only the update changes which cached results each user may see
+    assert CacheGeneration("search", shared_backend=SqliteCacheBackend(search_cache_path)).get() == 1
+
+
 @pytest.mark.asyncio
 async def test_add_acl_already_exists(monkeypatch, capsys):
     async def mock_search(self, *args, **kwargs):
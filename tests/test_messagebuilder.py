@@ -1,4 +1,4 @@
-from core.messagebuilder import MessageBuilder
+from core.messagebuilder import MessageBuilder, PromptPrefixCache
 
 
 def test_messagebuilder():
@@ -47,3 +47,36 @@ def test_messagebuilder_unicode_append():
     assert builder.model == "gpt-35-turbo"
     assert builder.count_tokens_for_message(builder.messages[0]) == 4
     assert builder.count_tokens_for_message(builder.messages[1]) == 4
+
+
+def test_prompt_prefix_cache():
+    cache = PromptPrefixCache(max_size=2)
+    few_shots = [{"role": "user", "content": "a\u0301?"}, {"role": "assistant", "content": "Yes."}]
+
+    prefix = cache.get("You are a bot.", "gpt-35-turbo", few_shots)
+
+    assert prefix.messages == (
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "á?"},
+        {"role": "assistant", "content": "Yes."},
+    )
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    assert prefix.token_count == sum(builder.count_tokens_for_message(message) for message in prefix.messages)
+    # The same prefix is returned until it is evicted
+    assert cache.get("You are a bot.", "gpt-35-turbo", few_shots) is prefix
+    cache.get("You are a bot.", "gpt-4", few_shots)
+    cache.get("You are a helpful bot.", "gpt-35-turbo")
+    assert cache.get("You are a bot.", "gpt-35-turbo", few_shots) is not prefix
+
+
+def test_messagebuilder_from_prefix():
+    prefix = PromptPrefixCache().get("You are a bot.", "gpt-35-turbo")
+
+    builder = MessageBuilder(prefix, "gpt-35-turbo")
+    builder.insert_message("user", "Hello, how are you?")
+
+    assert builder.messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "Hello, how are you?"},
+    ]
+    assert len(prefix.messages) == 1
@@ -1,9 +1,13 @@
 import pytest
 
 from core.modelhelper import (
+    TokenCountCache,
+    get_encoding,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
+    num_tokens_from_text,
+    pack_sources,
 )
 
 
@@ -75,6 +79,42 @@ def test_num_tokens_from_messages_error():
         num_tokens_from_messages(message, model)
 
 
+def test_get_encoding_is_memoized():
+    assert get_encoding("gpt-35-turbo") is get_encoding("gpt-35-turbo")
+
+
+def test_token_count_cache():
+    cache = TokenCountCache(max_size=2)
+
+    assert cache.count("Qual é o prazo da locação?", "gpt-35-turbo") == num_tokens_from_text(
+        "Qual é o prazo da locação?", "gpt-35-turbo"
+    )
+    cache.count("Qual é o prazo da locação?", "gpt-35-turbo")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # The same text is counted separately for each model
+    cache.count("Qual é o prazo da locação?", "gpt-4")
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # The least recently used count is evicted
+    cache.count("E a multa?", "gpt-35-turbo")
+    cache.count("Qual é o prazo da locação?", "gpt-35-turbo")
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert len(cache.counts) == 2
+
+
+def test_num_tokens_from_messages_uses_cache(monkeypatch):
+    cache = TokenCountCache()
+    monkeypatch.setattr("core.modelhelper.token_count_cache", cache)
+    message = {"role": "user", "content": "Qual é o prazo da locação?"}
+
+    first_count = num_tokens_from_messages(message, "gpt-35-turbo")
+    second_count = num_tokens_from_messages(message, "gpt-35-turbo")
+
+    assert first_count == second_count
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
 def test_get_oai_chatmodel_tiktok_mapped():
     assert get_oai_chatmodel_tiktok("gpt-35-turbo") == "gpt-3.5-turbo"
     assert get_oai_chatmodel_tiktok("gpt-35-turbo-16k") == "gpt-3.5-turbo-16k"
@@ -91,3 +131,33 @@ def test_get_oai_chatmodel_tiktok_error():
         get_oai_chatmodel_tiktok(None)
     with pytest.raises(ValueError, match="Expected Azure OpenAI ChatGPT model name"):
         get_oai_chatmodel_tiktok("gpt-3")
+
+
+def test_pack_sources():
+    sources = ["first.pdf: " + "contrato " * 50, "second.pdf: " + "locação " * 200, "third.pdf: short"]
+    first_tokens = num_tokens_from_text(sources[0], "gpt-35-turbo")
+
+    packed, props = pack_sources(sources, "gpt-35-turbo", max_tokens=first_tokens + 150, min_source_tokens=100)
+
+    # The second source is trimmed to the remaining tokens and the lower ranked third source is dropped
+    assert packed[0] == sources[0]
+    assert packed[1].startswith("second.pdf: locação")
+    assert len(packed[1]) < len(sources[1])
+    assert props == {
+        "sources_tokens": first_tokens + 150,
+        "sources_token_limit": first_tokens + 150,
+        "sources_trimmed": True,
+        "sources_dropped": 1,
+    }
+
+
+def test_pack_sources_drops_when_too_few_tokens_left():
+    sources = ["first.pdf: " + "contrato " * 50, "second.pdf: " + "locação " * 200]
+    first_tokens = num_tokens_from_text(sources[0], "gpt-35-turbo")
+
+    packed, props = pack_sources(sources, "gpt-35-turbo", max_tokens=first_tokens + 50, min_source_tokens=100)
+
+    assert packed == sources[:1]
+    assert props["sources_tokens"] == first_tokens + 1
+    assert props["sources_trimmed"] is False
+    assert props["sources_dropped"] == 1
@@ -0,0 +1,43 @@
+import pytest
+
+from approaches.rewritepolicy import QueryRewritePolicy
+
+
+@pytest.mark.parametrize(
+    "history, expected_rewrite",
+    [
+        ([{"role": "user", "content": "Qual é o prazo para interpor recurso de apelação?"}], False),
+        ([{"role": "user", "content": "Prazo?"}], True),
+        ([{"role": "user", "content": " ".join(["palavra"] * 31)}], True),
+        ([{"role": "user", "content": "Qual é o valor da multa prevista nesse contrato?"}], True),
+        ([{"role": "user", "content": "What is the deadline for it?"}], True),
+        ([{"role": "user", "content": "What is the appeal deadline?"}], True),
+        ([{"role": "user", "content": "Prazo recursal apelação cível"}], False),
+        (
+            [
+                {"role": "user", "content": "Qual é o prazo para interpor recurso de apelação?"},
+                {"role": "assistant", "content": "O prazo é de 15 dias úteis."},
+                {"role": "user", "content": "Qual é o prazo para embargos de declaração?"},
+            ],
+            True,
+        ),
+    ],
+)
+def test_query_rewrite_policy(history, expected_rewrite):
+    decision = QueryRewritePolicy().decide(history)
+
+    assert decision.rewrite is expected_rewrite
+    assert decision.reason
+
+
+def test_query_rewrite_policy_props():
+    decision = QueryRewritePolicy(max_user_messages=2).decide(
+        [
+            {"role": "user", "content": "Qual é o prazo para interpor recurso de apelação?"},
+            {"role": "assistant", "content": "O prazo é de 15 dias úteis."},
+            {"role": "user", "content": "E como isso é contado?"},
+        ]
+    )
+
+    assert decision.rewrite is True
+    assert decision.props == {"user_messages": 2, "question_words": 5, "anaphora": ["isso"], "portuguese": True}
@@ -1,15 +1,22 @@
+import asyncio
 import io
+import json
 
 import openai
 import openai.types
 import pytest
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
+from azure.search.documents.indexes.models import SearchIndex, SimpleField
 from openai.types.create_embedding_response import Usage
 
+from prepdocslib.blobmanager import PageImage
 from prepdocslib.embeddings import AzureOpenAIEmbeddingService
+from prepdocslib.indexprofile import INDEX_PROFILES, IndexProfile
 from prepdocslib.listfilestrategy import File
+from prepdocslib.manifest import IndexManifest
 from prepdocslib.searchmanager import SearchManager, Section
 from prepdocslib.strategy import SearchInfo
 from prepdocslib.textsplitter import SplitPage
@@ -19,6 +26,7 @@ from .mocks import (
     MOCK_EMBEDDING_MODEL_NAME,
     MockClient,
     MockEmbeddingsClient,
+    MockIndexingResult,
 )
 
 
@@ -89,6 +97,67 @@ async def test_create_index_doesnt_exist_yet(monkeypatch, search_info):
     assert len(indexes[0].fields) == 6
 
 
+@pytest.mark.asyncio
+async def test_create_index_default_profile(monkeypatch, search_info):
+    indexes = []
+
+    async def mock_create_index(self, index):
+        indexes.append(index)
+
+    async def mock_list_index_names(self):
+        for index in []:
+            yield index
+
+    monkeypatch.setattr(SearchIndexClient, "create_index", mock_create_index)
+    monkeypatch.setattr(SearchIndexClient, "list_index_names", mock_list_index_names)
+
+    manager = SearchManager(search_info)
+    await manager.create_index()
+    embedding_field = next(field for field in indexes[0].fields if field.name == "embedding")
+    assert embedding_field.hidden is False
+    assert embedding_field.stored is None
+    assert indexes[0].vector_search.compressions is None
+    assert indexes[0].vector_search.profiles[0].compression_configuration_name is None
+
+
+@pytest.mark.asyncio
+async def test_create_index_storage_optimized_profile(monkeypatch, search_info):
+    indexes = []
+
+    async def mock_create_index(self, index):
+        indexes.append(index)
+
+    async def mock_list_index_names(self):
+        for index in []:
+            yield index
+
+    monkeypatch.setattr(SearchIndexClient, "create_index", mock_create_index)
+    monkeypatch.setattr(SearchIndexClient, "list_index_names", mock_list_index_names)
+
+    profile = INDEX_PROFILES["storage-optimized"].with_hnsw_parameters(m=8, ef_search=200)
+    manager = SearchManager(search_info, search_images=True, index_profile=profile)
+    await manager.create_index()
+
+    vector_search = indexes[0].vector_search
+    for field in indexes[0].fields:
+        if field.name in ("embedding", "imageEmbedding"):
+            assert field.hidden is True
+            assert field.stored is False
+    assert vector_search.profiles[0].compression_configuration_name == "compression_config"
+    assert len(vector_search.compressions) == 1
+    assert vector_search.compressions[0].name == "compression_config"
+    assert vector_search.compressions[0].rerank_with_original_vectors is True
+    assert vector_search.compressions[0].default_oversampling == 4
+    assert vector_search.compressions[0].parameters.quantized_data_type == "int8"
+    hnsw_parameters = vector_search.algorithms[0].parameters
+    assert (hnsw_parameters.m, hnsw_parameters.ef_construction, hnsw_parameters.ef_search) == (8, 400, 200)
+
+
+def test_index_profile_unsupported_compression():
+    with pytest.raises(ValueError, match="Unsupported vector compression"):
+        IndexProfile("test", compression="pq")
+
+
 @pytest.mark.asyncio
 async def test_create_index_using_int_vectorization(monkeypatch, search_info):
     indexes = []
@@ -152,6 +221,29 @@ async def test_create_index_acls(monkeypatch, search_info):
     assert len(indexes[0].fields) == 8
 
 
+@pytest.mark.asyncio
+async def test_create_index_adds_image_dimension_fields(monkeypatch, search_info):
+    updated_indexes = []
+
+    async def mock_list_index_names(self):
+        yield "test"
+
+    async def mock_get_index(self, name):
+        return SearchIndex(name=name, fields=[SimpleField(name="id", type="Edm.String", key=True)])
+
+    async def mock_create_or_update_index(self, index):
+        updated_indexes.append(index)
+
+    monkeypatch.setattr(SearchIndexClient, "list_index_names", mock_list_index_names)
+    monkeypatch.setattr(SearchIndexClient, "get_index", mock_get_index)
+    monkeypatch.setattr(SearchIndexClient, "create_or_update_index", mock_create_or_update_index)
+
+    manager = SearchManager(search_info, search_images=True)
+    await manager.create_index()
+    assert len(updated_indexes) == 1, "It should have added the missing fields to the existing index"
+    assert [field.name for field in updated_indexes[0].fields] == ["id", "imageWidth", "imageHeight"]
+
+
 @pytest.mark.asyncio
 async def test_update_content(monkeypatch, search_info):
     async def mock_upload_documents(self, documents):
@@ -161,6 +253,7 @@ async def test_update_content(monkeypatch, search_info):
         assert documents[0]["category"] == "test"
         assert documents[0]["sourcepage"] == "foo.pdf#page=1"
         assert documents[0]["sourcefile"] == "foo.pdf"
+        return [MockIndexingResult(documents[0]["id"])]
 
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
 
@@ -184,12 +277,83 @@ async def test_update_content(monkeypatch, search_info):
     )
 
 
+@pytest.mark.asyncio
+async def test_update_content_with_page_images(monkeypatch, search_info):
+    documents_uploaded = []
+
+    async def mock_upload_documents(self, documents):
+        documents_uploaded.extend(documents)
+        return [MockIndexingResult(document["id"]) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manager = SearchManager(search_info)
+
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+
+    await manager.update_content(
+        [
+            Section(split_page=SplitPage(page_num=1, text="test content"), content=file, category="test"),
+        ],
+        image_embeddings=[[0.1, 0.2], [0.3, 0.4]],
+        page_images=[
+            PageImage(blob_name="foo-0.jpg", url="https://test/foo-0.jpg", width=612, height=832),
+            PageImage(blob_name="foo-1.jpg", url="https://test/foo-1.jpg", width=842, height=635),
+        ],
+    )
+
+    assert len(documents_uploaded) == 1
+    assert documents_uploaded[0]["sourcepage"] == "foo-1.jpg"
+    assert documents_uploaded[0]["imageEmbedding"] == [0.3, 0.4]
+    assert documents_uploaded[0]["imageWidth"] == 842
+    assert documents_uploaded[0]["imageHeight"] == 635
+
+
+@pytest.mark.asyncio
+async def test_update_content_with_page_images_without_url(monkeypatch, search_info):
+    documents_uploaded = []
+
+    async def mock_upload_documents(self, documents):
+        documents_uploaded.extend(documents)
+        return [MockIndexingResult(document["id"]) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manager = SearchManager(search_info)
+
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+
+    # The first page has no URL, so it wasn't embedded, but the second page keeps its own slot
+    await manager.update_content(
+        [
+            Section(split_page=SplitPage(page_num=0, text="first page"), content=file, category="test"),
+            Section(split_page=SplitPage(page_num=1, text="second page"), content=file, category="test"),
+        ],
+        image_embeddings=[None, [0.3, 0.4]],
+        page_images=[
+            PageImage(blob_name="foo-0.jpg", url=None, width=612, height=832),
+            PageImage(blob_name="foo-1.jpg", url="https://test/foo-1.jpg", width=842, height=635),
+        ],
+    )
+
+    assert [document["sourcepage"] for document in documents_uploaded] == ["foo-0.jpg", "foo-1.jpg"]
+    assert "imageEmbedding" not in documents_uploaded[0]
+    assert documents_uploaded[0]["imageWidth"] == 612
+    assert documents_uploaded[1]["imageEmbedding"] == [0.3, 0.4]
+    assert documents_uploaded[1]["imageHeight"] == 635
+
+
 @pytest.mark.asyncio
 async def test_update_content_many(monkeypatch, search_info):
     ids = []
 
     async def mock_upload_documents(self, documents):
         ids.extend([doc["id"] for doc in documents])
+        return [MockIndexingResult(doc["id"]) for doc in documents]
 
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
 
@@ -219,6 +383,106 @@ async def test_update_content_many(monkeypatch, search_info):
     assert len(set(ids)) == 1500, "Document ids are not unique"
 
 
+def make_sections(count: int, text: str = "test section"):
+    test_io = io.BytesIO(b"test page")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+    return [
+        Section(split_page=SplitPage(page_num=0, text=f"{text} {i}"), content=file, category="test")
+        for i in range(count)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_update_content_batches_by_size(monkeypatch, search_info):
+    batch_sizes = []
+
+    async def mock_upload_documents(self, documents):
+        batch_sizes.append(len(documents))
+        return [MockIndexingResult(document["id"]) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manager = SearchManager(search_info)
+    sections = make_sections(10, text="x" * 1000)
+    document_size = SearchManager.estimate_document_size({"content": sections[0].split_page.text})
+    manager.MAX_BATCH_BYTES = document_size * 4
+
+    await manager.update_content(sections)
+
+    assert batch_sizes == [3, 3, 3, 1]
+
+
+def test_estimate_document_size():
+    document = {"id": "file-foo_pdf-page-0", "content": 'some "quoted" text', "embedding": [-0.0023064255] * 1536}
+    assert SearchManager.estimate_document_size(document) >= len(json.dumps(document))
+
+
+@pytest.mark.asyncio
+async def test_update_content_retries_failed_documents(monkeypatch, search_info, caplog, tmp_path):
+    upload_calls = []
+
+    async def mock_upload_documents(self, documents):
+        upload_calls.append([document["id"] for document in documents])
+        results = []
+        for document in documents:
+            if document["content"] == "test section 1" and len(upload_calls) < 3:
+                results.append(MockIndexingResult(document["id"], False, 503, "Service unavailable"))
+            elif document["content"] == "test section 2":
+                results.append(MockIndexingResult(document["id"], False, 400, "Invalid document"))
+            else:
+                results.append(MockIndexingResult(document["id"]))
+        return results
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manifest_path = str(tmp_path / "manifest.json")
+    manager = SearchManager(search_info, manifest=IndexManifest(manifest_path))
+    manager.UPLOAD_RETRY_DELAY = 0
+    sections = make_sections(4)
+
+    with caplog.at_level("INFO"):
+        await manager.update_content(sections)
+
+    assert len(upload_calls) == 3
+    assert len(upload_calls[0]) == 4
+    # Only the document with a transient failure is retried, until it succeeds
+    assert upload_calls[1] == upload_calls[2] == [upload_calls[0][1]]
+    assert f"Failed to index section {upload_calls[0][2]}: Invalid document" in caplog.text
+    # The section that failed for good is counted, and left out of the manifest
+    assert manager.failed_section_count == 1
+    assert sorted(IndexManifest(manifest_path).get(sections[0].content.filename())) == sorted(
+        [upload_calls[0][0], upload_calls[0][1], upload_calls[0][3]]
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_content_overlaps_embedding_and_upload(monkeypatch, search_info):
+    events = []
+
+    class MockEmbeddings:
+        open_ai_dimensions = 3
+
+        async def create_embeddings(self, texts):
+            events.append(f"embed {len(texts)}")
+            return [[0.1, 0.2, 0.3] for _ in texts]
+
+    async def mock_upload_documents(self, documents):
+        events.append(f"upload start {len(documents)}")
+        await asyncio.sleep(0)
+        events.append(f"upload end {len(documents)}")
+        return [MockIndexingResult(document["id"]) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manager = SearchManager(search_info, embeddings=MockEmbeddings())
+    manager.MAX_BATCH_SIZE = 2
+
+    await manager.update_content(make_sections(3))
+
+    assert events == ["embed 2", "embed 1", "upload start 2", "upload end 2", "upload start 1", "upload end 1"]
+
+
 @pytest.mark.asyncio
 async def test_update_content_with_embeddings(monkeypatch, search_info):
     async def mock_create_client(*args, **kwargs):
@@ -248,6 +512,7 @@ async def test_update_content_with_embeddings(monkeypatch, search_info):
 
     async def mock_upload_documents(self, documents):
         documents_uploaded.extend(documents)
+        return [MockIndexingResult(document["id"]) for document in documents]
 
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
     embeddings = AzureOpenAIEmbeddingService(
@@ -341,7 +606,7 @@ async def test_remove_content(monkeypatch, search_info):
 
     await manager.remove_content("foo.pdf")
 
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert len(searched_filters) == 1, "It should have searched once (the only page of results wasn't full)"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 1, "It should have deleted one document"
     assert deleted_documents[0]["id"] == "file-foo_pdf-666F6F2E706466-page-0"
@@ -425,7 +690,7 @@ async def test_remove_content_only_oid(monkeypatch, search_info):
     manager = SearchManager(search_info)
     await manager.remove_content("foo.pdf", only_oid="A-USER-ID")
 
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert len(searched_filters) == 1, "It should have searched once (the only page of results wasn't full)"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 1, "It should have deleted one document"
     assert deleted_documents[0]["id"] == "file-foo_pdf-222"
@@ -469,3 +734,120 @@ async def test_remove_content_no_inf_loop(monkeypatch, search_info):
     assert len(searched_filters) == 1, "It should have searched once"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 0, "It should have deleted no documents"
+
+
+@pytest.mark.asyncio
+async def test_remove_content_keyset_pagination(monkeypatch, search_info):
+    all_ids = [f"file-foo_pdf-666F6F2E706466-page-{i}" for i in range(5)]
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        assert kwargs["select"] == ["id"]
+        assert kwargs["order_by"] == ["id asc"]
+        ids = sorted(all_ids)
+        filter = kwargs["filter"]
+        if " and " in filter:
+            last_id = filter.split("id gt '")[1].rstrip("')")
+            ids = [id for id in ids if id > last_id]
+        return AsyncSearchResultsIterator([{"id": id} for id in reversed(ids[: kwargs["top"]])])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    deleted_batches = []
+
+    async def mock_delete_documents(self, documents):
+        deleted_batches.append([document["id"] for document in documents])
+        return documents
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manager = SearchManager(search_info)
+    manager.MAX_BATCH_SIZE = 2
+    await manager.remove_content("foo.pdf")
+
+    assert [search["filter"] for search in searches] == [
+        "sourcefile eq 'foo.pdf'",
+        "(sourcefile eq 'foo.pdf') and (id gt 'file-foo_pdf-666F6F2E706466-page-1')",
+        "(sourcefile eq 'foo.pdf') and (id gt 'file-foo_pdf-666F6F2E706466-page-3')",
+    ]
+    assert sorted(id for batch in deleted_batches for id in batch) == sorted(all_ids)
+
+
+@pytest.mark.asyncio
+async def test_remove_content_id_not_sortable(monkeypatch, search_info):
+    documents = [{"id": id, "oids": oids} for id, oids in [("a", ["A"]), ("b", ["A", "B"]), ("c", ["A"]), ("d", ["A"])]]
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        if kwargs.get("order_by"):
+            error = HttpResponseError(message="Field 'id' is not sortable")
+            error.status_code = 400
+            raise error
+        skip = kwargs["skip"] or 0
+        return AsyncSearchResultsIterator(list(reversed(documents[skip : skip + kwargs["top"]])))
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    deleted_batches = []
+
+    async def mock_delete_documents(self, batch):
+        deleted_batches.append([document["id"] for document in batch])
+        for document in batch:
+            documents.remove(next(d for d in documents if d["id"] == document["id"]))
+        return batch
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manager = SearchManager(search_info)
+    manager.MAX_BATCH_SIZE = 2
+    manager.REMOVAL_REFRESH_DELAY = 0
+    await manager.remove_content(only_oid="A")
+
+    # The search is repeated after each deletion, only skipping the sections shared with other users
+    assert [search.get("skip") for search in searches[1:]] == [None, 1, 1]
+    assert all(search["filter"] is None for search in searches)
+    assert deleted_batches == [["a"], ["c", "d"]]
+    assert [document["id"] for document in documents] == ["b"]
+
+
+@pytest.mark.asyncio
+async def test_remove_content_from_manifest(monkeypatch, search_info, tmp_path):
+    async def mock_upload_documents(self, documents):
+        return [MockIndexingResult(document["id"]) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    async def mock_search(self, *args, **kwargs):
+        assert False, "search() shouldn't have been called"
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    deleted_ids = []
+
+    async def mock_delete_documents(self, documents):
+        deleted_ids.extend(document["id"] for document in documents)
+        return documents
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manifest_path = str(tmp_path / "manifest.json")
+    manager = SearchManager(search_info, manifest=IndexManifest(manifest_path))
+    await manager.update_content(make_sections(3))
+    assert IndexManifest(manifest_path).get("foo.pdf") == [
+        "file-foo_pdf-666F6F2E706466-page-0",
+        "file-foo_pdf-666F6F2E706466-page-1",
+        "file-foo_pdf-666F6F2E706466-page-2",
+    ]
+
+    # A later run only has the manifest on disk to go by
+    manager = SearchManager(search_info, manifest=IndexManifest(manifest_path))
+    await manager.remove_content("data/foo.pdf")
+
+    assert deleted_ids == [
+        "file-foo_pdf-666F6F2E706466-page-0",
+        "file-foo_pdf-666F6F2E706466-page-1",
+        "file-foo_pdf-666F6F2E706466-page-2",
+    ]
+    assert IndexManifest(manifest_path).get("foo.pdf") is None
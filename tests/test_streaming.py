@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import pytest
+
+from core.streaming import FollowupQuestionParser, StreamDelta, coalesce_deltas
+
+ANSWER = "<table><tr><td>Multa</td><td>3 aluguéis</td></tr></table> [contrato.pdf]"
+FOLLOWUPS = "<<Qual é o prazo?>> <<Quem paga o condomínio?>>"
+
+
+def test_stream_delta_to_ndjson():
+    delta = StreamDelta('A multa é de "três" aluguéis.\n')
+
+    # The frame is the same as the one written by json.dumps for the event
+    assert delta.to_ndjson() == json.dumps(delta, ensure_ascii=False) + "\n"
+    assert delta["choices"][0]["delta"]["content"] == delta.content
+
+
+@pytest.mark.asyncio
+async def test_coalesce_deltas():
+    async def gen():
+        yield {"choices": [{"context": {"data_points": []}}]}
+        yield StreamDelta("A multa ")
+        yield StreamDelta("é de ")
+        yield StreamDelta("três aluguéis.")
+        await asyncio.sleep(0.1)
+        yield StreamDelta(" Ela é reduzida")
+        yield {"choices": [{"context": {"followup_questions": []}}]}
+        yield StreamDelta(".")
+
+    events = [event async for event in coalesce_deltas(gen(), 0.02)]
+
+    assert events == [
+        {"choices": [{"context": {"data_points": []}}]},
+        # The deltas generated within the window are merged, and written before the pause ends
+        StreamDelta("A multa é de três aluguéis."),
+        StreamDelta(" Ela é reduzida"),
+        {"choices": [{"context": {"followup_questions": []}}]},
+        StreamDelta("."),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_deltas_error():
+    async def gen():
+        yield StreamDelta("A multa ")
+        raise ValueError("something bad happened")
+
+    events = []
+    with pytest.raises(ValueError):
+        async for event in coalesce_deltas(gen(), 0.02):
+            events.append(event)
+
+    assert events == [StreamDelta("A multa ")]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_deltas_closed_early():
+    closed = asyncio.Event()
+
+    async def gen():
+        try:
+            yield {"choices": [{"context": {"data_points": []}}]}
+            yield StreamDelta("A multa ")
+            await asyncio.sleep(10)
+            yield StreamDelta("é de três aluguéis.")
+        finally:
+            closed.set()
+
+    stream = coalesce_deltas(gen(), 0.02)
+    assert await stream.__anext__() == {"choices": [{"context": {"data_points": []}}]}
+    # The merged delta is written when the window closes, while the generator is still waiting for the next one
+    assert await stream.__anext__() == StreamDelta("A multa ")
+    await stream.aclose()
+
+    assert closed.is_set()
+
+
+def parse_chunks(chunks):
+    parser = FollowupQuestionParser()
+    content, questions = [], []
+    for chunk in chunks:
+        chunk_content, chunk_questions = parser.feed(chunk)
+        content.append(chunk_content)
+        questions.append(chunk_questions)
+    content.append(parser.close())
+    return "".join(content), questions
+
+
+def test_followup_question_parser():
+    content, questions = parse_chunks(["A multa é de 3 aluguéis. <", "<Qual é o pra", "zo?>", "> <<Quem paga?>>"])
+
+    # The << split across chunks isn't part of the answer
+    assert content == "A multa é de 3 aluguéis. "
+    # Each question is returned by the chunk that completes it
+    assert questions == [[], [], [], ["Qual é o prazo?", "Quem paga?"]]
+
+
+def test_followup_question_parser_html():
+    content, questions = parse_chunks(["<table><", "tr><td>Multa</td></tr></table>"])
+
+    assert content == "<table><tr><td>Multa</td></tr></table>"
+    assert questions == [[], []]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7])
+def test_followup_question_parser_chunks(chunk_size):
+    text = ANSWER + FOLLOWUPS
+    chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    content, questions = parse_chunks(chunks)
+
+    assert content == ANSWER
+    assert sum(questions, []) == ["Qual é o prazo?", "Quem paga o condomínio?"]
@@ -15,7 +15,7 @@ from quart.datastructures import FileStorage
 
 from prepdocslib.embeddings import AzureOpenAIEmbeddingService
 
-from .mocks import MockClient, MockEmbeddingsClient
+from .mocks import MockClient, MockEmbeddingsClient, MockIndexingResult
 
 
 # parameterize for directory existing or not
@@ -87,6 +87,7 @@ async def test_upload_file(auth_client, monkeypatch, mock_data_lake_service_clie
 
     async def mock_upload_documents(self, documents):
         documents_uploaded.extend(documents)
+        return [MockIndexingResult(document["id"]) for document in documents]
 
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
     monkeypatch.setattr(AzureOpenAIEmbeddingService, "create_client", mock_create_client)
@@ -222,7 +223,7 @@ async def test_delete_uploaded(auth_client, monkeypatch, mock_data_lake_service_
         "/delete_uploaded", headers={"Authorization": "Bearer test"}, json={"filename": "a.txt"}
     )
     assert response.status_code == 200
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert len(searched_filters) == 1, "It should have searched once (the only page of results wasn't full)"
     assert searched_filters[0] == "sourcefile eq 'a.txt'"
     assert len(deleted_documents) == 1, "It should have only deleted the document solely owned by OID_X"
     assert deleted_documents[0]["id"] == "file-a_txt-7465737420646F63756D656E742E706466"